@@ -1,4 +1,3 @@
-import sh
 from dataclasses import dataclass, asdict
 from abc import ABC
 from koda import Ok, Err, Result
@@ -8,14 +7,18 @@ import operator
 import itertools
 from dataclasses import asdict, dataclass
 import os
-from lm_dataformat import Archive
-from lm_dataformat import Reader
+import hashlib
+import json
+import threading
+from bisect import bisect_left
+from collections import Counter
+from functools import lru_cache
 from koda import Ok, Err
 from dataclasses import dataclass, fields
 
 from typing import List, Optional, Dict
 
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 @dataclass
 class AsmTarget:
     impl: str
@@ -44,21 +47,374 @@ class FuncAsm:
         return asdict(self)
 
 
+@dataclass
+class RawAsm:
+    func_asm: str  # whole compiler output, returned as is for fPIC targets
+
+    def dict(self):
+        return asdict(self)
+
+
+_TOOL_VERSIONS = {}
+_PCH_ARGS = {}  # preamble key -> compiler args that include its precompiled header, None if it couldn't be built
+_PCH_LOCK = threading.Lock()
+_PREAMBLE_LINE_PATTERN = re.compile(r'\s*(#\s*include\b.*)?$')
+
+_GCC_FUNC_LABEL_PATTERN = re.compile(r'\.(LFB|LFE)(\d+)')
+_CLANG_FUNC_LABEL_PATTERN = re.compile(r'\.(LBB|LCPI|Lfunc_end)(\d+)')
+
+
+@lru_cache(maxsize=None)
+def resolve_tool(name):
+    # sh.Command of an executable, looked up once per process. None if it isn't installed
+    import sh
+    try:
+        return getattr(sh, name)
+    except sh.CommandNotFound:
+        return None
+
+
+def _require_tool(name):
+    tool = resolve_tool(name)
+    if tool is None:
+        import sh
+        raise sh.CommandNotFound(name)
+    return tool
+
+
+def get_tool_version(tool):
+    path = str(tool)
+    if path not in _TOOL_VERSIONS:
+        try:
+            out = tool('--version')
+            _TOOL_VERSIONS[path] = out.stdout.decode().strip() if isinstance(out.stdout, bytes) else str(out).strip()
+        except BaseException:
+            _TOOL_VERSIONS[path] = path
+    return _TOOL_VERSIONS[path]
+
+
+_GAS_CONSTANT_PATTERN = re.compile(r'\.LC[0-9]*')
+_GAS_FUNCTION_TYPE_PATTERN = re.compile(r'\s*\.type\s+([^\s,]+)\s*,\s*[@%]function')
+_GAS_STATIC_PATTERN = re.compile(r'a\.[0-9]*')
+_CLANG_CONSTANT_PATTERN = re.compile(r'\.LC[0-9A-Z_]*')
+_CLANG_STRING_PATTERN = re.compile(r'\.L\.[a-z0-9]*')
+_ASM_DATA_DIRECTIVE_PATTERN = re.compile(
+    r'\s*\.(string|ascii|asciz|byte|short|value|hword|word|long|int|quad|octa|xword|dword|float|single|double|zero|'
+    r'space|[248]byte)\b')
+
+
+class _AsmLabelIndex:
+    """
+    Labels of a compiler output (lines ending with <label>:), indexed in a single pass, to look up the directives of
+    the constants a function references. The first definition of a label wins.
+    """
+
+    def __init__(self, all_asm):
+        if not isinstance(all_asm, str):
+            all_asm = all_asm.decode('utf-8')
+        self.lines = all_asm.replace('\r', '\n').split('\n')
+        self.labels = {}
+        for idx, line in enumerate(self.lines):
+            if line.endswith(':'):
+                tokens = line[:-1].split()
+                if tokens:
+                    self.labels.setdefault(tokens[-1], idx)
+
+    def directives(self, label, full_block=False, suffix=False):
+        # the first non-empty line after the label (None if there is none); with full_block, also the data
+        # directives that follow it (multi-line strings, tables, vector constants). With suffix, the first label
+        # ending with label is used (e.g. a.1 finds data.1)
+        if suffix:
+            idx = min((i for key, i in self.labels.items() if key.endswith(label)), default=None)
+        else:
+            idx = self.labels.get(label)
+        if idx is None:
+            return None
+        idx += 1
+        while idx < len(self.lines) and not self.lines[idx]:
+            idx += 1
+        if idx == len(self.lines):
+            return None
+        block = [self.lines[idx]]
+        if full_block:
+            idx += 1
+            while idx < len(self.lines) and _ASM_DATA_DIRECTIVE_PATTERN.match(self.lines[idx]):
+                block.append(self.lines[idx])
+                idx += 1
+        return block
+
+
+class _GASModule:
+    """
+    Lines of a compiler output with the positions of those that start (<fname>:) and end (.cfi_endproc, or returns
+    on RISC-V outputs without CFI directives) functions, collected in a single pass so that every function of the
+    module can be sliced out of it without scanning it again. global_directive lines (.globl/.global) are dropped
+    from the pre_asm of the function they declare.
+    """
+
+    def __init__(self, all_asm, riscv=False, global_directive='.globl'):
+        self.text = _output_text(all_asm)
+        self.lines = self.text.splitlines()
+        self.global_directive = global_directive
+        # without .cfi_endproc, the RISC-V returns end the function also when seen outside of it
+        self.ends_outside_func = riscv and '.cfi_endproc' not in self.text
+        self.starts = {}
+        self.ends = []
+        self.globals = []
+        self.function_names = []
+        for idx, line in enumerate(self.lines):
+            head, colon, _ = line.partition(':')
+            if colon:
+                self.starts.setdefault(head, []).append(idx)
+            if self.ends_outside_func:
+                if 'jr\tra' in line or 'ret' in line or 'jr ra' in line:
+                    self.ends.append(idx)
+            elif '.cfi_endproc' in line:
+                self.ends.append(idx)
+            if global_directive in line:
+                self.globals.append(idx)
+            m = _GAS_FUNCTION_TYPE_PATTERN.match(line)
+            if m is not None:
+                self.function_names.append(m.group(1))
+        self._label_index = None
+
+    @property
+    def label_index(self):
+        if self._label_index is None:
+            self._label_index = _AsmLabelIndex(self.text)
+        return self._label_index
+
+    def split(self, fname):
+        # (pre, func, post) lines of fname: lines before the first <fname>: line (without its global directive),
+        # from each <fname>: line to the next end, and everything else after the first end
+        lines, starts, ends = self.lines, self.starts.get(fname, []), self.ends
+        n = len(lines)
+        pre, func, post = [], [], []
+        pos, after = 0, False
+        while pos < n:
+            i = bisect_left(starts, pos)
+            start = starts[i] if i < len(starts) else n
+            i = bisect_left(ends, pos)
+            end = ends[i] if i < len(ends) else n
+            if self.ends_outside_func and end < start:
+                stop, start = end + 1, None
+            else:
+                stop = start
+            if after:
+                post.extend(lines[pos:stop])
+            else:
+                declaration = f'{self.global_directive} {fname}'
+                dropped = [idx for idx in self.globals[bisect_left(self.globals, pos):bisect_left(self.globals, stop)]
+                           if declaration in lines[idx]]
+                for idx in dropped:
+                    pre.extend(lines[pos:idx])
+                    pos = idx + 1
+                pre.extend(lines[pos:stop])
+            if start is None:
+                pos, after = stop, True
+                continue
+            if start == n:
+                break
+            i = bisect_left(ends, start)
+            end = ends[i] if i < len(ends) else n - 1
+            func.extend(lines[start:end + 1])
+            pos, after = end + 1, True
+        return pre, func, post
+
+
+def _output_text(out):
+    text = out if isinstance(out, str) else out.stdout
+    return text.decode() if isinstance(text, bytes) else text
+
+
+def _strip_comments(code, comment_sym):  # only support simple commands, asm
+    res = []
+    for l in code.splitlines():
+        without_comments = l.split(comment_sym)[0]
+        if len(without_comments.split()) > 0:
+            res.append(without_comments)
+    return '\n'.join(res)
+
+
+@lru_cache(maxsize=None)
+def _comment_pattern(comment_sym):
+    return re.compile(fr'{comment_sym}.*$', flags=re.MULTILINE)
+
+
+def _rename_symbol(code, old, new):
+    return re.sub(rf'\b{re.escape(old)}\b', new, code)
+
+
+def _split_preamble(all_required_c_code):
+    # leading #include lines that can be precompiled, and the code with them blanked out so that line numbers
+    # (e.g. __LINE__ in asserts) stay the same
+    lines = all_required_c_code.split('\n')
+    n = 0
+    while n < len(lines) - 1 and _PREAMBLE_LINE_PATTERN.match(lines[n]):
+        n += 1
+    if not any(line.strip() for line in lines[:n]):
+        return '', all_required_c_code
+    return '\n'.join(lines[:n]) + '\n', '\n' * n + '\n'.join(lines[n:])
+
+
+def _write_atomic(path, data):
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
 class Compiler:
-    def __init__(self, arch, o, lang, bits=64, fPIC=False):
+    def __init__(self, arch, o, lang, bits=64, fPIC=False, cache=None, pch_dir=None):
         self.arch = arch
         self.o = o
         self.bits = bits
         self.lang = lang
         self.fPIC = fPIC
+        self.cache = cache  # optional forklift.cache.AsmCache
+        self.pch_dir = pch_dir  # optional directory of precompiled #include preambles, see _compile
 
     def get_func_asm(self, all_required_c_code, fname, output_path=None) -> Result[FuncAsm, BaseException]:
-        return self._get_func_asm(all_required_c_code, fname, output_path, arch=self.arch, o=self.o, bits=self.bits)
+        if self.cache is None:
+            return self._get_func_asm(all_required_c_code, fname, output_path, arch=self.arch, o=self.o, bits=self.bits)
+        key = self.cache.key(all_required_c_code, fname, self.get_cache_params())
+        cached = self.cache.get(key)
+        if cached is not None:
+            return Ok(cached)
+        res = self._get_func_asm(all_required_c_code, fname, output_path, arch=self.arch, o=self.o, bits=self.bits)
+        if isinstance(res, Ok):
+            self.cache.put(key, res.val)
+        return res
+
+    def get_funcs_asm(self, deps, funcs) -> List[Result[FuncAsm, BaseException]]:
+        """
+        Batched get_func_asm for independent functions sharing the same deps: funcs is a list of (func_def, fname).
+        Where the output of a single compilation can be restored exactly (see _batch_exact), the functions are renamed
+        to avoid clashes, compiled as a single translation unit and split back per function. Everything else (other
+        targets, and functions whose output could depend on the rest of the batch) goes through get_func_asm, so
+        the results and the cache entries are the same as with get_func_asm.
+        """
+        def single(func_def, fname):
+            return self.get_func_asm(all_required_c_code=deps + '\n' + func_def, fname=fname)
+
+        if self.fPIC or len(funcs) < 2 or not self.batchable:
+            return [single(func_def, fname) for func_def, fname in funcs]
+        results = [None] * len(funcs)
+        todo = []
+        params = self.get_cache_params() if self.cache is not None else None
+        keys = [self.cache.key(deps + '\n' + func_def, fname, params) if params else None for func_def, fname in funcs]
+        for idx, key in enumerate(keys):
+            cached = self.cache.get(key) if key is not None else None
+            if cached is not None:
+                results[idx] = Ok(cached)
+            else:
+                todo.append(idx)
+        batch_names = [f'{funcs[idx][1]}__forklift_batch{n}' for n, idx in enumerate(todo)]
+        all_required_c_code = deps + '\n' + '\n'.join(_rename_symbol(funcs[idx][0], funcs[idx][1], batch_name)
+                                                      for idx, batch_name in zip(todo, batch_names))
+        try:
+            out = self._compile(all_required_c_code, self.arch, self.o, self.bits)
+            module = self._parse_output(out)
+        except BaseException:
+            out = None
+        for n, (idx, batch_name) in enumerate(zip(todo, batch_names)):
+            res = None
+            if out is not None:
+                res = self._func_asm_from_output(out, batch_name, self.arch, self.o, self.bits, func_index=n,
+                                                 module=module)
+            if isinstance(res, Ok) and self._batch_exact(module, batch_name, res.val.func_asm):
+                fname = funcs[idx][1]
+                func_asm = self._canonicalize_batch_labels(_rename_symbol(res.val.func_asm, batch_name, fname), n)
+                results[idx] = Ok(FuncAsm(pre_asm=_rename_symbol(res.val.pre_asm, batch_name, fname),
+                                          func_asm=func_asm,
+                                          post_asm=_rename_symbol(res.val.post_asm, batch_name, fname),
+                                          target=res.val.target))
+                if keys[idx] is not None:
+                    self.cache.put(keys[idx], results[idx].val)
+            else:
+                results[idx] = single(*funcs[idx])
+        return results
+
+    def get_funcs_asm_from_output(self, out, fnames=None) -> Dict[str, Result[FuncAsm, BaseException]]:
+        """
+        The FuncAsm of each of fnames (default: every function defined in the module) from a single compiler output,
+        parsed once: the same as get_func_asm extracting them one by one from that output.
+        """
+        module = self._parse_output(out)
+        positions = {fname: idx for idx, fname in enumerate(module.function_names)}
+        if fnames is None:
+            fnames = module.function_names
+        return {fname: self._func_asm_from_output(out, fname, self.arch, self.o, self.bits,
+                                                  func_index=positions.get(fname, 0), module=module)
+                for fname in fnames}
+
+    def _compile(self, all_required_c_code, arch, o, bits):
+        # With a pch_dir, the leading #include lines of the deps are precompiled once per preamble and compiler
+        # configuration, and every later compilation only parses the rest of the code
+        if self.pch_dir is not None:
+            preamble, rest = _split_preamble(all_required_c_code)
+            pch_args = self._get_pch_args(preamble, arch, o, bits) if preamble else None
+            if pch_args is not None:
+                try:
+                    return self._run_backend(rest, arch, o, bits, pch_args)
+                except BaseException:
+                    pass  # e.g. the precompiled header was rejected, compile the whole code instead
+        return self._run_backend(all_required_c_code, arch, o, bits, [])
+
+    def _get_pch_args(self, preamble, arch, o, bits):
+        params = dict(self.get_cache_params(), arch=arch, o=o, bits=bits)
+        key = hashlib.sha256(json.dumps([preamble, params], sort_keys=True).encode()).hexdigest()
+        with _PCH_LOCK:  # builds are rare, so a single lock is enough to build each header once
+            if key not in _PCH_ARGS:
+                header_path = os.path.join(os.path.expanduser(self.pch_dir), key + '.h')
+                try:
+                    os.makedirs(os.path.dirname(header_path), exist_ok=True)
+                    if not os.path.exists(header_path):
+                        _write_atomic(header_path, preamble)
+                    _PCH_ARGS[key] = self._build_pch(header_path, arch, o, bits)
+                except BaseException:
+                    _PCH_ARGS[key] = None
+            return _PCH_ARGS[key]
+
+    def _run_backend(self, all_required_c_code, arch, o, bits, pch_args):
+        raise NotImplementedError
+
+    def _build_pch(self, header_path, arch, o, bits):
+        raise NotImplementedError
+
+    def _parse_output(self, out):
+        raise NotImplementedError
+
+    def _func_asm_from_output(self, out, fname, arch, o, bits, func_index=0, module=None) \
+            -> Result[FuncAsm, BaseException]:
+        raise NotImplementedError
+
+    def _canonicalize_batch_labels(self, func_asm, func_index):
+        return func_asm
+
+    @property
+    def batchable(self):
+        # whether get_funcs_asm compiles functions together: only where _batch_exact can tell the results are exact
+        return False
+
+    def _batch_exact(self, module, batch_name, func_asm):
+        # whether func_asm, extracted from a batched module, is what compiling the function alone gives
+        return False
+
+    def get_cache_params(self):
+        params = dict(impl=type(self).__name__.lower(), arch=self.arch, o=self.o, bits=self.bits, lang=self.lang,
+                      fPIC=self.fPIC, version=self.get_version())
+        if getattr(self, 'full_constant_blocks', False):
+            params['full_constant_blocks'] = True
+        return params
+
+    def get_version(self):
+        raise NotImplementedError
 
     def _get_func_asm(self, all_required_c_code, fname, output_path, arch, o, bits) -> Result[FuncAsm, BaseException]:
         raise NotImplementedError
 
-    def _asm_replace_constants_with_literals(self, all_asm, func_asm):
+    def _asm_replace_constants_with_literals(self, all_asm, func_asm, index=None):
         raise NotImplementedError
 
     @classmethod
@@ -71,6 +427,8 @@ class Compiler:
 
 
 class GASCompiler(ABC, Compiler):
+    # inline whole multi-line constant blocks (strings, tables, vector constants) instead of their first line only
+    full_constant_blocks = False
 
     def get_comment_sym(self):
         if self.lang == 'gas':
@@ -82,109 +440,98 @@ class GASCompiler(ABC, Compiler):
         else:
             raise ValueError(f'lang = {self.lang}')
 
-    def _asm_replace_constants_with_literals(self, all_asm, func_asm):
-        all_asm = all_asm.decode("utf-8")
+    def _asm_replace_constants_with_literals(self, all_asm, func_asm, index=None):
+        # appends the definition of the constants (.LC<n>) and static variables (<name>.<n>) the function uses, in
+        # order of first use
+        index = index or _AsmLabelIndex(all_asm)
         asm_to_add = []
-        for symbol in set(re.compile('\.LC[0-9]*').findall(func_asm)):  # TODO: move, compile once
-            for e in re.findall(f'\.{symbol.replace(".", "")}:[\r\n]+([^\r\n]+)', all_asm):
-                asm_to_add.append(symbol + ': ' + e)
-                break
-        for symbol in set(re.compile('a\.[0-9]*').findall(func_asm)):  # TODO: move, compile once
-            for e in re.findall(f'{symbol}:[\r\n]+([^\r\n]+)', all_asm):
-                asm_to_add.append(symbol + ': ' + e)
-                break
+        for pattern, suffix in [(_GAS_CONSTANT_PATTERN, False), (_GAS_STATIC_PATTERN, True)]:
+            for symbol in dict.fromkeys(pattern.findall(func_asm)):
+                block = index.directives(symbol, full_block=self.full_constant_blocks, suffix=suffix)
+                if block is not None:
+                    asm_to_add.append(symbol + ': ' + block[0])
+                    asm_to_add.extend(block[1:])
         return func_asm + '\n' + '\n'.join(asm_to_add) + '\n'
 
-    def _gas_get_func_asm_from_all_asm(self, fname, all_asm):
-
-        def strip_comments(code, comment_sym):  # only support simple commands, asm
-            res = []
-            for l in code.splitlines():
-                without_comments = l.split(comment_sym)[0]
-                if len(without_comments.split()) > 0:
-                    res.append(without_comments)
-            return '\n'.join(res)
+    def _parse_output(self, out):
+        return _GASModule(out, riscv=self.arch == 'riscv',
+                          global_directive='.global' if self.arch == 'arm' else '.globl')
 
+    def _gas_get_func_asm_from_all_asm(self, fname, all_asm, module=None):
+        if module is None:
+            module = self._parse_output(all_asm)
         if self.arch == 'arm':
             func = [f'.global {fname}', f'.type {fname}, %function']
         else:
             func = [f'.globl {fname}', f'.type {fname}, @function']
-        inside_func = False
-        after_func = False
-        pre_asm = []
-        post_asm = []
-        for l in all_asm.splitlines():
-            if l.startswith(f'{fname}:'):
-                inside_func = True
-            if inside_func:
-                func.append(l)
-            elif after_func:
-                post_asm.append(l)
-            else:
-                if self.arch == 'arm':
-                    if f'.global {fname}' not in l:
-                        pre_asm.append(l)
-                else:
-                    if f'.globl {fname}' not in l:
-                        pre_asm.append(l)
-            if inside_func and '.cfi_endproc' in l:
-                inside_func = False
-                after_func = True
-            elif self.arch == 'riscv' and '.cfi_endproc' not in all_asm and ('jr\tra' in l or 'ret' in l or 'jr ra' in l):
-                inside_func = False
-                after_func = True
-
+        pre_asm, func_lines, post_asm = module.split(fname)
         pre_asm = '\n'.join(pre_asm) + '\n'
-        func_asm = '\n'.join(func) + '\n'
-        comment_sym = self.get_comment_sym()
-        func_asm = strip_comments(func_asm, comment_sym=comment_sym)
+        func_asm = '\n'.join(func + func_lines) + '\n'
+        func_asm = _strip_comments(func_asm, comment_sym=self.get_comment_sym())
         post_asm = '\n'.join(post_asm) + '\n'
 
         return pre_asm, func_asm, post_asm
 
 
 class GCC(GASCompiler):
+    # (arch, bits) -> executable, resolved on first use
+    TOOLS = {
+        ('x86', 64): 'gcc',
+        ('arm', 64): 'aarch64_linux_gnu_gcc',  # sudo apt install gcc-aarch64-linux-gnu
+        ('riscv', 64): 'riscv64_linux_gnu_gcc',  # sudo apt install gcc-riscv64-linux-gnu
+        ('arm', 32): 'arm_linux_gnueabi_gcc',  # sudo apt install  gcc-arm-linux-gnueabi
+    }
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, lang='gas', **kwargs)
-        self.x86_64 = sh.gcc
-        try:
-            self.arm_64 = sh.aarch64_linux_gnu_gcc  # sudo apt install gcc-aarch64-linux-gnu
-            self.riscv_64 = sh.riscv64_linux_gnu_gcc # sudo apt install gcc-riscv64-linux-gnu
-            self.arm_32 = sh.arm_linux_gnueabi_gcc # sudo apt install  gcc-arm-linux-gnueabi
-        except:
-            pass
-    def _get_func_asm(self, all_required_c_code, fname, output_path, arch, o, bits) -> Result[FuncAsm, BaseException]:
-        lang = 'gas'
-        if arch == 'arm' and bits == 64:
-            backend = self.arm_64
-        elif arch == 'x86' and bits == 64:
-            backend = self.x86_64
-        elif arch == 'riscv' and bits == 64:
-            backend = self.riscv_64
-        elif arch == 'arm' and bits == 32:
-            backend = self.arm_32
-        else:
+
+    def _get_backend(self, arch, bits):
+        if (arch, bits) not in self.TOOLS:
             raise NotImplementedError(f'arch = {arch}, bits = {bits}')
-        try:
+        return _require_tool(self.TOOLS[(arch, bits)])
+
+    def get_version(self):
+        return get_tool_version(self._get_backend(self.arch, self.bits))
+
+    def _run_backend(self, all_required_c_code, arch, o, bits, pch_args):
+        backend = self._get_backend(arch, bits)
+        extra_cmd = ['-fPIC'] if self.fPIC else []
+        return backend('-S', *extra_cmd, *pch_args, f'-O{o}', '-x', 'c', '-o', '/dev/stdout', '-',
+                       _in=all_required_c_code)
+
+    def _build_pch(self, header_path, arch, o, bits):
+        # gcc uses <header>.gch when the header is passed with -include, or parses the header itself if the
+        # precompiled one doesn't match the flags
+        pch_path = header_path + '.gch'
+        if not os.path.exists(pch_path):
+            backend = self._get_backend(arch, bits)
             extra_cmd = ['-fPIC'] if self.fPIC else []
-            out = backend('-S', *extra_cmd, f'-O{o}', '-x', 'c', '-o', '/dev/stdout', '-', _in=all_required_c_code)
+            tmp_path = f'{pch_path}.{os.getpid()}.tmp'
+            backend(*extra_cmd, f'-O{o}', '-x', 'c-header', '-o', tmp_path, header_path)
+            os.replace(tmp_path, pch_path)
+        return ['-include', header_path]
+
+    def _get_func_asm(self, all_required_c_code, fname, output_path, arch, o, bits) -> Result[FuncAsm, BaseException]:
+        self._get_backend(arch, bits)
+        try:
+            out = self._compile(all_required_c_code, arch, o, bits)
         except BaseException as e:
             return Err(e)
 
         if self.fPIC:
-            out = out.stdout.decode()
+            return Ok(RawAsm(func_asm=out.stdout.decode()))
+        return self._func_asm_from_output(out, fname, arch, o, bits)
 
-            class _anonclass:
-                def __init__(self):
-                    self.func_asm = out
-                    return
-                def dict(self):
-                    return {'func_asm': self.func_asm}
-            return Ok(_anonclass())
-        pre_asm, func_asm, post_asm = self._gas_get_func_asm_from_all_asm(all_asm=out, fname=fname)
+    def _func_asm_from_output(self, out, fname, arch, o, bits, func_index=0, module=None) \
+            -> Result[FuncAsm, BaseException]:
+        lang = 'gas'
+        if module is None:
+            module = self._parse_output(out)
+        pre_asm, func_asm, post_asm = self._gas_get_func_asm_from_all_asm(all_asm=out, fname=fname, module=module)
 
         if not (arch == 'arm' and bits == 32):
-            func_asm = self._asm_replace_constants_with_literals(all_asm=out.stdout, func_asm=func_asm)
+            func_asm = self._asm_replace_constants_with_literals(all_asm=out.stdout, func_asm=func_asm,
+                                                                 index=module.label_index)
         if self.fPIC:
             for l in post_asm.splitlines():
                 if '.comm' in l:
@@ -195,15 +542,245 @@ class GCC(GASCompiler):
                                                                                                    o=o))
         return Ok(func_asm)
 
+    @staticmethod
+    def _canonicalize_batch_labels(func_asm, func_index):
+        # .LFB<n>/.LFE<n> are numbered by function position in the translation unit
+        return _GCC_FUNC_LABEL_PATTERN.sub(lambda m: f'.{m.group(1)}{int(m.group(2)) - func_index}', func_asm)
+
+
+_LLVM_NAME = r'(?:"[^"]*"|[-a-zA-Z$._0-9]+)'
+_LLVM_TYPE_DEF_PATTERN = re.compile(rf'(%{_LLVM_NAME}) = type ')
+_LLVM_COMDAT_DEF_PATTERN = re.compile(rf'(\${_LLVM_NAME}) = comdat ')
+_LLVM_GLOBAL_DEF_PATTERN = re.compile(rf'(@{_LLVM_NAME}) = ((?:[a-z_]+(?:\([^)]*\))? )*?)(global|constant|alias|ifunc) (.*)$')
+_LLVM_FUNC_NAME_PATTERN = re.compile(rf'(@{_LLVM_NAME})\(')
+_LLVM_TYPE_REF_PATTERN = re.compile(rf'%{_LLVM_NAME}')
+_LLVM_GLOBAL_REF_PATTERN = re.compile(rf'@{_LLVM_NAME}')
+_LLVM_C_STRING_PATTERN = re.compile(r'c"[^"]*"')
+_LLVM_GLOBAL_TAIL_PATTERN = re.compile(r', (?:section|partition) "[^"]*"|, align \d+| #\d+$')
+_LLVM_MODULE_NUMBERED_PATTERN = re.compile(r'@\.|%(?:struct|union)\.(?:anon\b|[-a-zA-Z$._0-9]*\.\d+\b)')
+_LLVM_UNSUPPORTED_HEADER_PATTERN = re.compile(r' (?:personality|prefix|prologue) ')
+_LLVM_LOCAL_LINKAGES = {'private', 'internal'}
+_LLVM_LINKAGES = _LLVM_LOCAL_LINKAGES | {'available_externally', 'linkonce', 'weak', 'common', 'appending',
+                                         'extern_weak', 'linkonce_odr', 'weak_odr', 'external'}
+
+
+def _llvm_match_brackets(text, start):
+    # index right after the bracket group opening at text[start]
+    depth = 0
+    i = start
+    while i < len(text):
+        c = text[i]
+        if c == '"':
+            i = text.index('"', i + 1)
+        elif c in '([{<':
+            depth += 1
+        elif c in ')]}>':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    raise ValueError(f'unbalanced brackets in {text}')
+
+
+def _llvm_split_type(text):
+    # leading type of text (e.g. `[2 x i8*]`, `%struct.S`, `i32 (i32)*`) and the rest
+    if text[0] in '[{<':
+        i = _llvm_match_brackets(text, 0)
+    else:
+        i = re.match(rf'%{_LLVM_NAME}|[a-z0-9]+', text).end()
+    while True:
+        if text.startswith('*', i):
+            i += 1
+        elif text.startswith(' addrspace(', i):
+            i = _llvm_match_brackets(text, i + len(' addrspace'))
+        elif text.startswith(' (', i):  # function type
+            i = _llvm_match_brackets(text, i + 1)
+        else:
+            return text[:i], text[i:]
+
+
+def _llvm_split_params(params):
+    # top level commas of a parameter list
+    parts, depth, start = [], 0, 0
+    for i, c in enumerate(params):
+        if c in '([{<':
+            depth += 1
+        elif c in ')]}>':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            parts.append(params[start:i].strip())
+            start = i + 1
+    if params.strip():
+        parts.append(params[start:].strip())
+    return parts
+
+
+class _LLVMModule:
+    """
+    Textual view of a clang -S -emit-llvm module, parsed once, that reproduces what `llvm-extract -S --func=<fname>`
+    prints for a single function: referenced named types (depth first, in order of first use), the function's comdat,
+    declarations of the referenced globals and functions in module order and the function itself.
+    Returns None from extract() for modules it doesn't handle (numbered types, aliases, llvm.* globals) so that the
+    caller can fall back to llvm-extract.
+    """
+
+    def __init__(self, ir):
+        self.types = {}
+        self.comdats = {}
+        self.globals = []  # (name, line)
+        self.functions = []  # (name, lines), declarations have a single line
+        self.supported = True
+        self._references = None
+        self._users = None
+        lines = ir.splitlines()
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            if line.startswith('%'):
+                m = _LLVM_TYPE_DEF_PATTERN.match(line)
+                if m is None or m.group(1)[1:].isdigit():
+                    self.supported = False
+                else:
+                    self.types[m.group(1)] = line
+            elif line.startswith('$'):
+                m = _LLVM_COMDAT_DEF_PATTERN.match(line)
+                if m is not None:
+                    self.comdats[m.group(1)] = line
+            elif line.startswith('@'):
+                m = _LLVM_GLOBAL_DEF_PATTERN.match(line)
+                if m is None or m.group(3) in ('alias', 'ifunc') or m.group(1).startswith('@llvm.'):
+                    self.supported = False
+                else:
+                    self.globals.append((m.group(1), line))
+            elif line.startswith('declare '):
+                self.functions.append((_LLVM_FUNC_NAME_PATTERN.search(line).group(1), [line]))
+            elif line.startswith('define '):
+                start = i
+                while lines[i] != '}':
+                    i += 1
+                self.functions.append((_LLVM_FUNC_NAME_PATTERN.search(line).group(1), lines[start:i + 1]))
+            i += 1
+
+    @property
+    def function_names(self):
+        # defined functions, in module order
+        return [name[1:] for name, lines in self.functions if len(lines) > 1]
+
+    @property
+    def references(self):
+        # defined function -> globals and functions its body references (but itself)
+        if self._references is None:
+            self._references = {name: set(_LLVM_GLOBAL_REF_PATTERN.findall('\n'.join(lines[1:]))) - {name}
+                                for name, lines in self.functions if len(lines) > 1}
+        return self._references
+
+    @property
+    def users(self):
+        # global or function -> number of defined functions that reference it
+        if self._users is None:
+            self._users = Counter(ref for refs in self.references.values() for ref in refs)
+        return self._users
+
+    @staticmethod
+    def _split_linkage(tokens):
+        linkage = tokens[0] if tokens and tokens[0] in _LLVM_LINKAGES else ''
+        return linkage, tokens[1:] if linkage else tokens
+
+    @classmethod
+    def _global_declaration(cls, line):
+        m = _LLVM_GLOBAL_DEF_PATTERN.match(line)
+        name, attrs, kind, rest = m.groups()
+        linkage, attrs = cls._split_linkage(attrs.split())
+        if linkage in ('external', 'extern_weak'):
+            return line
+        if linkage in _LLVM_LOCAL_LINKAGES:
+            attrs = ['hidden'] + attrs
+        value_type, rest = _llvm_split_type(rest)
+        tail = ''.join(_LLVM_GLOBAL_TAIL_PATTERN.findall(_LLVM_C_STRING_PATTERN.sub('', rest)))
+        return ' '.join([f'{name} = external'] + attrs + [kind, value_type]) + tail
+
+    @classmethod
+    def _function_header(cls, line, declare):
+        keyword, rest = line.split(' ', 1)
+        name_match = _LLVM_FUNC_NAME_PATTERN.search(rest)
+        linkage, attrs = cls._split_linkage(rest[:name_match.start()].split(' '))
+        if linkage in _LLVM_LOCAL_LINKAGES:
+            attrs = ['hidden'] + attrs
+        elif not declare and linkage:
+            attrs = [linkage.replace('linkonce', 'weak')] + attrs  # llvm-extract keeps linkonce functions as weak
+        if not declare:
+            return ' '.join([keyword] + attrs) + rest[name_match.start():]
+        # declarations keep parameter types and attributes but not their names, comdats, metadata or bodies
+        params_end = _llvm_match_brackets(rest, name_match.end() - 1)
+        params = [p if p == '...' else p.rsplit(' ', 1)[0]
+                  for p in _llvm_split_params(rest[name_match.end():params_end - 1])]
+        tail = [token for token in rest[params_end:].split(' ')
+                if token and token != '{' and not token.startswith('!') and not token.startswith('comdat')]
+        return ' '.join(['declare'] + attrs) + rest[name_match.start():name_match.end()] + ', '.join(params) + ')' + \
+            ''.join(' ' + token for token in tail)
+
+    def extract(self, fname):
+        if not self.supported:
+            return None
+        fname = f'@{fname}'
+        func_lines = dict(self.functions).get(fname)
+        if func_lines is None or len(func_lines) == 1:
+            raise ValueError(f"program doesn't contain function named '{fname[1:]}'")
+        header = func_lines[0]
+        if ' available_externally ' in header:
+            return None
+        for name, lines in self.functions:
+            if len(lines) > 1 and _LLVM_UNSUPPORTED_HEADER_PATTERN.search(lines[0]):
+                return None
+        body = _LLVM_C_STRING_PATTERN.sub('', '\n'.join(func_lines))
+        refs = set(_LLVM_GLOBAL_REF_PATTERN.findall(body))
+
+        out_globals = [self._global_declaration(line) for name, line in self.globals if name in refs]
+        out_functions = []
+        for name, lines in self.functions:
+            if name == fname:
+                out_functions.extend([self._function_header(header, declare=False)] + func_lines[1:])
+            elif name in refs:
+                out_functions.append(lines[0] if len(lines) == 1 else self._function_header(lines[0], declare=True))
+
+        types = []
+        seen = set()
+
+        def add_types(text):
+            for ref in _LLVM_TYPE_REF_PATTERN.findall(text):
+                if ref in self.types and ref not in seen:
+                    seen.add(ref)
+                    types.append(self.types[ref])
+                    add_types(self.types[ref].split(' = type ', 1)[1])
+
+        add_types(_LLVM_C_STRING_PATTERN.sub('', '\n'.join(out_globals + out_functions)))
+        comdats = []
+        header_tail = header[_llvm_match_brackets(header, header.index(fname + '(') + len(fname)):]
+        comdat = re.search(rf' comdat(?:\((\${_LLVM_NAME})\))?', header_tail)
+        if comdat is not None:
+            comdats = [self.comdats[comdat.group(1) or '$' + fname[1:]]]
+        return '\n'.join(types + comdats + out_globals + out_functions)
+
 
 class Clang(GASCompiler):
+    use_llvm_extract = False  # slice IR functions with llvm-extract instead of _LLVMModule
+
     def __init__(self, *args, emit_llvm=False, **kwargs):
         lang = 'llvm' if emit_llvm else 'gas'
         super().__init__(*args, lang=lang, **kwargs)
-        self.clang = sh.clang  # sudo apt install clang
         self.emit_llvm = emit_llvm
         self.emit_llvm_flag = '-emit-llvm' if emit_llvm else ''
 
+    @property
+    def clang(self):
+        return _require_tool('clang')  # sudo apt install clang
+
+    def get_version(self):
+        version = get_tool_version(self.clang)
+        if self.emit_llvm and not self.fPIC and self.use_llvm_extract:
+            version += '\n' + get_tool_version(_require_tool('llvm_extract'))
+        return version
+
     def get_comment_sym(self):
         if self.lang == 'gas':
             if self.arch == 'arm':
@@ -214,96 +791,83 @@ class Clang(GASCompiler):
         else:
             raise ValueError(f'lang = {self.lang}')
 
-    def _get_all_llvm_ir(self, all_required_c_code):
-        assert self.emit_llvm
-        arch = self.arch
-        o = self.o
-        bits = self.bits
-        extra_cmd = []
-        all_required_c_code = all_required_c_code.replace('static ', ' ').replace('static\n', '\n').replace('static\t',
-                                                                                                            '\t')
+    def _get_backend(self, arch, bits):
         # clang doesn't return assembly in some cases
         if arch == 'x86' and bits == 64:
-            backend = self.clang
+            return self.clang, []
         elif arch == 'arm' and bits == 64:
-            backend = self.clang
-            extra_cmd.append('--target=aarch64')
+            return self.clang, ['--target=aarch64']
         elif arch == 'riscv' and bits == 64:
-            backend = self.clang
-            extra_cmd.append('--target=riscv64')
+            return self.clang, ['--target=riscv64']
         elif arch == 'arm' and bits == 32:
-            backend = self.clang
-            extra_cmd.append('--target=arm-linux-gnueabi')
+            return self.clang, ['--target=arm-linux-gnueabi']
             # extra_cmd.append('--target=arm-linux-gnueabihf')
-        else:
-            raise NotImplementedError(f'arch = {arch}, bits = {bits}')
-        try:
-            if self.fPIC:
-                extra_cmd.append('-fPIC')
-            out = backend(*extra_cmd, '-S', self.emit_llvm_flag, f'-O{o}', '-x', 'c', '-o', '/dev/stdout', '-',
-                          _in=all_required_c_code)
-            if self.fPIC:
-                out = out.stdout.decode()
+        raise NotImplementedError(f'arch = {arch}, bits = {bits}')
 
-                class _anonclass:
-                    def __init__(self):
-                        self.func_asm = out
-                        return
+    def _compile(self, all_required_c_code, arch, o, bits):
+        all_required_c_code = all_required_c_code.replace('static ', ' ').replace('static\n', '\n').replace('static\t', '\t')
+        return super()._compile(all_required_c_code, arch, o, bits)
 
-                    def dict(self):
-                        return {'func_asm': self.func_asm}
+    def _run_backend(self, all_required_c_code, arch, o, bits, pch_args):
+        backend, extra_cmd = self._get_backend(arch, bits)
+        if self.fPIC:
+            extra_cmd.append('-fPIC')
+        return backend(*extra_cmd, *pch_args, '-S', self.emit_llvm_flag, f'-O{o}', '-x', 'c', '-o', '/dev/stdout', '-',
+                       _in=all_required_c_code)
+
+    def _build_pch(self, header_path, arch, o, bits):
+        pch_path = header_path[:-len('.h')] + '.pch'
+        if not os.path.exists(pch_path):
+            backend, extra_cmd = self._get_backend(arch, bits)
+            if self.fPIC:
+                extra_cmd.append('-fPIC')
+            tmp_path = f'{pch_path}.{os.getpid()}.tmp'
+            backend(*extra_cmd, f'-O{o}', '-x', 'c-header', '-o', tmp_path, header_path)
+            os.replace(tmp_path, pch_path)
+        return ['-include-pch', pch_path]
 
-                return Ok(_anonclass())
+    def _get_all_llvm_ir(self, all_required_c_code):
+        assert self.emit_llvm
+        self._get_backend(self.arch, self.bits)
+        try:
+            out = self._compile(all_required_c_code, self.arch, self.o, self.bits)
+            if self.fPIC:
+                return Ok(RawAsm(func_asm=out.stdout.decode()))
         except BaseException as e:
             return Err(e)
         return Ok(out)
 
-
     def _get_func_asm(self, all_required_c_code, fname, output_path, arch, o, bits) -> Result[FuncAsm, BaseException]:
-        extra_cmd = []
-        all_required_c_code = all_required_c_code.replace('static ', ' ').replace('static\n', '\n').replace('static\t', '\t')
-        # clang doesn't return assembly in some cases
-        if arch == 'x86' and bits == 64:
-            backend = self.clang
-        elif arch == 'arm' and bits == 64:
-            backend = self.clang
-            extra_cmd.append( '--target=aarch64')
-        elif arch == 'riscv' and bits == 64:
-            backend = self.clang
-            extra_cmd.append( '--target=riscv64')
-        elif arch == 'arm' and bits == 32:
-            backend = self.clang
-            extra_cmd.append('--target=arm-linux-gnueabi')
-        else:
-            raise NotImplementedError(f'arch = {arch}, bits = {bits}')
+        self._get_backend(arch, bits)
         try:
+            out = self._compile(all_required_c_code, arch, o, bits)
             if self.fPIC:
-                extra_cmd.append('-fPIC')
-            out = backend(*extra_cmd, '-S', self.emit_llvm_flag, f'-O{o}', '-x', 'c', '-o', '/dev/stdout', '-',
-                          _in=all_required_c_code)
-            if self.fPIC:
-                out = out.stdout.decode()
-                class _anonclass:
-                    def __init__(self):
-                        self.func_asm = out
-                        return
-                    def dict(self):
-                        return {'func_asm': self.func_asm}
-
-                return Ok(_anonclass())
+                return Ok(RawAsm(func_asm=out.stdout.decode()))
         except BaseException as e:
             return Err(e)
+        return self._func_asm_from_output(out, fname, arch, o, bits)
+
+    def _parse_output(self, out):
+        if self.emit_llvm:
+            return _LLVMModule(_output_text(out))
+        return super()._parse_output(out)
+
+    def _func_asm_from_output(self, out, fname, arch, o, bits, func_index=0, module=None) \
+            -> Result[FuncAsm, BaseException]:
         try:
+            if module is None:
+                module = self._parse_output(out)
             if self.emit_llvm:
                 try:
-                    func_asm = self._llvm_get_func_asm_from_all_asm_using_llvm_extract(all_asm=out, fname=fname)
+                    func_asm = self._llvm_get_func_asm_from_all_asm(all_asm=out, fname=fname, module=module)
                 except BaseException as e:
                     return Err(e)
                 pre_asm = ''
                 post_asm = ''
             else:
-                pre_asm, func_asm, post_asm = self._gas_get_func_asm_from_all_asm(all_asm=out, fname=fname)
-                before, func_end, after = func_asm.partition('.Lfunc_end0:\n')
+                pre_asm, func_asm, post_asm = self._gas_get_func_asm_from_all_asm(all_asm=out, fname=fname,
+                                                                                  module=module)
+                before, func_end, after = func_asm.partition(f'.Lfunc_end{func_index}:\n')
                 new_func_asm = before
                 if '.cfi_endproc' in func_asm and '.cfi_endproc' not in new_func_asm:
                     new_func_asm += '\t.cfi_endproc\n'
@@ -314,52 +878,56 @@ class Clang(GASCompiler):
             return Err(e)
         if not self.emit_llvm:
             if not (arch == 'arm' and bits == 32):
-                if isinstance(out, str):
-                    func_asm = self._asm_replace_constants_with_literals(all_asm=out, func_asm=func_asm)
-                else:
-                    func_asm = self._asm_replace_constants_with_literals(all_asm=out.stdout, func_asm=func_asm)
+                func_asm = self._asm_replace_constants_with_literals(all_asm=module.text, func_asm=func_asm,
+                                                                     index=module.label_index)
         func_asm = FuncAsm(pre_asm=pre_asm, func_asm=func_asm, post_asm=post_asm, target=AsmTarget(impl='clang',
                                                                                                    bits=bits,
                                                                                                    lang='llvm' if self.emit_llvm else 'gas',
                                                                                                    o=o))
         return Ok(func_asm)
 
-    def _asm_replace_constants_with_literals(self, all_asm, func_asm):
-        if not isinstance(all_asm, str):
-            all_asm = all_asm.decode("utf-8")
-        symbols = set(re.compile('\.LC[0-9A-Z_]*').findall(func_asm)) | set(re.compile('\.L\.[a-z0-9]*').findall(func_asm))
+    @property
+    def batchable(self):
+        # GCC's module-wide label counters and the module-wide pre_asm/post_asm of assembly targets can't be
+        # restored, the IR of a function can
+        return self.emit_llvm
+
+    def _batch_exact(self, module, batch_name, func_asm):
+        # the IR of a function doesn't depend on the rest of the module unless it uses module-numbered names
+        # (@.str.<n>, %struct.anon, %struct.S.<n>), or other functions may have changed the module order of the
+        # globals and declarations it references
+        if _LLVM_MODULE_NUMBERED_PATTERN.search(func_asm):
+            return False
+        refs = module.references.get(f'@{batch_name}', set())
+        return len(refs) < 2 or all(module.users[ref] == 1 for ref in refs)
+
+    def _canonicalize_batch_labels(self, func_asm, func_index):
+        if self.emit_llvm:
+            return func_asm
+        # basic blocks, constant pools and function ends are numbered by function position in the translation unit
+        return _CLANG_FUNC_LABEL_PATTERN.sub(lambda m: f'.{m.group(1)}{int(m.group(2)) - func_index}', func_asm)
+
+    def _asm_replace_constants_with_literals(self, all_asm, func_asm, index=None):
+        index = index or _AsmLabelIndex(all_asm)
+        comment_pattern = _comment_pattern(self.get_comment_sym())
+        symbols = dict.fromkeys(_CLANG_CONSTANT_PATTERN.findall(func_asm) + _CLANG_STRING_PATTERN.findall(func_asm))
         asm_to_add = []
         for symbol in symbols:
-            for e in re.findall(f'{symbol}:[\r\n]+([^\r\n]+)', all_asm):
+            block = index.directives(symbol, full_block=self.full_constant_blocks)
+            if block is not None:
                 asm_to_add.append(symbol + ':')
-                e = re.sub(fr'{self.get_comment_sym()}.*$', '', e, flags=re.MULTILINE)
-                asm_to_add.append(e)
-                break
+                asm_to_add.extend(comment_pattern.sub('', e) for e in block)
         if not func_asm.endswith('\n'):
             func_asm = func_asm + '\n'
         return func_asm + '\n'.join(asm_to_add) + '\n'
 
     @staticmethod
     def normalize_structs(llvm_ir):
-        struct_dict = {}
-        counter = 0
-        normalized_ir = ""
-        struct_pattern = re.compile(r"(%struct\.[a-zA-Z0-9_]+)")
-        for line in llvm_ir.split("\n"):
-            for match in struct_pattern.findall(line):
-                if match not in struct_dict:
-                    struct_dict[match] = f"%struct.struct{counter}"
-                    counter += 1
-            normalized_line = struct_pattern.sub(lambda m: struct_dict.get(m.group(1), m.group(1)), line)
-            normalized_ir += normalized_line + "\n"
-        return normalized_ir
-
-    @classmethod
-    def _llvm_get_func_asm_from_all_asm_using_llvm_extract(cls, fname, all_asm):
-        llvm_extract = sh.llvm_extract
-        out = llvm_extract('-S', f'--func={fname}', _in=all_asm)
+        from .utils import normalize_structs
+        return normalize_structs(llvm_ir) if llvm_ir else "\n"
 
-        ir = out.stdout.decode() if isinstance(out.stdout, bytes) else out.stdout
+    @staticmethod
+    def _llvm_filter_ir(ir):
         filtered_ir = []
         for line in ir.splitlines():
             if len(line.splitlines()) == 0:
@@ -379,6 +947,24 @@ class Clang(GASCompiler):
         ir = re.sub(pattern, "", ir)
         return ir
 
+    @classmethod
+    def _llvm_get_func_asm_from_all_asm(cls, fname, all_asm, module=None):
+        # same output as llvm-extract, without spawning it; falls back to llvm-extract for modules it doesn't handle
+        if cls.use_llvm_extract:
+            return cls._llvm_get_func_asm_from_all_asm_using_llvm_extract(fname=fname, all_asm=all_asm)
+        extracted = (module or _LLVMModule(_output_text(all_asm))).extract(fname)
+        if extracted is None:
+            return cls._llvm_get_func_asm_from_all_asm_using_llvm_extract(fname=fname, all_asm=all_asm)
+        return cls._llvm_filter_ir(extracted)
+
+    @classmethod
+    def _llvm_get_func_asm_from_all_asm_using_llvm_extract(cls, fname, all_asm):
+        llvm_extract = _require_tool('llvm_extract')
+        out = llvm_extract('-S', f'--func={fname}', _in=all_asm)
+
+        ir = out.stdout.decode() if isinstance(out.stdout, bytes) else out.stdout
+        return cls._llvm_filter_ir(ir)
+
 
 @dataclass
 class IOPair:
@@ -438,82 +1024,117 @@ class FuncDataclass:
         return cls(**kwargs)
 
 
+# compiler key -> (impl, Compiler.factory kwargs). Every key also has a {key}_fPIC variant
+COMPILER_SPECS = {
+    'gcc_x86_O0': ('gcc', dict(arch='x86', o='0')),
+    'gcc_x86_O3': ('gcc', dict(arch='x86', o='3')),
+    'gcc_x86_Os': ('gcc', dict(arch='x86', o='s')),
+    'gcc_arm_O0': ('gcc', dict(arch='arm', o='0')),
+    'gcc_arm_Os': ('gcc', dict(arch='arm', o='s')),
+    'gcc_arm_O3': ('gcc', dict(arch='arm', o='3')),
+    'clang_x86_O0': ('clang', dict(arch='x86', o='0')),
+    'clang_x86_O3': ('clang', dict(arch='x86', o='3')),
+    'clang_ir_O0': ('clang', dict(arch='x86', o='0', emit_llvm=True)),
+    'clang_ir_Oz': ('clang', dict(arch='x86', o='z', emit_llvm=True)),
+    'clang_arm_O0': ('clang', dict(arch='arm', o='0')),
+    'clang_arm_O3': ('clang', dict(arch='arm', o='3')),
+    'gcc_riscv_O0': ('gcc', dict(arch='riscv', o='0')),
+    'gcc_riscv_O3': ('gcc', dict(arch='riscv', o='3')),
+    'clang_riscv_O0': ('clang', dict(arch='riscv', o='0')),
+    'clang_riscv_O3': ('clang', dict(arch='riscv', o='3')),
+    'clang_ir_O3': ('clang', dict(arch='x86', o='3', emit_llvm=True)),
+    'gcc_arm32_O0': ('gcc', dict(arch='arm', o='0', bits=32)),
+    'gcc_arm32_O3': ('gcc', dict(arch='arm', o='3', bits=32)),
+    'clang_arm32_O0': ('clang', dict(arch='arm', o='0', bits=32)),
+    'clang_arm32_O3': ('clang', dict(arch='arm', o='3', bits=32)),
+}
+
+
 class AsmAdder:
-    def __init__(self, compilers=None, also_do_real=False, replace_asm=False, compilers_keys=None):
-        self.compilers = self.setup_compilers() if not compilers else compilers
-        if compilers_keys:
+    def __init__(self, compilers=None, also_do_real=False, replace_asm=False, compilers_keys=None, n_workers=None,
+                 cache=None, pch_dir=None):
+        self.compilers = self.setup_compilers(compilers_keys or None) if not compilers else compilers
+        if compilers and compilers_keys:
             filtered_compilers = {}
             for k in self.compilers:
                 if k in compilers_keys:
                     filtered_compilers[k] = self.compilers[k]
             self.compilers = filtered_compilers
+        if cache is not None:
+            for k in self.compilers:
+                self.compilers[k].cache = cache
+        if pch_dir is not None:
+            for k in self.compilers:
+                self.compilers[k].pch_dir = pch_dir
         self.also_do_real = also_do_real
         self.replace_asm = replace_asm
+        # compilations are subprocess-bound, so threads are enough to keep n_workers compilers busy
+        self.n_workers = n_workers
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.n_workers)
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _compile_jobs(self, jobs):
+        # jobs: asm key (e.g. angha_gcc_x86_O0) -> (compiler key, all_required_c_code, fname)
+        if not self.n_workers or self.n_workers < 2 or len(jobs) < 2:
+            return {k: self.compilers[compiler].get_func_asm(all_required_c_code=all_required_c_code, fname=fname)
+                    for k, (compiler, all_required_c_code, fname) in jobs.items()}
+        pool = self._get_pool()
+        futures = {k: pool.submit(self.compilers[compiler].get_func_asm, all_required_c_code=all_required_c_code,
+                                  fname=fname)
+                   for k, (compiler, all_required_c_code, fname) in jobs.items()}
+        return {k: f.result() for k, f in futures.items()}
 
-    def add_asm_to_dict(self, fd_row: Dict):
+    @staticmethod
+    def _collect(results):
         asm_to_add = {}
-        n_ok = {}
+        for k, res in results.items():
+            asm_to_add[k] = res.val if isinstance(res, Ok) else None
+        return asm_to_add
+
+    def add_asm_to_dict(self, fd_row: Dict):
+        jobs = {}
         for compiler in self.compilers:
             if fd_row['synth_deps'] is not None and f'angha_{compiler}' not in fd_row['asm']:
                 all_required_c_code =fd_row['synth_deps'] + '\n' + fd_row['func_def']
                 all_required_c_code = all_required_c_code.replace('inline', ' ')
                 fname = fd_row['fname'] if ('func_head' not in fd_row or not fd_row[
                     'func_head']) else FuncDataclass.dict_get_fname_tmp_fix(fd_row)
-                res_asm_angha = self.compilers[compiler].get_func_asm(all_required_c_code=all_required_c_code,
-                                                                      fname=fname)
-                if isinstance(res_asm_angha, Ok):
-                    asm_to_add[f'angha_{compiler}'] = res_asm_angha.val
-                    n_ok[f'angha_{compiler}'] = 1
-                else:
-                    asm_to_add[f'angha_{compiler}'] = None
-                    n_ok[f'angha_{compiler}'] = 0
+                jobs[f'angha_{compiler}'] = (compiler, all_required_c_code, fname)
 
             if fd_row['real_deps'] is not None and self.also_do_real and f'real_{compiler}' not in fd_row['asm']:
                 all_required_c_code =fd_row['real_deps'] + '\n' + fd_row['func_def']
                 all_required_c_code = all_required_c_code.replace('inline', ' ')
                 fname = fd_row['fname'] if ('func_head' not in fd_row or not fd_row['func_head']) else FuncDataclass.dict_get_fname_tmp_fix(fd_row)
-                res_asm_real = self.compilers[compiler].get_func_asm(all_required_c_code=all_required_c_code,
-                                                                     fname=fname)
+                jobs[f'real_{compiler}'] = (compiler, all_required_c_code, fname)
 
-                if isinstance(res_asm_real, Ok):
-                    asm_to_add[f'real_{compiler}'] = res_asm_real.val
-                    n_ok[f'real_{compiler}'] = 1
-                else:
-                    asm_to_add[f'real_{compiler}'] = None
-                    n_ok[f'real_{compiler}'] = 0
-
-        return asm_to_add
+        return self._collect(self._compile_jobs(jobs))
 
     def add_asm(self, fd_dataclass: FuncDataclass):
-        asm_to_add = {}
-        n_ok = {}
+        jobs = {}
         for compiler in self.compilers:
             if fd_dataclass.angha_deps is not None and (not fd_dataclass.asm or not fd_dataclass.asm[f'angha_{compiler}']):
                 all_required_c_code = fd_dataclass.angha_deps + '\n' + fd_dataclass.func_def
                 all_required_c_code = all_required_c_code.replace('inline', ' ')
-                res_asm_angha = self.compilers[compiler].get_func_asm(all_required_c_code=all_required_c_code,
-                                                                      fname=fd_dataclass.get_fname_tmp_fix())
-                if isinstance(res_asm_angha, Ok):
-                    asm_to_add[f'angha_{compiler}'] = res_asm_angha.val
-                    n_ok[f'angha_{compiler}'] = 1
-                else:
-                    asm_to_add[f'angha_{compiler}'] = None
-                    n_ok[f'angha_{compiler}'] = 0
+                jobs[f'angha_{compiler}'] = (compiler, all_required_c_code, fd_dataclass.get_fname_tmp_fix())
 
             if fd_dataclass.real_deps is not None and self.also_do_real and (not fd_dataclass.asm or not fd_dataclass.asm[f'real_{compiler}']):
                 all_required_c_code = fd_dataclass.real_deps + '\n' + fd_dataclass.func_def
                 all_required_c_code = all_required_c_code.replace('inline', ' ')
                 fname = fd_dataclass.fname if not fd_dataclass.func_head else fd_dataclass.get_fname_tmp_fix()
-                res_asm_real = self.compilers[compiler].get_func_asm(all_required_c_code=all_required_c_code,
-                                                                     fname=fname)
+                jobs[f'real_{compiler}'] = (compiler, all_required_c_code, fname)
 
-                if isinstance(res_asm_real, Ok):
-                    asm_to_add[f'real_{compiler}'] = res_asm_real.val
-                    n_ok[f'real_{compiler}'] = 1
-                else:
-                    asm_to_add[f'real_{compiler}'] = None
-                    n_ok[f'real_{compiler}'] = 0
+        self._set_asm(fd_dataclass, self._collect(self._compile_jobs(jobs)))
 
+    def _set_asm(self, fd_dataclass: FuncDataclass, asm_to_add):
         if self.replace_asm:
             fd_dataclass.asm = asm_to_add
         else:
@@ -524,57 +1145,49 @@ class AsmAdder:
                     asm_to_add[k] = asm_to_add[k].dict()
                 fd_dataclass.asm[k] = asm_to_add[k]
 
+    def add_asm_batch(self, fd_dataclasses: List[FuncDataclass]):
+        # Same as calling add_asm on each element, but functions with the same deps are compiled together, in a
+        # single compiler invocation per target (see Compiler.get_funcs_asm)
+        groups = {}  # (asm key prefix, compiler, deps) -> [(index in fd_dataclasses, func_def, fname)]
+        keys = [[] for _ in fd_dataclasses]
+        for idx, fd_dataclass in enumerate(fd_dataclasses):
+            for compiler in self.compilers:
+                if fd_dataclass.angha_deps is not None and (not fd_dataclass.asm or not fd_dataclass.asm[f'angha_{compiler}']):
+                    group = ('angha', compiler, fd_dataclass.angha_deps.replace('inline', ' '))
+                    groups.setdefault(group, []).append((idx, fd_dataclass.func_def.replace('inline', ' '),
+                                                         fd_dataclass.get_fname_tmp_fix()))
+                    keys[idx].append(f'angha_{compiler}')
+                if fd_dataclass.real_deps is not None and self.also_do_real and (not fd_dataclass.asm or not fd_dataclass.asm[f'real_{compiler}']):
+                    fname = fd_dataclass.fname if not fd_dataclass.func_head else fd_dataclass.get_fname_tmp_fix()
+                    group = ('real', compiler, fd_dataclass.real_deps.replace('inline', ' '))
+                    groups.setdefault(group, []).append((idx, fd_dataclass.func_def.replace('inline', ' '), fname))
+                    keys[idx].append(f'real_{compiler}')
+
+        def compile_group(group):
+            _, compiler, deps = group
+            return self.compilers[compiler].get_funcs_asm(deps, [(func_def, fname) for _, func_def, fname in groups[group]])
+
+        if not self.n_workers or self.n_workers < 2 or len(groups) < 2:
+            group_results = {group: compile_group(group) for group in groups}
+        else:
+            futures = {group: self._get_pool().submit(compile_group, group) for group in groups}
+            group_results = {group: f.result() for group, f in futures.items()}
+
+        results = [{} for _ in fd_dataclasses]
+        for group, res_list in group_results.items():
+            kind, compiler, _ = group
+            for (idx, _, _), res in zip(groups[group], res_list):
+                results[idx][f'{kind}_{compiler}'] = res
+        for idx, fd_dataclass in enumerate(fd_dataclasses):
+            self._set_asm(fd_dataclass, self._collect({k: results[idx][k] for k in keys[idx]}))
+
     @staticmethod
-    def setup_compilers():  # adding riscv, clang IR O3
-        gcc_x86_O0 = Compiler.factory('gcc', arch='x86', o='0')
-        gcc_x86_O3 = Compiler.factory('gcc', arch='x86', o='3')
-        gcc_x86_Os = Compiler.factory('gcc', arch='x86', o='s')
-        gcc_arm_O0 = Compiler.factory('gcc', arch='arm', o='0')
-        gcc_arm_Os = Compiler.factory('gcc', arch='arm', o='s')
-        gcc_arm_O3 = Compiler.factory('gcc', arch='arm', o='3')
-        clang_x86_O0 = Compiler.factory('clang', arch='x86', o='0')
-        clang_x86_O3 = Compiler.factory('clang', arch='x86', o='3')
-        clang_ir_O0 = Compiler.factory('clang', arch='x86', o='0', emit_llvm=True)
-        clang_ir_Oz = Compiler.factory('clang', arch='x86', o='z', emit_llvm=True)
-        clang_arm_O0 = Compiler.factory('clang', arch='arm', o='0')
-        clang_arm_O3 = Compiler.factory('clang', arch='arm', o='3')
-        gcc_riscv_O0 = Compiler.factory('gcc', arch='riscv', o='0')
-        gcc_riscv_O3 = Compiler.factory('gcc', arch='riscv', o='3')
-        clang_riscv_O0 = Compiler.factory('clang', arch='riscv', o='0')
-        clang_riscv_O3 = Compiler.factory('clang', arch='riscv', o='3')
-        clang_ir_O3 = Compiler.factory('clang', arch='x86', o='3', emit_llvm=True)
-
-        gcc_arm32_O0 = Compiler.factory('gcc', arch='arm', o='0', bits=32)
-        gcc_arm32_O3 = Compiler.factory('gcc', arch='arm', o='3', bits=32)
-        clang_arm32_O0 = Compiler.factory('clang', arch='arm', o='0', bits=32)
-        clang_arm32_O3 = Compiler.factory('clang', arch='arm', o='3', bits=32)
-        compilers = {'gcc_x86_O0': gcc_x86_O0, 'gcc_x86_O3': gcc_x86_O3,
-                     'gcc_x86_Os': gcc_x86_Os,
-                     'gcc_arm_O0': gcc_arm_O0,
-                     'gcc_arm_Os': gcc_arm_Os,
-                     'gcc_arm_O3': gcc_arm_O3,
-                     'clang_x86_O0': clang_x86_O0, 'clang_x86_O3': clang_x86_O3, 'clang_ir_O0': clang_ir_O0,
-                     'clang_ir_Oz': clang_ir_Oz,
-                     'clang_arm_O0': clang_arm_O0, 'clang_arm_O3': clang_arm_O3,
-
-                     'gcc_riscv_O0': gcc_riscv_O0,
-
-                     'gcc_riscv_O3': gcc_riscv_O3,
-                     'clang_riscv_O0': clang_riscv_O0,
-                     'clang_riscv_O3': clang_riscv_O3,
-                     'clang_ir_O3': clang_ir_O3,
-                     'gcc_arm32_O0': gcc_arm32_O0,
-                     'gcc_arm32_O3': gcc_arm32_O3,
-                     'clang_arm32_O0': clang_arm32_O0,
-                     'clang_arm32_O3': clang_arm32_O3
-                     }
-
-
-        fpic_compilers = {}
-        for k in compilers:
-            fpic = deepcopy(compilers[k])
-            fpic.fPIC = True
-            fpic_compilers[f'{k}_fPIC'] = fpic
-        for k in fpic_compilers:
-            compilers[k] = fpic_compilers[k]
+    def setup_compilers(compilers_keys=None):  # adding riscv, clang IR O3
+        # only the compilers in compilers_keys (all of them if None), in COMPILER_SPECS order
+        compilers = {}
+        for fPIC in [False, True]:
+            for k, (impl, kwargs) in COMPILER_SPECS.items():
+                key = f'{k}_fPIC' if fPIC else k
+                if compilers_keys is None or key in compilers_keys:
+                    compilers[key] = Compiler.factory(impl, fPIC=fPIC, **kwargs)
         return compilers
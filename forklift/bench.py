@@ -0,0 +1,368 @@
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+# Micro-benchmarks of the preprocessing hot paths, each compared against the implementation it replaced.
+# Run with: python -m forklift.bench [name ...]
+# The generation benchmark needs a model and samples: python -m forklift.bench generation --model M --pair P
+# --samples samples.json
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _legacy_normalize_structs(llvm_ir):
+    if not llvm_ir:
+        return llvm_ir
+    struct_dict = {}
+    counter = 0
+    normalized_ir = ""
+    struct_pattern = re.compile(r"(%struct\.[a-zA-Z0-9_]+)")
+    for line in llvm_ir.split("\n"):
+        for match in struct_pattern.findall(line):
+            if match not in struct_dict:
+                struct_dict[match] = f"%struct.struct{counter}"
+                counter += 1
+        normalized_line = struct_pattern.sub(lambda m: struct_dict.get(m.group(1), m.group(1)), line)
+        normalized_ir += normalized_line + "\n"
+    return normalized_ir
+
+
+def _legacy_clean_detokenized(detok, remove_mask=True):
+    # DP.detokenize after tokenizer.decode, with the comment regex recompiled on every call
+    detok = detok.replace('<eol> ', '\n').replace('<eol>', '\n').replace('<tab> ', '\t').replace('<tab>', '\t')
+    if remove_mask:
+        detok = detok.replace(
+        '<mask:0>', '')
+    detok = detok.replace('<pad>', '').replace('<s>', '').replace('</s>', '')
+    detok = re.sub('# (/\w+)*', '', detok)
+    detok = detok.replace('0x ', '0x').replace(' #', '').replace('return', 'return ').replace('return  ', 'return ')
+    detok = detok.replace('static', '').replace('inline', '')
+    detok = re.sub('# (/\w+)*', '', detok)
+    detok = detok.replace('__attribute__((used))', '')
+    return detok
+
+
+def _legacy_gas_replace_constants(all_asm, func_asm):
+    # GASCompiler._asm_replace_constants_with_literals before the label index: one regex search of the module per symbol
+    asm_to_add = []
+    for symbol in set(re.compile(r'\.LC[0-9]*').findall(func_asm)):
+        for e in re.findall(f'\\.{symbol.replace(".", "")}:[\r\n]+([^\r\n]+)', all_asm):
+            asm_to_add.append(symbol + ': ' + e)
+            break
+    for symbol in set(re.compile(r'a\.[0-9]*').findall(func_asm)):
+        for e in re.findall(f'{symbol}:[\r\n]+([^\r\n]+)', all_asm):
+            asm_to_add.append(symbol + ': ' + e)
+            break
+    return func_asm + '\n' + '\n'.join(asm_to_add) + '\n'
+
+
+def _timeit(f, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _synthetic_ir(n_bytes):
+    block = '''%struct.node_{i} = type {{ i32, %struct.node_{i}*, %struct.list* }}
+
+define dso_local i32 @f{i}(%struct.node_{i}* noundef %0, %struct.list* noundef %1) #0 {{
+  %3 = getelementptr inbounds %struct.node_{i}, %struct.node_{i}* %0, i32 0, i32 0
+  %4 = load i32, i32* %3, align 8
+  %5 = getelementptr inbounds %struct.list, %struct.list* %1, i32 0, i32 1
+  ret i32 %4
+}}
+'''
+    blocks = []
+    size = 0
+    i = 0
+    while size < n_bytes:
+        blocks.append(block.format(i=i % 512))
+        size += len(blocks[-1])
+        i += 1
+    return ''.join(blocks)
+
+
+def bench_normalize_structs(sizes=(1 << 16, 1 << 20, 4 << 20)):
+    from .utils import normalize_structs
+    print(f"{'size':>10} {'legacy (s)':>12} {'single pass (s)':>16} {'speedup':>8}")
+    for size in sizes:
+        ir = _synthetic_ir(size)
+        assert normalize_structs(ir) == _legacy_normalize_structs(ir)
+        legacy = _timeit(_legacy_normalize_structs, ir)
+        new = _timeit(normalize_structs, ir)
+        print(f'{len(ir):>10} {legacy:>12.4f} {new:>16.4f} {legacy / new:>7.1f}x')
+
+
+def _synthetic_gas_module(n_constants):
+    # a vectorized function referencing n_constants constants, followed by their pool (as in gcc -O3 output)
+    func = ''.join(f'\tvmovapd\t.LC{i}(%rip), %ymm{i % 16}\n\tvaddpd\t%ymm{i % 16}, %ymm0, %ymm0\n'
+                   for i in range(n_constants))
+    pool = ''.join(f'\t.align 32\n.LC{i}:\n\t.long\t{i}\n\t.long\t{i + 1}\n\t.long\t{i + 2}\n\t.long\t{i + 3}\n'
+                   for i in range(n_constants))
+    return func, f'\t.text\nfunc0:\n{func}\tret\n\t.section\t.rodata.cst32,"aM",@progbits,32\n{pool}'
+
+
+def bench_constants(sizes=(16, 256, 2048)):
+    from .asm import GCC
+    compiler = GCC(arch='x86', o='3')
+    print(f"{'constants':>10} {'legacy (s)':>12} {'label index (s)':>16} {'speedup':>8}")
+    for size in sizes:
+        func_asm, all_asm = _synthetic_gas_module(size)
+        new = compiler._asm_replace_constants_with_literals(all_asm.encode(), func_asm)
+        assert sorted(new.split('\n')) == sorted(_legacy_gas_replace_constants(all_asm, func_asm).split('\n'))
+        legacy = _timeit(_legacy_gas_replace_constants, all_asm, func_asm)
+        new = _timeit(compiler._asm_replace_constants_with_literals, all_asm.encode(), func_asm)
+        print(f'{size:>10} {legacy:>12.4f} {new:>16.4f} {legacy / new:>7.1f}x')
+
+
+def _synthetic_gas_unit(n_funcs):
+    # a translation unit of n_funcs functions, each with its own constant (as in gcc -O2 output)
+    funcs = ''.join(f'\t.globl\tfunc{i}\n\t.type\tfunc{i}, @function\nfunc{i}:\n.LFB{i}:\n\t.cfi_startproc\n'
+                    f'\tmovsd\t.LC{i}(%rip), %xmm1\n\tmulsd\t%xmm1, %xmm0  # x * c\n\tret\n\t.cfi_endproc\n'
+                    f'.LFE{i}:\n\t.size\tfunc{i}, .-func{i}\n' for i in range(n_funcs))
+    pool = ''.join(f'\t.align 8\n.LC{i}:\n\t.long\t0\n\t.long\t{1072693248 + i}\n' for i in range(n_funcs))
+    return f'\t.text\n{funcs}\t.section\t.rodata.cst8,"aM",@progbits,8\n{pool}'
+
+
+def bench_extract(sizes=(16, 128, 512)):
+    # every function of a module: one scan of the output per function vs get_funcs_asm_from_output
+    from .asm import GCC
+    compiler = GCC(arch='x86', o='2')
+    print(f"{'functions':>10} {'per function (s)':>17} {'single pass (s)':>16} {'speedup':>8}")
+    for size in sizes:
+        out = SimpleNamespace(stdout=_synthetic_gas_unit(size).encode())
+        fnames = [f'func{i}' for i in range(size)]
+
+        def per_function():
+            return {fname: compiler._func_asm_from_output(out, fname, 'x86', '2', 64).val for fname in fnames}
+
+        def single_pass():
+            return {fname: res.val for fname, res in compiler.get_funcs_asm_from_output(out).items()}
+
+        assert per_function() == single_pass()
+        legacy = _timeit(per_function)
+        new = _timeit(single_pass)
+        print(f'{size:>10} {legacy:>17.4f} {new:>16.4f} {legacy / new:>7.1f}x')
+
+
+def _as_decoded(text, rng):
+    # what tokenizer.decode(..., skip_special_tokens=False) returns for a saved output, plus some pathological
+    # token joins (e.g. <s<pad>>) that only the chained replaces resolve
+    text = text.replace('\n', '<eol> ' if rng.random() < 0.5 else '<eol>').replace('\t', '<tab> ')
+    pieces = ['<s> <mask:0>', text, '</s>', '<pad>' * rng.randint(0, 3)]
+    if rng.random() < 0.2:
+        pieces.insert(2, rng.choice(['<s<pad>>', '</<pad>s>', '<<s>/s>', '<e<mask:0>ol>', '<s</s>>']))
+    return ' '.join(pieces)
+
+
+def check_detokenize(paths=None, seed=0):
+    # DP.detokenize's cleanup against the previous implementation, on saved model outputs
+    from .par_data import DP
+    paths = paths or sorted(glob.glob(os.path.join(REPO_ROOT, 'results', '*.ll')) +
+                            glob.glob(os.path.join(REPO_ROOT, 'manual', '*', '*.ll')))
+    if not paths:
+        raise FileNotFoundError(f'no saved model outputs (results/*.ll, manual/*/*.ll) under {REPO_ROOT}')
+    rng = random.Random(seed)
+    decoded = []
+    for path in paths:
+        with open(path) as f:
+            decoded.append(_as_decoded(f.read(), rng))
+    for detok in decoded:
+        for remove_mask in (True, False):
+            assert DP._clean_detokenized(detok, remove_mask) == _legacy_clean_detokenized(detok, remove_mask), detok
+    return decoded
+
+
+def bench_detokenize(model=None):
+    # decode_batch against one decode per hypothesis, with the tokenizer of model (the check alone without one)
+    from .par_data import DP
+    decoded = check_detokenize()
+    print(f'{len(decoded)} saved outputs: identical output')
+    if model is None:
+        return
+    from .evaluator import load_tokenizer
+    dp = DP(tokenizer=load_tokenizer(model))
+    samples = [enc.ids for enc in dp.tokenizer.encode_batch(decoded)]
+    samples = samples * max(1, 2000 // len(samples))
+    assert dp.detokenize_batch(samples) == [dp.detokenize(sample) for sample in samples]
+    single = _timeit(lambda: [dp.detokenize(sample) for sample in samples])
+    batch = _timeit(dp.detokenize_batch, samples)
+    print(f'{len(samples)} hypotheses: detokenize {single:.4f}s, detokenize_batch {batch:.4f}s '
+          f'({single / batch:.1f}x)')
+
+
+_INGEST_SOURCE = r'''
+#include <stdio.h>
+#include <stdlib.h>
+static int counter;
+const char *names[] = {"a", "b"};
+int helper(int x) { static int c; c++; return x * 2 + c + counter; }
+void report(int i) { printf("%s %d\n", names[i & 1], helper(i)); }
+int main(int argc, char **argv) { for (int i = 0; i < argc; i++) report(atoi(argv[i])); return 0; }
+'''
+
+
+def check_ingest(tools=('llvm-objdump', 'objdump')):
+    # the functions ingest takes from an object, a shared library and an executable built by gcc assemble on their own:
+    # every symbol they reference is a function or an object (not a file or section symbol), or a plain address
+    from .ingest import disassemble
+    tools = [path for path in map(shutil.which, tools) if path is not None]
+    if shutil.which('gcc') is None or shutil.which('as') is None or not tools:
+        return None
+    n_funcs = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, 'ingest.c')
+        with open(src, 'w') as f:
+            f.write(_INGEST_SOURCE)
+        binaries = {'ingest.o': ['-c'], 'ingest.so': ['-shared', '-fPIC'], 'ingest': []}
+        for name, flags in binaries.items():
+            subprocess.run(['gcc', '-O2', *flags, src, '-o', os.path.join(tmp, name)], check=True)
+        for name in binaries:
+            for tool in tools:
+                funcs = disassemble(os.path.join(tmp, name), objdump=tool)
+                assert {'helper', 'report', 'main'} <= set(funcs), (name, tool, list(funcs))
+                for fname, code in funcs.items():
+                    out = subprocess.run(['as', '-o', os.devnull, '-'], input=code, capture_output=True, text=True)
+                    assert out.returncode == 0, (name, tool, fname, out.stderr, code)
+                n_funcs += len(funcs)
+    return n_funcs
+
+
+def bench_ingest():
+    n_funcs = check_ingest()
+    if n_funcs is None:
+        print('needs gcc, as and objdump or llvm-objdump: skipped')
+    else:
+        print(f'{n_funcs} disassembled functions of an object, a shared library and an executable: all assemble')
+
+
+# dependencies that take seconds to import, which the command line tools must only load when they need them
+HEAVY_MODULES = ('torch', 'transformers', 'tokenizers', 'sh', 'lm_dataformat')
+
+
+def bench_imports(modules=('forklift.cli', 'forklift.verify', 'forklift.asm', 'forklift.utils', 'forklift.par_data'),
+                  repeat=5):
+    # import time of each module in a fresh interpreter (minus the interpreter startup) and the heavy modules it loads
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+
+    def run(code):
+        best, out = float('inf'), ''
+        for _ in range(repeat):
+            start = time.perf_counter()
+            out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True,
+                                 check=True).stdout
+            best = min(best, time.perf_counter() - start)
+        return best, out.strip()
+
+    startup, _ = run('pass')
+    print(f"{'module':>20} {'import (s)':>11}  heavy modules loaded")
+    for module in modules:
+        try:
+            elapsed, loaded = run(f'import sys, {module}; '
+                                  f'print(" ".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))')
+        except subprocess.CalledProcessError as e:  # a dependency of the module isn't installed
+            print(f'{module:>20} {"-":>11}  {e.stderr.strip().splitlines()[-1]}')
+            continue
+        print(f'{module:>20} {elapsed - startup:>11.3f}  {loaded or "-"}')
+
+
+# Config overrides of each generation mode. The first mode run is the reference of the exact-match column
+GENERATION_MODES = {
+    'fp32': dict(inference_mode=False),
+    'inference_mode': dict(),
+    'bf16': dict(dtype='bfloat16'),
+    'int8': dict(quantize='dynamic_int8'),
+    'compile': dict(compile_decoder=True),
+    'prompt_lookup': dict(prompt_lookup_num_tokens=10),  # speculative, greedy only
+    'assistant': dict(),  # speculative with the --assistant draft model, greedy only
+}
+_SPECULATIVE_MODES = ('prompt_lookup', 'assistant')
+
+
+def bench_generation(model, samples, pair, modes=None, num_threads=None, beam=1, assistant=None):
+    # tokens/s of the top hypothesis and exact match of the lifted IR against the first mode
+    from .evaluator import Config, get_evaluator
+    from .utils import InferenceDataset
+    if modes is None:
+        modes = [mode for mode in GENERATION_MODES if mode not in _SPECULATIVE_MODES or
+                 (beam == 1 and (mode != 'assistant' or assistant))]
+    rows = None
+    reference = None
+    print(f"{'mode':>16} {'time (s)':>10} {'tokens/s':>10} {'exact match':>12}")
+    for mode in modes:
+        overrides = dict(GENERATION_MODES[mode])
+        if mode == 'assistant':
+            overrides['assistant_model_path'] = assistant
+        config = Config(hf_model_path=model, pairs=[pair], beam=beam, num_threads=num_threads, **overrides)
+        evaluator = get_evaluator(config)
+        if rows is None:
+            rows = [(row, pair) for row in InferenceDataset(samples, pairs=[pair])]
+        evaluator.predict_batch(rows[:1])  # warm-up, torch.compile compiles here
+        start = time.perf_counter()
+        hyps = [h[0] for h in evaluator.predict_batch(rows)]
+        elapsed = time.perf_counter() - start
+        n_tokens = sum(len(evaluator.data_processor.tokenizer.encode(h).ids) for h in hyps)
+        reference = reference or hyps
+        match = sum(h == r for h, r in zip(hyps, reference)) / max(len(hyps), 1)
+        print(f'{mode:>16} {elapsed:>10.2f} {n_tokens / elapsed:>10.1f} {match:>11.1%}')
+
+
+def _bench_generation_from_args(args):
+    if not args.model or not args.samples or not args.pair:
+        raise SystemExit('generation: --model, --samples and --pair are required')
+    if args.modes and 'assistant' in args.modes and not args.assistant:
+        raise SystemExit('generation: the assistant mode requires --assistant')
+    with open(args.samples) as f:
+        samples = json.load(f)
+    bench_generation(args.model, samples, args.pair, modes=args.modes, num_threads=args.num_threads, beam=args.beam,
+                     assistant=args.assistant)
+
+
+BENCHMARKS = {
+    'normalize_structs': lambda args: bench_normalize_structs(),
+    'detokenize': lambda args: bench_detokenize(args.model),
+    'constants': lambda args: bench_constants(),
+    'extract': lambda args: bench_extract(),
+    'imports': lambda args: bench_imports(),
+    'ingest': lambda args: bench_ingest(),
+    'generation': _bench_generation_from_args,
+}
+DEFAULT_BENCHMARKS = ['normalize_structs', 'detokenize', 'constants', 'extract', 'imports', 'ingest']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Forklift benchmarks')
+    parser.add_argument('names', nargs='*', help=f'Benchmarks to run, among {", ".join(BENCHMARKS)} '
+                                                 f'(default: {", ".join(DEFAULT_BENCHMARKS)})')
+    parser.add_argument('--model', default=None, help='HF model path (generation, tokenizer of detokenize)')
+    parser.add_argument('--samples', default=None,
+                        help='JSON list of {func_def, deps, fname} samples to lift (generation)')
+    parser.add_argument('--pair', default=None, help='Lifting pair, e.g. clang_opt3_ir_optz-ir_optz (generation)')
+    parser.add_argument('--modes', nargs='+', default=None, choices=list(GENERATION_MODES),
+                        help='Generation modes to compare (default: all)')
+    parser.add_argument('--num-threads', type=int, default=None)
+    parser.add_argument('--beam', type=int, default=1)
+    parser.add_argument('--assistant', default=None, help='HF path of a draft model for the assistant mode')
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark {name}')
+    for name in args.names or DEFAULT_BENCHMARKS:
+        print(f'== {name}')
+        BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Optional, Union
+
+from .asm import AsmTarget, FuncAsm, RawAsm
+
+
+class AsmCache:
+    """
+    Content-addressed on-disk cache of compiler outputs (FuncAsm, or RawAsm for fPIC targets).
+    Keys hash the C code, the function name, the compiler flags and the compiler version. Entries are evicted in
+    least-recently-used order (by mtime, refreshed on every hit) once the directory grows over max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._size = sum(size for _, _, size in self._entries())
+
+    @staticmethod
+    def key(all_required_c_code, fname, params):
+        h = hashlib.sha256()
+        h.update(json.dumps([all_required_c_code, fname, params], sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for f in files:
+                if f.endswith('.json'):
+                    path = os.path.join(root, f)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:  # evicted by another process
+                        continue
+                    yield path, st.st_mtime, st.st_size
+
+    def get(self, key) -> Optional[Union[FuncAsm, RawAsm]]:
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        try:
+            if entry['kind'] == 'raw':
+                return RawAsm(func_asm=entry['func_asm'])
+            return FuncAsm(pre_asm=entry['pre_asm'], func_asm=entry['func_asm'], post_asm=entry['post_asm'],
+                           target=AsmTarget(**entry['target']))
+        except (KeyError, TypeError):  # written with another schema, treated as a miss and dropped
+            self._remove(path)
+            return None
+
+    def put(self, key, value: Union[FuncAsm, RawAsm]):
+        entry = value.dict()
+        entry['kind'] = 'raw' if isinstance(value, RawAsm) else 'func'
+        data = json.dumps(entry).encode()
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        try:
+            old_size = os.path.getsize(path)
+        except FileNotFoundError:
+            old_size = 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._size += len(data) - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._size -= size
+
+    def _evict(self):
+        # the directory may be shared between processes, so recompute the size from disk before evicting
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        self._size = sum(size for _, _, size in entries)
+        target = int(self.max_bytes * 0.9)
+        for path, _, size in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+    def clear(self):
+        with self._lock:
+            for path, _, _ in list(self._entries()):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._size = 0
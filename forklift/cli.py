@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import sys
+
+# Command line entry point: python -m forklift compile|lift|ingest|verify|bench ...
+# Each command imports what it needs when it runs, so that e.g. verify never loads torch and compile never loads the
+# tokenizer. Keep the imports at the top of this module to the standard library (see python -m forklift.bench imports).
+
+# commands that forward their arguments to the main() of another module
+FORWARDED = {'verify': 'forklift.verify', 'bench': 'forklift.bench'}
+
+
+def load_sample(path, fname):
+    # #include lines are the deps, everything else is the function definition
+    with open(path) as f:
+        lines = f.readlines()
+    deps = ''.join(line for line in lines if line.strip().startswith('#include'))
+    func_def = ''.join(line for line in lines if not line.strip().startswith('#include'))
+    return dict(func_def=func_def, deps=deps, fname=fname)
+
+
+def _inference_dataset(args, samples, pairs=None):
+    from .utils import InferenceDataset
+    cache = None
+    if args.asm_cache:
+        from .cache import AsmCache
+        cache = AsmCache(args.asm_cache)
+    return InferenceDataset(samples, compilers_keys=getattr(args, 'targets', None), n_workers=args.jobs, cache=cache,
+                            pch_dir=args.pch_dir, asm_as_dict=True, pairs=pairs)
+
+
+def compile_command(args):
+    if not args.targets and not args.pairs:
+        raise SystemExit('compile: --targets or --pairs is required')
+    samples = [load_sample(path, args.fname) for path in args.files]
+    for path, row in zip(args.files, _inference_dataset(args, samples, pairs=args.pairs)):
+        print(json.dumps(dict(path=path, fname=row['fname'], asm=row['asm'])), flush=True)
+    return 0
+
+
+def _evaluator(args):
+    from .evaluator import Config, get_evaluator
+    config = Config(hf_model_path=args.model, pairs=[args.pair], beam=args.beam, nbest=args.nbest, dtype=args.dtype,
+                    quantize=args.quantize, num_threads=args.num_threads)
+    return get_evaluator(config)
+
+
+def _write_hypotheses(out_dir, name, hyps):
+    ll_file = os.path.join(out_dir, name + '.ll')
+    with open(ll_file, 'w') as f:
+        f.write(hyps[0] if hyps else '')
+    print(ll_file, flush=True)
+
+
+def lift_command(args):
+    evaluator = _evaluator(args)
+    samples = [load_sample(path, args.fname) for path in args.files]
+    rows = list(_inference_dataset(args, samples, pairs=[args.pair]))
+    predictions = evaluator.predict_bucketed([(row, args.pair) for row in rows])
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+    for path, hyps in zip(args.files, predictions):
+        if args.out_dir:
+            _write_hypotheses(args.out_dir, os.path.splitext(os.path.basename(path))[0], hyps)
+        else:
+            print(json.dumps(dict(path=path, hypotheses=hyps)), flush=True)
+    return 0
+
+
+def ingest_command(args):
+    # without a model, only prints the rows
+    from .ingest import iter_rows, lift_binaries
+    kwargs = dict(fnames=set(args.functions) if args.functions else None, objdump=args.objdump, n_workers=args.jobs)
+    if not args.model:
+        for row in iter_rows(args.files, args.pair, **kwargs):
+            print(json.dumps(row), flush=True)
+        return 0
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+    for row, hyps in lift_binaries(_evaluator(args), args.files, args.pair, batch_size=args.batch_size, **kwargs):
+        if args.out_dir:
+            _write_hypotheses(args.out_dir, f"{os.path.basename(row['path'])}_{row['fname']}", hyps)
+        else:
+            print(json.dumps(dict(path=row['path'], fname=row['fname'], hypotheses=hyps)), flush=True)
+    return 0
+
+
+def _add_compile_args(parser):
+    parser.add_argument('files', nargs='+', help='C files, #include lines are taken as the deps')
+    parser.add_argument('--fname', default='func0', help='Name of the function to compile/lift in every file')
+    parser.add_argument('--asm-cache', default=None, help='Directory of a persistent cache of compiled assembly')
+    parser.add_argument('--pch-dir', default=None, help='Directory of precompiled headers for the #include lines')
+    parser.add_argument('--jobs', type=int, default=None, help='Parallel compiler invocations per sample')
+
+
+def _add_model_args(parser, required=True):
+    parser.add_argument('--model', required=required, help='HF model path')
+    parser.add_argument('--pair', required=True, help='Lifting pair, e.g. clang_opt3_ir_optz-ir_optz')
+    parser.add_argument('--beam', type=int, default=5)
+    parser.add_argument('--nbest', type=int, default=1)
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'bfloat16'])
+    parser.add_argument('--quantize', default=None, choices=['dynamic_int8'])
+    parser.add_argument('--num-threads', type=int, default=None)
+    parser.add_argument('--out-dir', default=None,
+                        help='Write the top hypothesis of each function to <out-dir>/<name>.ll instead of printing '
+                             'JSON lines')
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in FORWARDED:
+        import importlib
+        return importlib.import_module(FORWARDED[argv[0]]).main(argv[1:])
+
+    parser = argparse.ArgumentParser(prog='forklift', description='Forklift: compile, lift and verify C functions')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('compile', help='Compile C files and print the asm of each target as JSON lines')
+    _add_compile_args(p)
+    p.add_argument('--targets', nargs='+', default=None, help='Compiler keys, e.g. clang_x86_O3 clang_ir_Oz')
+    p.add_argument('--pairs', nargs='+', default=None, help='Compile the targets these lifting pairs read')
+    p.set_defaults(func=compile_command)
+
+    p = commands.add_parser('lift', help='Compile and lift C files with a model')
+    _add_compile_args(p)
+    _add_model_args(p)
+    p.set_defaults(func=lift_command)
+
+    p = commands.add_parser('ingest', help='Disassemble the functions of ELF files (.o, .so, executables) and lift '
+                                           'them with a model, or print them as rows without --model')
+    p.add_argument('files', nargs='+', help='ELF files')
+    p.add_argument('--functions', nargs='+', default=None, help='Only these functions (default: all in .text)')
+    p.add_argument('--objdump', default=None,
+                   help='Disassembler (default: llvm-objdump, or the GNU objdump of the arch)')
+    p.add_argument('--jobs', type=int, default=None, help='Parallel disassembler invocations')
+    p.add_argument('--batch-size', type=int, default=8)
+    _add_model_args(p, required=False)
+    p.set_defaults(func=ingest_command)
+
+    for command, module in FORWARDED.items():
+        commands.add_parser(command, help=f'Same as python -m {module} (see forklift {command} --help)')
+
+    args = parser.parse_args(argv)
+    return args.func(args)
@@ -1,17 +1,30 @@
+import contextlib
 from dataclasses import asdict, dataclass
 from typing import List
 import os
 import json
 from tokenizers import Tokenizer
 from transformers import BartForConditionalGeneration
+from transformers.modeling_outputs import BaseModelOutput
 import torch
 import math
+import threading
+from collections import deque
 from .asm import AsmAdder, FuncDataclass
 from torch.nn.utils.rnn import pad_sequence
-from forklift.par_data import DP
+from forklift.par_data import DP, TokenizationCache, get_asm_index
 from typing import Optional
 InferenceDataProcessor = DP
 
+# status of each row in predict_batch(..., return_status=True)
+FITS = 'ok'
+TOO_LONG_ESTIMATE = 'too_long_estimate'  # rejected by the character-length pre-filter, never tokenized
+TOO_LONG = 'too_long'  # tokenized, longer than max_position_embeddings
+
+OVERFLOW_POLICIES = ('empty', 'skip', 'queue')
+DTYPES = ('float32', 'bfloat16')
+QUANTIZATIONS = (None, 'dynamic_int8')
+
 
 @dataclass
 class Config:
@@ -23,81 +36,335 @@ class Config:
     length_penalty: float = 1.0
     min_length: int = 1
     max_new_tokens: int = 2048
+    max_batch_tokens: int = 8192  # padded source tokens per generate call in predict_bucketed
+    max_batch_size: Optional[int] = None
+    check_target_length: bool = True  # also tokenize the target, to skip rows whose reference doesn't fit in the model
+    tokenize_cache_size: int = 1024  # tokenized prompts kept in memory (LRU), 0 to disable
+    # rows whose prompt has more than max_position_embeddings * max_chars_per_token characters are rejected before
+    # tokenization. None: the longest token of the vocabulary, so that no row that would fit is ever rejected; that
+    # bound is loose (the longest token is much longer than an average one), so it only skips the tokenization of
+    # rows far over the limit, the others are tokenized and rejected by their token count. A chars-per-token ratio
+    # measured on the data skips more of them, but may reject rows of short-token text that fit
+    max_chars_per_token: Optional[float] = None
+    # what too long rows predict: 'empty' ([''], as before), 'skip' (None) or 'queue' (None, and (row, pair, status)
+    # is appended to Evaluator.long_inputs to be handled separately)
+    overflow_policy: str = 'empty'
+    # CPU generation: weights dtype, dynamic int8 quantization of the linear layers (float32 only), torch.compile of
+    # the decoder, torch.set_num_threads (process-wide, None: torch's default) and torch.inference_mode
+    dtype: str = 'float32'
+    quantize: Optional[str] = None
+    compile_decoder: bool = False
+    num_threads: Optional[int] = None
+    inference_mode: bool = True
+    # speculative greedy decoding (beam = nbest = 1, same output as plain greedy): tokens are drafted by a small
+    # lifter sharing the tokenizer, or by n-gram lookup in the sequence generated so far, and verified by the model
+    assistant_model_path: Optional[str] = None
+    prompt_lookup_num_tokens: Optional[int] = None
     is_exebench_backend = True
     asm_key = 'real'
 
+    def __post_init__(self):
+        if self.overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f'overflow_policy = {self.overflow_policy}')
+        if self.dtype not in DTYPES:
+            raise ValueError(f'dtype = {self.dtype}')
+        if self.quantize not in QUANTIZATIONS:
+            raise ValueError(f'quantize = {self.quantize}')
+        if self.quantize and self.dtype != 'float32':
+            raise ValueError(f'quantize = {self.quantize} requires dtype = float32')
+        if self.assistant_model_path and self.prompt_lookup_num_tokens:
+            raise ValueError('assistant_model_path and prompt_lookup_num_tokens are exclusive')
+        if (self.assistant_model_path or self.prompt_lookup_num_tokens) and (self.beam != 1 or self.nbest != 1):
+            raise ValueError(f'speculative decoding requires beam = nbest = 1, got {self.beam}, {self.nbest}')
+
+    def model_options(self):
+        # what changes the loaded weights, part of the model registry key
+        return dict(dtype=self.dtype, quantize=self.quantize, compile_decoder=self.compile_decoder)
+
     def to_dict(self):
         return asdict(self)
 
 
+@dataclass
+class Encoded:
+    # Evaluator.encode() result: encoder states of the rows that fit, reusable by any number of decode() calls
+    rows_pairs: list
+    status: List[str]
+    fitting: List[int]  # indices in rows_pairs of the encoded rows
+    overflow: list  # prediction of each row that doesn't fit (None for the others), per config.overflow_policy
+    attention_mask: Optional[torch.Tensor] = None
+    encoder_hidden_states: Optional[torch.Tensor] = None
+
+    def select(self, idxs):
+        # the rows idxs of rows_pairs (e.g. those still without a passing hypothesis), without re-encoding
+        position = {row_idx: i for i, row_idx in enumerate(self.fitting)}
+        selected = Encoded(rows_pairs=[self.rows_pairs[idx] for idx in idxs], status=[self.status[idx] for idx in idxs],
+                           fitting=[i for i, idx in enumerate(idxs) if idx in position],
+                           overflow=[self.overflow[idx] for idx in idxs])
+        keep = [position[idx] for idx in idxs if idx in position]
+        if keep:
+            selected.attention_mask = self.attention_mask[keep]
+            selected.encoder_hidden_states = self.encoder_hidden_states[keep]
+        return selected
+
+
+def load_tokenizer(hf_model_path):
+    try:
+        tok = Tokenizer.from_file(os.path.join(hf_model_path, 'tokenizer.json'))
+    except:
+        from huggingface_hub import HfFileSystem
+        fs = HfFileSystem()
+        tok = Tokenizer.from_str(fs.open(os.path.join(hf_model_path, 'tokenizer.json'), 'r').read())
+    return tok
+
+
+_REGISTRY = {}
+_REGISTRY_LOCK = threading.Lock()
+_TOKENIZATION_CACHES = {}
+
+
+def load_model(hf_model_path, dtype='float32', quantize=None, compile_decoder=False):
+    model = BartForConditionalGeneration.from_pretrained(hf_model_path)
+    if dtype != 'float32':
+        model = model.to(getattr(torch, dtype))
+    if quantize == 'dynamic_int8':
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model = model.eval()
+    if compile_decoder:
+        # generate() calls the decoder with a growing sequence length, dynamic shapes avoid a recompilation per step
+        model.model.decoder = torch.compile(model.model.decoder, dynamic=True)
+    return model
+
+
+def get_model_and_tokenizer(hf_model_path, **model_options):
+    # process-level registry, so that the weights are loaded once no matter how many Evaluators are built
+    key = (hf_model_path, tuple(sorted(model_options.items())))
+    with _REGISTRY_LOCK:
+        if key not in _REGISTRY:
+            tok = load_tokenizer(hf_model_path)
+            model = load_model(hf_model_path, **model_options)
+            _REGISTRY[key] = (model, tok)
+        return _REGISTRY[key]
+
+
+def get_tokenization_cache(config: Config):
+    # shared by the evaluators of the same model, so that repeated runs in a process reuse tokenized prompts
+    if not config.tokenize_cache_size:
+        return None
+    with _REGISTRY_LOCK:
+        key = (config.hf_model_path, config.tokenize_cache_size)
+        if key not in _TOKENIZATION_CACHES:
+            _TOKENIZATION_CACHES[key] = TokenizationCache(config.tokenize_cache_size)
+        return _TOKENIZATION_CACHES[key]
+
+
+def get_evaluator(config: Config):
+    model, tok = get_model_and_tokenizer(config.hf_model_path, **config.model_options())
+    assistant_model = None
+    if config.assistant_model_path:
+        assistant_model, _ = get_model_and_tokenizer(config.assistant_model_path, **config.model_options())
+    return Evaluator(config, model=model, tokenizer=tok, tokenization_cache=get_tokenization_cache(config),
+                     assistant_model=assistant_model)
+
+
 class Evaluator:
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, model=None, tokenizer=None, tokenization_cache=None, assistant_model=None):
         self.config = config
-        try:
-            tok = Tokenizer.from_file(os.path.join(self.config.hf_model_path, 'tokenizer.json'))
-        except:
-            from huggingface_hub import HfFileSystem
-            fs = HfFileSystem()
-            tok = Tokenizer.from_str(fs.open(os.path.join(self.config.hf_model_path, 'tokenizer.json'), 'r').read())
-
-        self.model = BartForConditionalGeneration.from_pretrained(self.config.hf_model_path).eval()
+        tok = tokenizer if tokenizer is not None else load_tokenizer(self.config.hf_model_path)
+        if model is None:
+            model = load_model(self.config.hf_model_path, **self.config.model_options())
+        self.model = model
+        if assistant_model is None and self.config.assistant_model_path:
+            assistant_model = load_model(self.config.assistant_model_path, **self.config.model_options())
+        self.assistant_model = assistant_model
+        if self.config.num_threads:
+            torch.set_num_threads(self.config.num_threads)
         self._is_exebench_backend = self.config.is_exebench_backend
         self.asm_key = self.config.asm_key
         self.required_asms = self.get_required_asms()
-        self.data_processor = InferenceDataProcessor(tokenizer=tok)
+        if tokenization_cache is None and self.config.tokenize_cache_size:
+            tokenization_cache = TokenizationCache(self.config.tokenize_cache_size)
+        self.data_processor = InferenceDataProcessor(tokenizer=tok, cache=tokenization_cache)
+        self.long_inputs = deque()
+        self._max_chars = None
+
+    @property
+    def max_chars(self):
+        # length pre-filter threshold: a prompt of n characters has at least n / (longest token) tokens
+        if self._max_chars is None:
+            chars_per_token = self.config.max_chars_per_token or \
+                max(map(len, self.data_processor.tokenizer.get_vocab()))
+            self._max_chars = int(self.model.config.max_position_embeddings * chars_per_token)
+        return self._max_chars
 
     def get_required_asms(self):
-        required_asms = set()
-        dp = DP()
-        for pair in self.config.pairs:
-            source_k, target_k, _, _ = dp.get_par_data(row=None, pair=pair, asm_key='angha', fPIC=False)
-            source_k = source_k.replace('angha_', '')
-            target_k = target_k.replace('angha_', '')
-            required_asms.add(source_k)
-            required_asms.add(target_k)
-
-        # always add O0 reference
-        new_asm_to_add = set()
-        for k in required_asms:
-            if '_O0' not in k:
-                new_asm_to_add.add(k.replace('_O3', '_O0').replace('_Os', '_O0').replace('_Oz', '_O0'))
-        required_asms = required_asms.union(new_asm_to_add)
-        return list(required_asms)
-
-    def predict_batch(self, rows_pairs):
-        tokenized = []
-        max_len = []
+        return DP.get_required_asms(self.config.pairs)
+
+    def _tokenize(self, rows_pairs, return_status=False):
+        # None marks rows that don't fit in the model. Rows are encoded in one encode_batch call per pair, except
+        # those the length pre-filter rejects
+        max_len = self.model.config.max_position_embeddings
+        by_pair = {}
         for idx, (r, p) in enumerate(rows_pairs):
-            tok, len_t = self.data_processor.prepare(r, p, asm_key=self.asm_key, return_target_length=True)
-            if len(tok) > self.model.config.max_position_embeddings or len_t > self.model.config.max_position_embeddings:
-                max_len.append(True)
+            by_pair.setdefault(p, []).append(idx)
+        tokenized = [None] * len(rows_pairs)
+        status = [TOO_LONG_ESTIMATE] * len(rows_pairs)
+        for p, idxs in by_pair.items():
+            rows = [rows_pairs[idx][0] for idx in idxs]
+            if self.config.check_target_length:
+                prepared = self.data_processor.prepare_batch(rows, p, asm_key=self.asm_key, return_target_length=True,
+                                                             max_chars=self.max_chars)
             else:
-                tokenized.append(torch.tensor(tok))
-                max_len.append(False)
+                prepared = [tok if tok is None else (tok, 0) for tok in
+                            self.data_processor.prepare_batch(rows, p, asm_key=self.asm_key, max_chars=self.max_chars)]
+            for idx, prep in zip(idxs, prepared):
+                if prep is None:
+                    continue
+                tok, len_t = prep
+                if len(tok) <= max_len and len_t <= max_len:
+                    tokenized[idx], status[idx] = tok, FITS
+                else:
+                    status[idx] = TOO_LONG
+        if return_status:
+            return tokenized, status
+        return tokenized
+
+    def _overflow(self, row, pair, status):
+        # prediction of a row that doesn't fit in the model, according to config.overflow_policy
+        if self.config.overflow_policy == 'empty':
+            return ['']
+        if self.config.overflow_policy == 'queue':
+            self.long_inputs.append((row, pair, status))
+        return None
+
+    def _inference_context(self):
+        return torch.inference_mode() if self.config.inference_mode else contextlib.nullcontext()
+
+    def _pad(self, tokenized):
+        return pad_sequence([torch.tensor(tok) for tok in tokenized], True,
+                            self.data_processor.tokenizer.get_vocab()['<pad>'])
+
+    def _generate_kwargs(self, **overrides):
+        # model.generate() arguments from the config, overridden by e.g. num_beams=1, do_sample=True, top_p=0.95
+        kwargs = dict(max_new_tokens=self.config.max_new_tokens, num_beams=self.config.beam,
+                      num_return_sequences=self.config.nbest, early_stopping=self.config.early_stopping,
+                      length_penalty=self.config.length_penalty, min_length=self.config.min_length)
+        kwargs.update(overrides)
+        return kwargs
+
+    def _detokenize_output(self, output, n, nbest):
+        output = output.view(n * nbest, -1).cpu()
+        detokenized = self.data_processor.detokenize_batch(output.tolist())
+        return [detokenized[idx * nbest:(idx + 1) * nbest] for idx in range(n)]
 
-        batch = pad_sequence(tokenized, True, self.data_processor.tokenizer.get_vocab()['<pad>'])
+    def _speculative_kwargs(self):
+        if self.assistant_model is not None:
+            return dict(assistant_model=self.assistant_model)
+        if self.config.prompt_lookup_num_tokens:
+            return dict(prompt_lookup_num_tokens=self.config.prompt_lookup_num_tokens)
+        return {}
 
-        output = self.model.generate(batch, max_new_tokens=self.config.max_new_tokens, num_beams=self.config.beam,
-                                     num_return_sequences=self.config.nbest, early_stopping=self.config.early_stopping,
-                                     length_penalty=self.config.length_penalty, min_length=self.config.min_length,
-                                     )
+    def _generate(self, tokenized):
+        speculative = self._speculative_kwargs()
+        kwargs = self._generate_kwargs(**speculative)
+        # assisted generation only supports batches of one sample
+        batches = [[tok] for tok in tokenized] if speculative else [tokenized]
         res = []
-        output = output.view(len(tokenized), self.config.nbest, -1).cpu()
-        skip = 0
-        for idx in range(len(rows_pairs)):
-            if max_len[idx]:
-                res.append([''])
-                skip += 1
-                continue
-            idx_output = idx - skip
-            hyps = []
-            for out in output[idx_output]:
-                detokenized = self.data_processor.detokenize(out.tolist())
-                hyps.append(detokenized)
-            res.append(hyps)
+        for batch in batches:
+            with self._inference_context():
+                output = self.model.generate(self._pad(batch), **kwargs)
+            res.extend(self._detokenize_output(output, len(batch), kwargs['num_return_sequences']))
+        return res
+
+    def encode(self, rows_pairs) -> Encoded:
+        """
+        Tokenizes and runs the encoder once on a batch of (row, pair). The result can be decoded many times with
+        decode(), e.g. greedy then beam search then sampling retries, without re-running the encoder.
+        """
+        rows_pairs = list(rows_pairs)
+        tokenized, status = self._tokenize(rows_pairs, return_status=True)
+        fitting = [idx for idx, tok in enumerate(tokenized) if tok is not None]
+        overflow = [None if tok is not None else self._overflow(r, p, s)
+                    for (r, p), tok, s in zip(rows_pairs, tokenized, status)]
+        encoded = Encoded(rows_pairs=rows_pairs, status=status, fitting=fitting, overflow=overflow)
+        if fitting:
+            batch = self._pad([tokenized[idx] for idx in fitting])
+            encoded.attention_mask = batch.ne(self.data_processor.tokenizer.get_vocab()['<pad>']).long()
+            with self._inference_context():
+                encoded.encoder_hidden_states = self.model.get_encoder()(
+                    input_ids=batch, attention_mask=encoded.attention_mask).last_hidden_state
+        return encoded
+
+    def decode(self, encoded: Encoded, **overrides):
+        # predictions for every row of encoded, like predict_batch. overrides are model.generate() arguments
+        res = list(encoded.overflow)
+        if not encoded.fitting:
+            return res
+        kwargs = self._generate_kwargs(**overrides)
+        with self._inference_context():
+            # generate() expands the encoder outputs in place for beam search, so each call gets its own wrapper
+            output = self.model.generate(attention_mask=encoded.attention_mask,
+                                         encoder_outputs=BaseModelOutput(
+                                             last_hidden_state=encoded.encoder_hidden_states),
+                                         **kwargs)
+        for idx, hyps in zip(encoded.fitting,
+                             self._detokenize_output(output, len(encoded.fitting), kwargs['num_return_sequences'])):
+            res[idx] = hyps
+        return res
+
+    def predict_batch(self, rows_pairs, return_status=False):
+        # with return_status, also returns the status of each row (FITS, TOO_LONG_ESTIMATE or TOO_LONG)
+        tokenized, status = self._tokenize(rows_pairs, return_status=True)
+        fitting = [tok for tok in tokenized if tok is not None]
+        hyps = iter(self._generate(fitting) if fitting else [])
+        res = [self._overflow(r, p, s) if tok is None else next(hyps)
+               for (r, p), tok, s in zip(rows_pairs, tokenized, status)]
+        if return_status:
+            return res, status
+        return res
+
+    @staticmethod
+    def make_length_buckets(lengths, max_batch_tokens, max_batch_size=None):
+        # Sorts by length and greedily fills batches while padded size (longest * count) stays under max_batch_tokens.
+        # A single sample longer than the budget gets its own batch.
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        batches = []
+        current = []
+        for i in order:
+            n = len(current) + 1
+            if current and (lengths[i] * n > max_batch_tokens or (max_batch_size and n > max_batch_size)):
+                batches.append(current)
+                current = []
+            current.append(i)
+        if current:
+            batches.append(current)
+        return batches
+
+    def predict_bucketed(self, rows_pairs, max_batch_tokens=None, max_batch_size=None, return_status=False):
+        """
+        Like predict_batch, but for an arbitrarily large list of (row, pair): samples are bucketed by source length
+        and batched under a padded token budget, so short functions don't run at the length of the longest one.
+        Results are returned in the original order.
+        """
+        max_batch_tokens = max_batch_tokens or self.config.max_batch_tokens
+        max_batch_size = max_batch_size or self.config.max_batch_size
+        rows_pairs = list(rows_pairs)
+        tokenized, status = self._tokenize(rows_pairs, return_status=True)
+        fitting = [idx for idx, tok in enumerate(tokenized) if tok is not None]
+        res = [None if tok is not None else self._overflow(r, p, s)
+               for (r, p), tok, s in zip(rows_pairs, tokenized, status)]
+        buckets = self.make_length_buckets([len(tokenized[idx]) for idx in fitting], max_batch_tokens, max_batch_size)
+        for bucket in buckets:
+            batch_idx = [fitting[i] for i in bucket]
+            for idx, hyps in zip(batch_idx, self._generate([tokenized[idx] for idx in batch_idx])):
+                res[idx] = hyps
+        if return_status:
+            return res, status
         return res
 
     @staticmethod
     def get_asm(key, row):
-        asm_idx = row['asm']['target'].index(key)
-        return row['asm']['code'][asm_idx]
+        index = get_asm_index(row)
+        if key not in index:
+            raise ValueError(f'{key!r} is not in list')
+        return index[key]
@@ -0,0 +1,266 @@
+import os
+import re
+import shutil
+import struct
+import subprocess
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List
+
+# Lifting rows from existing binaries (.o, .so, executables) instead of C sources: every function of a file is
+# disassembled by a single objdump call (symbol table, relocations and code at once) and rewritten as gas-like
+# assembly, with labels for the branch targets and symbols instead of addresses. The rows have the HF asm format that
+# DP.get_par_data reads, with the disassembly as the source of the lifting pair and an empty target.
+# Data isn't disassembled, so unlike compiled rows the constants a function uses are referenced but not inlined.
+
+# ELF e_machine -> arch, as in the asm keys (angha_clang_x86_O3, angha_gcc_arm32_O0, ...)
+ELF_MACHINES = {62: 'x86', 183: 'arm', 40: 'arm32', 243: 'riscv'}
+# disassemblers tried when none is given: llvm-objdump handles every arch, GNU objdump only its own
+OBJDUMP_TOOLS = {
+    'x86': ['llvm-objdump', 'objdump'],
+    'arm': ['llvm-objdump', 'aarch64-linux-gnu-objdump'],
+    'arm32': ['llvm-objdump', 'arm-linux-gnueabi-objdump'],
+    'riscv': ['llvm-objdump', 'riscv64-linux-gnu-objdump'],
+}
+COMMENT_SYMS = {'x86': '#', 'arm': '//', 'arm32': '@', 'riscv': '#'}
+# relocations of immediates, printed as gcc does (the immediate they patch is replaced by the operand)
+RELOCATION_OPERANDS = {
+    'R_AARCH64_ADD_ABS_LO12_NC': ':lo12:{}',
+    'R_AARCH64_LDST8_ABS_LO12_NC': ':lo12:{}',
+    'R_AARCH64_LDST16_ABS_LO12_NC': ':lo12:{}',
+    'R_AARCH64_LDST32_ABS_LO12_NC': ':lo12:{}',
+    'R_AARCH64_LDST64_ABS_LO12_NC': ':lo12:{}',
+    'R_AARCH64_LDST128_ABS_LO12_NC': ':lo12:{}',
+    'R_ARM_MOVW_ABS_NC': '#:lower16:{}',
+    'R_ARM_MOVT_ABS': '#:upper16:{}',
+    'R_RISCV_HI20': '%hi({})',
+    'R_RISCV_LO12_I': '%lo({})',
+    'R_RISCV_LO12_S': '%lo({})',
+}
+_RISCV_CALL_RELOCATIONS = ('R_RISCV_CALL', 'R_RISCV_CALL_PLT')  # auipc + jalr, printed as call/tail
+
+_SYMBOL_PATTERN = re.compile(r'[0-9a-f]+ (.{7}) (\S+)\s+[0-9a-f]+\s+(?:\S+ )?(\S+)$')
+_SECTION_PATTERN = re.compile(r'Disassembly of section (\S+):$')
+_FUNCTION_PATTERN = re.compile(r'([0-9a-f]+) <(.+)>:$')
+_RELOCATION_PATTERN = re.compile(r'\s+([0-9a-f]+):\s+(R_\w+)\s+(\S+?)([+-]0x[0-9a-f]+)?$')
+_INSTRUCTION_PATTERN = re.compile(r'\s*([0-9a-f]+):\s*\t(.*)$')
+_TARGET_PATTERN = re.compile(r'(?:0x)?([0-9a-f]+) <([^>]+)>')
+# objdump annotation: symbol, version or @plt suffix, offset
+_ANNOTATION_PATTERN = re.compile(r'([^@+-]+)(?:@[^+-]*)?([+-]0x[0-9a-f]+)?$')
+_RIP_PATTERN = re.compile(r'-?(?:0x[0-9a-f]+|\d+)?\(%rip\)')
+_IMMEDIATE_PATTERN = re.compile(r'#?-?\b(?:0x[0-9a-f]+|\d+)\b')
+# GNU objdump's long nops (data16 cs nopw ...), which gas rejects: the data16 prefixes are dropped
+_DATA16_NOP_PATTERN = re.compile(r'(?:data16\s+)+(?=(?:cs\s+)?nop)')
+
+
+def elf_arch(path):
+    with open(path, 'rb') as f:
+        header = f.read(20)
+    if len(header) < 20 or header[:4] != b'\x7fELF':
+        raise ValueError(f'{path} is not an ELF file')
+    machine, = struct.unpack('<H' if header[5] == 1 else '>H', header[18:20])
+    if machine not in ELF_MACHINES:
+        raise ValueError(f'{path}: unsupported ELF machine {machine}')
+    return ELF_MACHINES[machine]
+
+
+def find_objdump(arch):
+    for tool in OBJDUMP_TOOLS[arch]:
+        path = shutil.which(tool)
+        if path is not None:
+            return path
+    raise FileNotFoundError(f'no disassembler for {arch}, install one of {", ".join(OBJDUMP_TOOLS[arch])}')
+
+
+def _symbol_operand(annotation, symbols):
+    # the operand for objdump's <symbol+offset> annotation, None unless it names a function or object: objdump also
+    # picks file (t.c+0x2010) and section (.plt.got) symbols, which aren't valid operands
+    m = _ANNOTATION_PATTERN.match(annotation)
+    if m is None or m.group(1) not in symbols:
+        return None
+    return m.group(1) + (m.group(2) or '')
+
+
+def _function_asm(fname, arch, insns, relocs, symbols=None):
+    # insns: [(address, instruction)], relocs: {offset: (type, symbol, addend)} of the function, symbols: name ->
+    # section of the functions and objects of the file
+    symbols = symbols or {}
+    comment_sym = COMMENT_SYMS[arch]
+    addrs = [addr for addr, _ in insns]
+    start = addrs[0]
+    bounds = dict(zip(addrs, addrs[1:] + [None]))
+    reloc_of = {}
+    for offset, reloc in relocs.items():
+        idx = bisect_right(addrs, offset) - 1
+        if idx >= 0:
+            reloc_of.setdefault(addrs[idx], (offset, reloc))
+
+    code = {}  # address -> instruction, or (before, target address, after) for branches to a label
+    targets = set()
+    skip = set()
+    for addr, insn in insns:
+        text, _, comment = insn.partition(comment_sym)
+        text = re.sub(r'\s+', '\t', _DATA16_NOP_PATTERN.sub('', text.strip()), count=1)
+        offset, (reloc, symbol, addend) = reloc_of.get(addr, (None, (None, None, 0)))
+        if reloc in _RISCV_CALL_RELOCATIONS and bounds[addr] is not None:
+            code[addr] = ('call\t' if text.partition('\t')[2].startswith('ra,') else 'tail\t') + symbol
+            skip.add(bounds[addr])
+            continue
+        if reloc in RELOCATION_OPERANDS:
+            if text.startswith('mv\t'):  # llvm-objdump prints addi rd, rs, 0 as mv rd, rs
+                text = 'addi\t' + text[3:] + ', 0'
+            immediates = list(_IMMEDIATE_PATTERN.finditer(text))
+            if immediates:
+                m = immediates[-1]
+                operand = RELOCATION_OPERANDS[reloc].format(symbol + (f'+{addend}' if addend else ''))
+                code[addr] = text[:m.start()] + operand + text[m.end():]
+                continue
+        m = _TARGET_PATTERN.search(text)
+        if m is not None:
+            target = int(m.group(1), 16)
+            if symbol is None and target in bounds and target != start:
+                targets.add(target)
+                code[addr] = (text[:m.start()], target, text[m.end():])
+                continue
+            if symbol is not None:
+                operand = symbol
+            elif target == start:
+                operand = fname
+            else:
+                operand = _symbol_operand(m.group(2), symbols) or f'0x{target:x}'
+            text = text[:m.start()] + operand + text[m.end():]
+        elif arch == 'x86' and '(%rip)' in text:
+            if symbol is not None:
+                # the PC-relative addend is counted from the end of the instruction
+                disp = addend + (bounds[addr] - offset if bounds[addr] is not None else 0)
+                target = symbol + (f'+{disp}' if disp > 0 else f'{disp}' if disp < 0 else '')
+            else:
+                # otherwise the numeric displacement is kept
+                m = _TARGET_PATTERN.search(comment)
+                target = _symbol_operand(m.group(2), symbols) if m is not None else None
+                if symbols.get(target) == '*UND*':
+                    target += '@GOTPCREL'  # objdump names the GOT entries of imported symbols after them
+            if target is not None:
+                text = _RIP_PATTERN.sub(lambda _: f'{target}(%rip)', text, count=1)
+        code[addr] = text
+
+    labels = {target: f'.L{n}' for n, target in enumerate(sorted(targets), start=2)}
+    if arch in ('arm', 'arm32'):
+        lines = [f'.global {fname}', f'.type {fname}, %function', f'{fname}:']
+    else:
+        lines = [f'.globl {fname}', f'.type {fname}, @function', f'{fname}:']
+    for addr, _ in insns:
+        if addr in skip:
+            continue
+        if addr in labels:
+            lines.append(labels[addr] + ':')
+        text = code[addr]
+        if isinstance(text, tuple):
+            text = text[0] + labels[text[1]] + text[2]
+        lines.append('\t' + text)
+    return '\n'.join(lines) + '\n'
+
+
+def parse_objdump(text, arch, fnames=None) -> Dict[str, str]:
+    """
+    fname -> gas-like assembly of every function in the .text sections of an `objdump -d -r -t` output (fnames
+    restricts the functions). Without a symbol table (stripped files), every symbol of the .text sections is taken.
+    """
+    functions = set()
+    symbols = {}  # name (without symbol version) -> section of the functions and objects
+    section = None
+    disassembly = {}  # fname -> ([(address, instruction)], {offset: (type, symbol, addend)})
+    current = None
+    for line in text.splitlines():
+        m = _RELOCATION_PATTERN.match(line)
+        if m is not None:
+            if current is not None:
+                addend = int(m.group(4).replace('0x', ''), 16) if m.group(4) else 0
+                current[1].setdefault(int(m.group(1), 16), (m.group(2), m.group(3), addend))
+            continue
+        m = _INSTRUCTION_PATTERN.match(line)
+        if m is not None:
+            if current is not None:
+                current[0].append((int(m.group(1), 16), m.group(2)))
+            continue
+        m = _FUNCTION_PATTERN.match(line)
+        if m is not None:
+            name, current = m.group(2), None
+            if section is not None and section.startswith('.text') and (fnames is None or name in fnames) \
+                    and name not in disassembly:
+                current = disassembly[name] = ([], {})
+            continue
+        m = _SECTION_PATTERN.match(line)
+        if m is not None:
+            section, current = m.group(1), None
+            continue
+        m = _SYMBOL_PATTERN.match(line)
+        if m is not None and ('F' in m.group(1) or 'O' in m.group(1)):
+            symbols[m.group(3).partition('@')[0]] = m.group(2)
+            if 'F' in m.group(1) and m.group(2).startswith('.text'):
+                functions.add(m.group(3))
+    kept = [fname for fname, (insns, _) in disassembly.items() if insns and (not functions or fname in functions)]
+    symbols.update((fname, '.text') for fname in kept if fname not in symbols)
+    return {fname: _function_asm(fname, arch, *disassembly[fname], symbols=symbols) for fname in kept}
+
+
+def disassemble(path, fnames=None, objdump=None) -> Dict[str, str]:
+    # every function of a binary, with a single disassembler call
+    arch = elf_arch(path)
+    cmd = [objdump or find_objdump(arch), '-d', '-r', '-t', '--no-show-raw-insn', path]
+    out = subprocess.run(cmd, capture_output=True, text=True)
+    if out.returncode != 0:
+        raise RuntimeError(f'{" ".join(cmd)} failed: {out.stderr}')
+    return parse_objdump(out.stdout, arch, fnames=fnames)
+
+
+def pair_asm_keys(pair, asm_key='angha'):
+    # asm keys of the source and target of a lifting pair, e.g. angha_clang_x86_O3 and angha_clang_ir_Oz
+    from .par_data import DP, resolve_pair
+    if resolve_pair(pair).spec.source == 'c':
+        raise ValueError(f'pair {pair} lifts from C, not from assembly')
+    source_key, target_key, _, _ = DP().get_par_data(row=None, pair=pair, asm_key=asm_key)
+    return source_key, target_key
+
+
+def binary_rows(path, pair, fnames=None, objdump=None, asm_key='angha') -> List[Dict]:
+    # lifting rows of the functions of a binary, in address order
+    source_key, target_key = pair_asm_keys(pair, asm_key)
+    arch = elf_arch(path)
+    if source_key.split('_')[-2] != arch:
+        raise ValueError(f'{path} is {arch}, pair {pair} lifts {source_key}')
+    funcs = disassemble(path, fnames=fnames, objdump=objdump)
+    return [dict(path=path, fname=fname, func_def='', asm=dict(target=[source_key, target_key], code=[code, '']))
+            for fname, code in funcs.items()]
+
+
+def iter_rows(paths: Iterable[str], pair, fnames=None, objdump=None, n_workers=None, asm_key='angha'):
+    """
+    Rows of the functions of every binary in paths, in order. Files are disassembled by up to n_workers concurrent
+    objdump calls, ahead of the consumer but at most 2 * n_workers files at a time.
+    """
+    n_workers = n_workers or os.cpu_count()
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        for path in paths:
+            pending.append(pool.submit(binary_rows, path, pair, fnames, objdump, asm_key))
+            if len(pending) >= 2 * n_workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def lift_binaries(evaluator, paths: Iterable[str], pair, batch_size=8, fnames=None, objdump=None,
+                  n_workers=None) -> Iterable:
+    # yields (row, hypotheses) for every function of paths, generating batch_size rows at a time while the next
+    # files are disassembled
+    batch = []
+    for row in iter_rows(paths, pair, fnames=fnames, objdump=objdump, n_workers=n_workers,
+                         asm_key=evaluator.asm_key):
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield from zip(batch, evaluator.predict_batch([(r, pair) for r in batch]))
+            batch = []
+    if batch:
+        yield from zip(batch, evaluator.predict_batch([(r, pair) for r in batch]))
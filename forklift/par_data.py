@@ -1,67 +1,249 @@
+import hashlib
 import re
-from tokenizers import Tokenizer
-import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Optional
+
 from .utils import normalize_structs
 
+
+@dataclass(frozen=True)
+class PairSpec:
+    source: str  # 'c' for the C function, otherwise a DP.get_asm_key key
+    target: str
+    # which compiler of the pair ('source' or 'target') each side is taken from; None uses get_asm's defaults
+    # (gcc, no fPIC)
+    source_compiler: Optional[str] = 'source'
+    target_compiler: Optional[str] = 'target'
+    normalize: bool = False  # normalize IR structs of the target
+    target_first: bool = True  # which side is fetched (and fails) first when both are missing
+
+
+@dataclass(frozen=True)
+class ResolvedPair:
+    pair: str  # pair without the clang_ prefixes, as used for tokenization
+    spec: PairSpec
+    source_compiler: str
+    target_compiler: str
+    source_goes_left: bool
+
+
+def _ir(source, target, **kwargs):
+    return PairSpec(source, target, normalize=True, **kwargs)
+
+
+_PAIRS = {
+    'c_s-s': PairSpec('c', 'x86', target_first=False),
+    'c_arm-arm': PairSpec('c', 'arm', target_first=False),
+    'arm_armopt-armopt': PairSpec('arm', 'armopt', source_compiler=None, target_first=False),
+    's_c-c': PairSpec('x86', 'c'),
+    's_opt-opt': PairSpec('x86', 'opt', target_first=False),
+    's_arm-arm': PairSpec('x86', 'arm', target_first=False),
+    'opt3_c-c': PairSpec('opt3', 'c'),
+    'arm_c-c': PairSpec('arm', 'c'),
+    'arm_opts_c-c': PairSpec('arm_opts', 'c'),
+    'arm_opt3_c-c': PairSpec('arm_opt3', 'c'),
+    'opt3_s-s': PairSpec('opt3', 'x86'),
+    's_s-s': PairSpec('x86', 'x86'),
+    's_opt3-opt3': PairSpec('x86', 'opt3'),
+    'riscv_ir-ir': _ir('riscv', 'ir'),
+    'riscv_opts_ir_opts-ir_opts': _ir('riscv_opts', 'ir'),
+    'riscv_opt3_ir_opt3-ir_opt3': _ir('riscv_opt3', 'ir_opt3'),
+    's_ir-ir': _ir('x86', 'ir'),
+    'opts_ir_opts-ir_opts': _ir('opts', 'ir_opts'),
+    'opt3_ir_opt3-ir_opt3': _ir('opt3', 'ir_opt3'),
+    'opt3_ir-ir': _ir('opt3', 'ir'),
+    'opt3_ir_optz-ir_optz': _ir('opt3', 'ir_optz'),
+    'arm_ir-ir': _ir('arm', 'ir'),
+    'arm_opts_ir_opt3-ir_opts': _ir('arm_opts', 'ir'),
+    'arm_opt3_ir_opt3-ir_opt3': _ir('arm_opt3', 'ir_opt3'),
+    'arm_opt3_ir-ir': _ir('arm_opt3', 'ir'),
+    'riscv_opt3_ir-ir': _ir('riscv_opt3', 'ir'),
+    'arm32_ir-ir': _ir('arm32', 'ir'),
+    'arm32_opts_ir_opts-ir_opts': _ir('arm32_opts', 'ir'),
+    'arm32_opt3_ir_opt3-ir_opt3': _ir('arm32_opt3', 'ir_opt3'),
+    'opt3_arm_opt3-arm_opt3': PairSpec('opt3', 'arm_opt3', source_compiler='target'),
+    'arm_opt3_ir_optz-ir_optz': PairSpec('arm_opt3', 'ir_optz', source_compiler='target'),
+    'riscv_opt3_ir_optz-ir_optz': PairSpec('riscv_opt3', 'ir_optz', source_compiler='target'),
+}
+PAIRS = MappingProxyType(_PAIRS)  # pair (without clang_ prefixes) -> PairSpec, extend with register_pair
+
+_SOURCE_GOES_RIGHT = frozenset(['opt3_c-c', 'arm_s-s', 's_c-c', 'arm_c-c', 'arm_opt3_c-c', 'riscv_c-c', 'riscv_opt3_c-c',
+                                's_ir-ir', 'arm_ir-ir', 'riscv_ir-ir', 'riscv_opt3_ir_opt3-ir_opt3',
+                                'arm_opt3_ir_opt3-ir_opt3', 'opt3_ir_opt3-ir_opt3', 'arm_opt3_ir_optz-ir_optz',
+                                'riscv_opt3_ir_optz-ir_optz'])
+_SOURCE_GOES_RIGHT_UNLESS_LEGACY = frozenset(['opt3_ir_optz-ir_optz', 'opt3_ir-ir'])
+
+_ASM_KEY_SUFFIXES = MappingProxyType({
+    'x86': 'x86_O0',
+    's': 'x86_O0',
+    'opt': 'x86_Os',
+    'arm': 'arm_O0',
+    'opt3': 'x86_O3',
+    'arm_opts': 'arm_Os',
+    'arm_opt3': 'arm_O3',
+    'riscv': 'riscv_O0',
+    'riscv_opts': 'riscv_Os',
+    'riscv_opt3': 'riscv_O3',
+    'ir': 'ir_O0',
+    'ir_opts': 'ir_Os',
+    'ir_optz': 'ir_Oz',
+    'ir_opt3': 'ir_O3',
+    'arm32': 'arm32_O0',
+    'arm32_opt3': 'arm32_O3',
+})
+
+
+def register_pair(pair, spec: PairSpec, source_goes_left=True):
+    if pair in _PAIRS:
+        raise ValueError(f'pair {pair} is already registered')
+    _PAIRS[pair] = spec
+    if not source_goes_left:
+        global _SOURCE_GOES_RIGHT
+        _SOURCE_GOES_RIGHT = _SOURCE_GOES_RIGHT | {pair}
+    resolve_pair.cache_clear()
+
+
+@lru_cache(maxsize=None)
+def resolve_pair(pair) -> ResolvedPair:
+    # e.g. clang_opt3_ir_optz-ir_optz: the compilers come from the full pair, the spec from the pair without clang_
+    target_l = pair.split('-')[1]
+    source_compiler = 'clang' if ('clang' in pair.split('-')[0].replace(target_l, '') or 'ir' in pair.split('-')[0].replace(target_l, '')) else 'gcc'
+    target_compiler = 'clang' if (source_compiler == 'clang' or 'clang' in target_l or 'ir' in target_l) else 'gcc'
+    base_pair = pair.replace('clang_', '')
+    spec = _PAIRS.get(base_pair)
+    if spec is None:
+        if 'io' in base_pair:
+            raise ValueError
+            # irrelevant for Forklift
+        raise ValueError(base_pair)
+    return ResolvedPair(pair=base_pair, spec=spec, source_compiler=source_compiler, target_compiler=target_compiler,
+                        source_goes_left=DP.source_goes_left(base_pair))
+
+
+_DETOK_COMMENT_PATTERN = re.compile(r'# (/\w+)*')
+
+
+class TokenizationCache:
+    # bounded LRU of DP.tokenize results, keyed by the pair, the tokenization flags and hashes of source and target
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(source, target, pair, ids, opt3_legacy):
+        digest = lambda s: None if s is None else hashlib.blake2b(s.encode(), digest_size=16).digest()
+        return pair, ids, opt3_legacy, digest(source), digest(target)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def get_asm_index(row):
+    # target -> code of a row, either in the HF format ({'target': [...], 'code': [...]}, first occurrence wins like
+    # list.index) or in the dict format of FuncDataclass.dict() ({target: FuncAsm dict, code or None})
+    asm = row['asm']
+    if isinstance(asm.get('target'), list):
+        index = {}
+        for target, code in zip(asm['target'], asm['code']):
+            index.setdefault(target, code)
+        return index
+    return {target: code['func_asm'] if isinstance(code, dict) else code for target, code in asm.items()}
+
+
+@lru_cache(maxsize=None)
+def _lang_special_token(lang, opt3_legacy=False):
+    modifiers = []
+    if 'clang_' in lang:
+        lang = lang.replace('clang_', '')
+        modifiers.append('clang')
+    if lang == 's':
+        token = 'intel'
+    elif lang == 'opt':
+        token = 'intel'
+        modifiers.append('opt')
+    elif lang == 'opt3':
+        token = 'intel'
+        modifiers.append('opt3')
+    elif lang == 'c':
+        token = 'c'
+    elif 'arm' in lang:
+        token = 'arm'
+    elif 'riscv' in lang:
+        token = 'riscv'
+    elif 'ir' in lang:
+        token = 'ir'
+    else:
+        raise ValueError(lang)
+    if lang not in ['s', 'opt', 'opt3']:
+        if 'opts' in lang:
+            modifiers.append('opts')
+        elif 'opt3' in lang:
+            modifiers.append('opt3')
+        elif 'oz' in lang:
+            modifiers.append('oz')
+
+    def _get_start_end(tok):
+        _start = f'<{tok}>'
+        _end = f'</{tok}>'
+        if opt3_legacy and tok == 'opt3': # legacy bug
+            _end = '</opt>'
+        return _start, _end
+
+    start, end = _get_start_end(token)
+    modifiers = tuple(map(_get_start_end, modifiers))
+
+    return start, end, modifiers
+
+
 class DP:
 
-    def __init__(self, tokenizer=None):
+    def __init__(self, tokenizer=None, cache: Optional[TokenizationCache] = None):
         self.tokenizer = tokenizer
+        self.cache = cache  # optional TokenizationCache shared by the DPs of the same tokenizer
+        self._asm_index_cache = (None, None)  # (row['asm'], index) of the last row, it is looked up several times
 
-    def source_goes_left(self, pair, legacy_opt3_ir=False):
-        res = True
-        if pair in ['opt3_c-c', 'arm_s-s', 's_c-c', 'arm_c-c', 'arm_opt3_c-c', 'riscv_c-c', 'riscv_opt3_c-c', 's_ir-ir',
-                    'arm_ir-ir', 'riscv_ir-ir', 'riscv_opt3_ir_opt3-ir_opt3', 'arm_opt3_ir_opt3-ir_opt3', 'opt3_ir_opt3-ir_opt3',
-                    'arm_opt3_ir_optz-ir_optz', 'riscv_opt3_ir_optz-ir_optz']:
-            res = False
-        if not legacy_opt3_ir and pair in ['opt3_ir_optz-ir_optz', 'opt3_ir-ir']:
-            res = False
-        return res
+    def _get_asm_index(self, row):
+        asm, index = self._asm_index_cache
+        if asm is not row['asm']:
+            index = get_asm_index(row)
+            self._asm_index_cache = (row['asm'], index)
+        return index
+
+    @staticmethod
+    def source_goes_left(pair, legacy_opt3_ir=False):
+        if pair in _SOURCE_GOES_RIGHT:
+            return False
+        return legacy_opt3_ir or pair not in _SOURCE_GOES_RIGHT_UNLESS_LEGACY
 
     def lang_special_token(self, lang, opt3_legacy=False):
-        modifiers = []
-        if 'clang_' in lang:
-            lang = lang.replace('clang_', '')
-            modifiers.append('clang')
-        if lang == 's':
-            token = 'intel'
-        elif lang == 'opt':
-            token = 'intel'
-            modifiers.append('opt')
-        elif lang == 'opt3':
-            token = 'intel'
-            modifiers.append('opt3')
-        elif lang == 'c':
-            token = 'c'
-        elif 'arm' in lang:
-            token = 'arm'
-        elif 'riscv' in lang:
-            token = 'riscv'
-        elif 'ir' in lang:
-            token = 'ir'
-        else:
-            raise ValueError(lang)
-        if lang not in ['s', 'opt', 'opt3']:
-            if 'opts' in lang:
-                modifiers.append('opts')
-            elif 'opt3' in lang:
-                modifiers.append('opt3')
-            elif 'oz' in lang:
-                modifiers.append('oz')
-
-        def _get_start_end(tok):
-            _start = f'<{tok}>'
-            _end = f'</{tok}>'
-            if opt3_legacy and tok == 'opt3': # legacy bug
-                _end = '</opt>'
-            return _start, _end
-
-        start, end = _get_start_end(token)
-        modifiers = list(map(_get_start_end, modifiers))
-
-        return start, end, modifiers
+        start, end, modifiers = _lang_special_token(lang, opt3_legacy=opt3_legacy)
+        return start, end, list(modifiers)
 
     @staticmethod
+    @lru_cache(maxsize=None)
     def get_lang_from_pair(p, source_or_target):
         assert source_or_target in ['source', 'target']
         if source_or_target == 'source':
@@ -79,6 +261,32 @@ class DP:
         return l
 
     def tokenize(self, source, target, pair, ids=True, no_tokenize=False, opt3_legacy=False):
+        # with target=None, only the source is tokenized and None is returned for the target.
+        # Cached results are shared, don't modify them in place
+        if self.cache is None or no_tokenize:
+            return self._tokenize(source, target, pair, ids=ids, no_tokenize=no_tokenize, opt3_legacy=opt3_legacy)
+        key = self.cache.key(source, target, pair, ids, opt3_legacy)
+        res = self.cache.get(key)
+        if res is None:
+            res = self._tokenize(source, target, pair, ids=ids, opt3_legacy=opt3_legacy)
+            self.cache.put(key, res)
+        return res
+
+    def _tokenize(self, source, target, pair, ids=True, no_tokenize=False, opt3_legacy=False):
+        if no_tokenize:
+            return self._build_prompts(source, target, pair, no_tokenize=True, opt3_legacy=opt3_legacy)
+        source_prompt, target_prompt = self._build_prompts(source, target, pair, opt3_legacy=opt3_legacy)
+        source_tokenized = self._encoding_to_list(self.tokenizer.encode(source_prompt), ids)
+        if target is None:  # source only, e.g. at inference time
+            return source_tokenized, None
+        return source_tokenized, self._encoding_to_list(self.tokenizer.encode(target_prompt), ids)
+
+    @staticmethod
+    def _encoding_to_list(encoding, ids):
+        return encoding.ids if ids else encoding.tokens
+
+    def _build_prompts(self, source, target, pair, no_tokenize=False, opt3_legacy=False):
+        # normalized source prompt and target reference (None if target is None), ready to be encoded
         # one_sample must be a function definition (and ONLY a function definition)
         assert pair.count('-') < 2
         if '-' not in pair:
@@ -100,17 +308,14 @@ class DP:
             one_sample_ref = f"{start_lang_tok} {modifiers_start} {target} {modifiers_end} {end_lang_tok}"
             if no_tokenize:
                 return one_sample, one_sample_ref
-            one_sample_ref_norm = self.tokenizer.normalizer.normalize_str(one_sample_ref)
-            one_sample_ref_norm = one_sample_ref_norm.replace(f"{start_lang_tok} {modifiers_start} ", '').replace(f" {modifiers_end} {end_lang_tok}", '')
+            ref_start, ref_end = f"{start_lang_tok} {modifiers_start} ", f" {modifiers_end} {end_lang_tok}"
             one_sample_masked = f"{start_lang_tok} {modifiers_start} <mask:0> {modifiers_end} {end_lang_tok}"
 
         else:
             one_sample_ref = f"{start_lang_tok} {target} {end_lang_tok}"
             if no_tokenize:
                 return one_sample, one_sample_ref
-            one_sample_ref_norm = self.tokenizer.normalizer.normalize_str(one_sample_ref)
-            one_sample_ref_norm = one_sample_ref_norm.replace(f"{start_lang_tok} ", '').replace(
-                f" {end_lang_tok}", '')
+            ref_start, ref_end = f"{start_lang_tok} ", f" {end_lang_tok}"
             one_sample_masked = f"{start_lang_tok} <mask:0> {end_lang_tok}"
 
         if self.source_goes_left(pair):
@@ -118,15 +323,12 @@ class DP:
         else:
             one_sample = f'{one_sample_masked} {one_sample}'
 
-        source_tokenized = self.tokenizer.encode(self.tokenizer.normalizer.normalize_str(one_sample))
-        target_tokenized = self.tokenizer.encode(one_sample_ref_norm)
-        if ids:
-            source_tokenized = source_tokenized.ids
-            target_tokenized = target_tokenized.ids
-        else:
-            source_tokenized = source_tokenized.tokens
-            target_tokenized = target_tokenized.tokens
-        return source_tokenized, target_tokenized
+        one_sample = self.tokenizer.normalizer.normalize_str(one_sample)
+        if target is None:
+            return one_sample, None
+        one_sample_ref_norm = self.tokenizer.normalizer.normalize_str(one_sample_ref)
+        one_sample_ref_norm = one_sample_ref_norm.replace(ref_start, '').replace(ref_end, '')
+        return one_sample, one_sample_ref_norm
 
 
     def prepare(self, row, pair, asm_key='angha', return_target_length=False):
@@ -136,10 +338,43 @@ class DP:
         one_sample, t_length = self.row_to_sample(row, pair, asm_key, return_target_length=True)
         return one_sample, t_length
 
+    def prepare_batch(self, rows, pair, asm_key='angha', return_target_length=False, max_chars=None):
+        # prepare() for many rows of the same pair, encoded with a single (multi-threaded) encode_batch call.
+        # Rows whose prompt is longer than max_chars characters are not encoded and come back as None
+        assert asm_key in ['real', 'angha']
+        texts = [self._get_par_texts(row, pair, asm_key, False, True) for row in rows]
+        res = [None] * len(texts)
+        todo = []
+        for idx, (base_pair, source, target) in enumerate(texts):
+            target = target if return_target_length else None
+            prompts = self._build_prompts(source, target, base_pair)
+            if max_chars is not None and (len(prompts[0]) > max_chars or
+                                          (prompts[1] is not None and len(prompts[1]) > max_chars)):
+                continue
+            key = self.cache.key(source, target, base_pair, True, False) if self.cache is not None else None
+            cached = self.cache.get(key) if key is not None else None
+            if cached is not None:
+                res[idx] = cached
+                continue
+            todo.append((idx, key, prompts))
+        if todo:
+            sources = self.tokenizer.encode_batch([source_prompt for _, _, (source_prompt, _) in todo])
+            targets = self.tokenizer.encode_batch([target_prompt for _, _, (_, target_prompt) in todo]) \
+                if return_target_length else [None] * len(todo)
+            for (idx, key, _), source_enc, target_enc in zip(todo, sources, targets):
+                res[idx] = (source_enc.ids, target_enc.ids if target_enc is not None else None)
+                if key is not None:
+                    self.cache.put(key, res[idx])
+        if not return_target_length:
+            return [None if r is None else r[0] for r in res]
+        return [None if r is None else (r[0], len(r[1])) for r in res]
+
     def row_to_sample(self, row, pair, asm_key, return_target_length=False):
+        # the target is only tokenized when its length is needed
         source, target, tokenized_source, tokenized_target = self.get_par_data(row, pair, asm_key=asm_key, fPIC=False,
                                                                                tokenize_ids=True,
-                                                                               do_normalize_ir_structs=True)
+                                                                               do_normalize_ir_structs=True,
+                                                                               tokenize_target=return_target_length)
         if not return_target_length:
             return tokenized_source
         return tokenized_source, len(tokenized_target)
@@ -147,52 +382,34 @@ class DP:
     def detokenize(self, one_sample, remove_mask=True):
         # We can't directly use decode(), need to remove some special tokens by hand (they can't be skipped as the others)
         detok = self.tokenizer.decode(one_sample, skip_special_tokens=False)
+        return self._clean_detokenized(detok, remove_mask=remove_mask)
+
+    def detokenize_batch(self, samples, remove_mask=True):
+        return [self._clean_detokenized(detok, remove_mask=remove_mask)
+                for detok in self.tokenizer.decode_batch(samples, skip_special_tokens=False)]
+
+    @staticmethod
+    def _clean_detokenized(detok, remove_mask=True):
         detok = detok.replace('<eol> ', '\n').replace('<eol>', '\n').replace('<tab> ', '\t').replace('<tab>', '\t')
         if remove_mask:
             detok = detok.replace(
             '<mask:0>', '')
         detok = detok.replace('<pad>', '').replace('<s>', '').replace('</s>', '')
-        detok = re.sub('# (/\w+)*', '', detok)
+        if '# ' in detok:
+            detok = _DETOK_COMMENT_PATTERN.sub('', detok)
         detok = detok.replace('0x ', '0x').replace(' #', '').replace('return', 'return ').replace('return  ', 'return ')
         detok = detok.replace('static', '').replace('inline', '')
-        detok = re.sub('# (/\w+)*', '', detok)
+        if '# ' in detok:
+            detok = _DETOK_COMMENT_PATTERN.sub('', detok)
         detok = detok.replace('__attribute__((used))', '')
         return detok
 
     def get_asm_key(self, key, asm_key='angha', compiler='gcc', fPIC=False):
         assert compiler in ['gcc', 'clang']
-        if key in ['x86', 's']:
-            full_key = f'{asm_key}_{compiler}_x86_O0'
-        elif key == 'opt':
-            full_key = f'{asm_key}_{compiler}_x86_Os'
-        elif key == 'arm':
-            full_key  = f'{asm_key}_{compiler}_arm_O0'
-        elif key == 'opt3':
-            full_key = f'{asm_key}_{compiler}_x86_O3'
-        elif key == 'arm_opts':
-            full_key = f'{asm_key}_{compiler}_arm_Os'
-        elif key == 'arm_opt3':
-            full_key = f'{asm_key}_{compiler}_arm_O3'
-        elif key == 'riscv':
-            full_key = f'{asm_key}_{compiler}_riscv_O0'
-        elif key == 'riscv_opts':
-            full_key = f'{asm_key}_{compiler}_riscv_Os'
-        elif key == 'riscv_opt3':
-            full_key = f'{asm_key}_{compiler}_riscv_O3'
-        elif key == 'ir':
-            full_key = f'{asm_key}_{compiler}_ir_O0'
-        elif key == 'ir_opts':
-            full_key = f'{asm_key}_{compiler}_ir_Os'
-        elif key == 'ir_optz':
-            full_key = f'{asm_key}_{compiler}_ir_Oz'
-        elif key == 'ir_opt3':
-            full_key = f'{asm_key}_{compiler}_ir_O3'
-        elif key == 'arm32':
-            full_key = f'{asm_key}_{compiler}_arm32_O0'
-        elif key == 'arm32_opt3':
-            full_key = f'{asm_key}_{compiler}_arm32_O3'
-        else:
+        suffix = _ASM_KEY_SUFFIXES.get(key)
+        if suffix is None:
             raise RuntimeError(key)
+        full_key = f'{asm_key}_{compiler}_{suffix}'
         if fPIC:
             full_key += '_fPIC'
         return full_key
@@ -202,30 +419,34 @@ class DP:
         if do_normalize_ir_structs:
             assert 'ir' in key
             assert row is not None
-        try:
-            k = self.get_asm_key(key, asm_key, compiler, fPIC=fPIC)
-            if not row:
-                return k
-            #print(row['asm']['target'])
-            asm_idx = row['asm']['target'].index(k)
-        except ValueError as e:
-            if not fPIC:
-                raise ValueError(e)
-            else:
-                k = self.get_asm_key(key, asm_key, compiler, fPIC=False)
-                if not row:
-                    return k
-                try:
-                    asm_idx = row['asm']['target'].index(k)
-                except ValueError:
-                    return ''
-        res = row['asm']['code'][asm_idx]
+        k = self.get_asm_key(key, asm_key, compiler, fPIC=fPIC)
+        if not row:
+            return k
+        index = self._get_asm_index(row)
+        if k in index:
+            res = index[k]
+        elif not fPIC:
+            raise ValueError(f'{k!r} is not in list')
+        else:
+            k = self.get_asm_key(key, asm_key, compiler, fPIC=False)
+            if k not in index:
+                return ''
+            res = index[k]
         if 'ir' in key and do_normalize_ir_structs:
             res = normalize_structs(res)
         return res
 
 
-    def get_par_data(self, row, pair, asm_key='angha', fPIC=False, tokenize_ids=True, do_normalize_ir_structs=False):
+    def _get_pair_side(self, row, key, compiler, asm_key, fPIC, do_normalize_ir_structs=False):
+        if key == 'c':
+            return row['func_def']
+        if compiler is None:
+            return self.get_asm(key, row, asm_key)
+        return self.get_asm(key, row, asm_key, compiler=compiler, fPIC=fPIC,
+                            do_normalize_ir_structs=do_normalize_ir_structs)
+
+    def get_par_data(self, row, pair, asm_key='angha', fPIC=False, tokenize_ids=True, do_normalize_ir_structs=False,
+                     tokenize_target=True):
         # if row is optional, only return asm full keys
         assert asm_key in ['real', 'angha']
         if asm_key == 'angha':
@@ -233,133 +454,40 @@ class DP:
         else:
             io_key = 'real_io_pairs'
 
-        target_l = pair.split('-')[1]
-        source_compiler = 'clang' if ('clang' in pair.split('-')[0].replace(target_l, '') or 'ir' in pair.split('-')[0].replace(target_l, '')) else 'gcc'
-        target_compiler = 'clang' if (source_compiler == 'clang' or 'clang' in target_l or 'ir' in target_l) else 'gcc'
-        pair = pair.replace('clang_', '')
-
-        if pair == 'c_s-s':
-            source = row['func_def']
-            target = self.get_asm('x86', row, asm_key, compiler=target_compiler, fPIC=fPIC)
-        elif pair == 'c_arm-arm':
-            source = row['func_def']
-            target = self.get_asm('arm', row, asm_key, compiler=target_compiler, fPIC=fPIC)
-        elif pair == 'arm_armopt-armopt':
-            source = self.get_asm('arm', row, asm_key)
-            target = self.get_asm('armopt', row, asm_key,compiler=target_compiler,fPIC=fPIC)
-        elif pair == 's_c-c':
-            target = row['func_def']
-            source = self.get_asm('x86', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 's_opt-opt':
-            source = self.get_asm('x86', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-            target = self.get_asm('opt', row, asm_key, compiler=target_compiler, fPIC=fPIC)
-        elif pair == 's_arm-arm':
-            source = self.get_asm('x86', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-            target = self.get_asm('arm', row, asm_key, compiler=target_compiler, fPIC=fPIC)
-        elif pair == 'opt3_c-c':
-            target = row['func_def']
-            source = self.get_asm('opt3', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 'arm_c-c':
-            target = row['func_def']
-            source = self.get_asm('arm', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 'arm_opts_c-c':
-            target = row['func_def']
-            source = self.get_asm('arm_opts', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 'arm_opt3_c-c':
-            target = row['func_def']
-            source = self.get_asm('arm_opt3', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 'opt3_s-s':
-            target = self.get_asm('x86', row, asm_key, compiler=target_compiler, fPIC=fPIC)
-            source = self.get_asm('opt3', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 's_s-s':
-            target = self.get_asm('x86', row, asm_key, compiler=target_compiler, fPIC=fPIC)
-            source = self.get_asm('x86', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 's_opt3-opt3':
-            target = self.get_asm('opt3', row, asm_key, compiler=target_compiler, fPIC=fPIC)
-            source = self.get_asm('x86', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 'riscv_ir-ir':
-            target = self.get_asm('ir', row, asm_key, compiler=target_compiler, fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('riscv', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 'riscv_opts_ir_opts-ir_opts':
-            target = self.get_asm('ir', row, asm_key, compiler=target_compiler, fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('riscv_opts', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 'riscv_opt3_ir_opt3-ir_opt3':
-            target = self.get_asm('ir_opt3', row, asm_key, compiler=target_compiler, fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('riscv_opt3', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-
-        elif pair == 's_ir-ir':
-            target = self.get_asm('ir', row, asm_key, compiler=target_compiler, fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('x86', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 'opts_ir_opts-ir_opts':
-            target = self.get_asm('ir_opts', row, asm_key, compiler=target_compiler, fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('opts', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 'opt3_ir_opt3-ir_opt3':
-            target = self.get_asm('ir_opt3', row, asm_key, compiler=target_compiler,fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('opt3', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-
-        elif pair == 'opt3_ir-ir':
-            target = self.get_asm('ir', row, asm_key, compiler=target_compiler,fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('opt3', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 'opt3_ir_optz-ir_optz':
-            target = self.get_asm('ir_optz', row, asm_key, compiler=target_compiler,fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('opt3', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-
-        elif pair == 'riscv_ir-ir':
-            target = self.get_asm('ir', row, asm_key, compiler=target_compiler, fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('riscv', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 'riscv_opts_ir_opts-ir_opts':
-            target = self.get_asm('ir', row, asm_key, compiler=target_compiler, fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('riscv_opts', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 'riscv_opt3_ir_opt3-ir_opt3':
-            target = self.get_asm('ir_opt3', row, asm_key, compiler=target_compiler, fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('riscv_opt3', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-
-        elif pair == 'arm_ir-ir':
-            target = self.get_asm('ir', row, asm_key, compiler=target_compiler, fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('arm', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 'arm_opts_ir_opt3-ir_opts':
-            target = self.get_asm('ir', row, asm_key, compiler=target_compiler, fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('arm_opts', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 'arm_opt3_ir_opt3-ir_opt3':
-            target = self.get_asm('ir_opt3', row, asm_key, compiler=target_compiler, fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('arm_opt3', row, asm_key, compiler=source_compiler,fPIC=fPIC)
-
-        elif pair == 'arm_opt3_ir-ir':
-            target = self.get_asm('ir', row, asm_key, compiler=target_compiler, fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('arm_opt3', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-
-        elif pair == 'riscv_opt3_ir-ir':
-            target = self.get_asm('ir', row, asm_key, compiler=target_compiler, fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('riscv_opt3', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-
-
-        elif pair == 'arm32_ir-ir':
-            target = self.get_asm('ir', row, asm_key, compiler=target_compiler,  fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('arm32', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 'arm32_opts_ir_opts-ir_opts':
-            target = self.get_asm('ir', row, asm_key, compiler=target_compiler, fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('arm32_opts', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-        elif pair == 'arm32_opt3_ir_opt3-ir_opt3':
-            target = self.get_asm('ir_opt3', row, asm_key, compiler=target_compiler, fPIC=fPIC, do_normalize_ir_structs=do_normalize_ir_structs)
-            source = self.get_asm('arm32_opt3', row, asm_key, compiler=source_compiler, fPIC=fPIC)
-
-        elif pair == 'opt3_arm_opt3-arm_opt3':
-            target = self.get_asm('arm_opt3', row, asm_key, compiler=target_compiler,fPIC=fPIC)
-            source = self.get_asm('opt3', row, asm_key, compiler=target_compiler,fPIC=fPIC)
-
-        elif pair == 'arm_opt3_ir_optz-ir_optz':
-            target = self.get_asm('ir_optz', row, asm_key, compiler=target_compiler, fPIC=fPIC)
-            source = self.get_asm('arm_opt3', row, asm_key, compiler=target_compiler, fPIC=fPIC)
-        elif pair == 'riscv_opt3_ir_optz-ir_optz':
-            target = self.get_asm('ir_optz', row, asm_key, compiler=target_compiler, fPIC=fPIC)
-            source = self.get_asm('riscv_opt3', row, asm_key, compiler=target_compiler, fPIC=fPIC)
-        elif 'io' in pair:
-            raise ValueError
-            # irrelevant for Forklift
-        else:
-            raise ValueError(pair)
+        pair, source, target = self._get_par_texts(row, pair, asm_key, fPIC, do_normalize_ir_structs)
         tokenized_source, tokenized_target = None, None
         if self.tokenizer:
-            tokenized_source, tokenized_target = self.tokenize(source, target, pair, ids=tokenize_ids)
+            tokenized_source, tokenized_target = self.tokenize(source, target if tokenize_target else None, pair,
+                                                               ids=tokenize_ids)
 
         return source, target, tokenized_source, tokenized_target
+
+    @classmethod
+    def get_required_asms(cls, pairs, add_o0_reference=True):
+        # compiler keys (see asm.COMPILER_SPECS) whose outputs the pairs read, and the O0 version of each optimized one
+        required_asms = set()
+        dp = cls()
+        for pair in pairs:
+            source_k, target_k, _, _ = dp.get_par_data(row=None, pair=pair, asm_key='angha', fPIC=False)
+            required_asms.add(source_k.replace('angha_', ''))
+            required_asms.add(target_k.replace('angha_', ''))
+        if add_o0_reference:
+            required_asms |= {k.replace('_O3', '_O0').replace('_Os', '_O0').replace('_Oz', '_O0')
+                              for k in required_asms if '_O0' not in k}
+        return sorted(required_asms)
+
+    def _get_par_texts(self, row, pair, asm_key, fPIC, do_normalize_ir_structs):
+        # pair without clang_ prefixes, source and target of a row
+        resolved = resolve_pair(pair)
+        spec = resolved.spec
+        compilers = dict(source=resolved.source_compiler, target=resolved.target_compiler)
+        get_source = lambda: self._get_pair_side(row, spec.source, compilers.get(spec.source_compiler), asm_key, fPIC)
+        get_target = lambda: self._get_pair_side(row, spec.target, compilers.get(spec.target_compiler), asm_key, fPIC,
+                                                 do_normalize_ir_structs=spec.normalize and do_normalize_ir_structs)
+        if spec.target_first:
+            target = get_target()
+            source = get_source()
+        else:
+            source = get_source()
+            target = get_target()
+        return resolved.pair, source, target
@@ -0,0 +1,115 @@
+import queue
+import threading
+
+from .utils import InferenceDataset
+
+_END = object()
+
+
+class _StageError:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class LiftPipeline:
+    """
+    Streaming lifter: compilation (AsmAdder), tokenization (DP.prepare) and generation (Evaluator) run as concurrent
+    stages connected by bounded queues, so clang/gcc keep working while the model generates.
+    run() yields (index in samples, row, hypotheses) as soon as each prediction is ready; the order follows
+    completion, not the input.
+    """
+
+    def __init__(self, evaluator, pair, compilers_keys=None, batch_size=8, queue_size=32, n_compile_workers=None,
+                 asm_cache=None):
+        self.evaluator = evaluator
+        self.pair = pair
+        self.compilers_keys = compilers_keys
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.n_compile_workers = n_compile_workers
+        self.asm_cache = asm_cache
+
+    @staticmethod
+    def _put(q, item, stop):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def _get(q, stop):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _compile_stage(self, samples, out_q, stop):
+        dataset = None
+        try:
+            dataset = InferenceDataset(samples, compilers_keys=self.compilers_keys, n_workers=self.n_compile_workers,
+                                       cache=self.asm_cache, pairs=[self.pair])
+            for idx, row in enumerate(dataset):
+                if not self._put(out_q, (idx, row), stop):
+                    return
+            self._put(out_q, _END, stop)
+        except BaseException as e:
+            self._put(out_q, _StageError(e), stop)
+        finally:
+            if dataset is not None:
+                dataset.asm_adder.close()
+
+    def _tokenize_stage(self, in_q, out_q, stop):
+        while not stop.is_set():
+            item = self._get(in_q, stop)
+            if item is _END or isinstance(item, _StageError):
+                self._put(out_q, item, stop)
+                return
+            idx, row = item
+            try:
+                tokenized, status = self.evaluator._tokenize([(row, self.pair)], return_status=True)
+            except BaseException as e:
+                self._put(out_q, _StageError(e), stop)
+                return
+            if not self._put(out_q, (idx, row, tokenized[0], status[0]), stop):
+                return
+
+    def run(self, samples):
+        compiled_q = queue.Queue(maxsize=self.queue_size)
+        tokenized_q = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        threads = [threading.Thread(target=self._compile_stage, args=(samples, compiled_q, stop), daemon=True),
+                   threading.Thread(target=self._tokenize_stage, args=(compiled_q, tokenized_q, stop), daemon=True)]
+        for t in threads:
+            t.start()
+        try:
+            done = False
+            while not done:
+                # block for the first item, then take whatever else is already tokenized (up to batch_size)
+                batch = [tokenized_q.get()]
+                while len(batch) < self.batch_size and batch[-1] is not _END and not isinstance(batch[-1], _StageError):
+                    try:
+                        batch.append(tokenized_q.get_nowait())
+                    except queue.Empty:
+                        break
+                if batch[-1] is _END:
+                    batch.pop()
+                    done = True
+                elif isinstance(batch[-1], _StageError):
+                    raise batch[-1].exc
+                to_generate = []
+                for idx, row, tok, status in batch:
+                    if tok is None:  # doesn't fit in the model, same as predict_batch
+                        yield idx, row, self.evaluator._overflow(row, self.pair, status)
+                    else:
+                        to_generate.append((idx, row, tok))
+                if to_generate:
+                    predictions = self.evaluator._generate([tok for _, _, tok in to_generate])
+                    for (idx, row, _), hyps in zip(to_generate, predictions):
+                        yield idx, row, hyps
+        finally:
+            stop.set()
@@ -0,0 +1,196 @@
+import argparse
+import os
+import secrets
+import stat
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+# Long-lived lifting service: the model is loaded once by the server and client scripts send rows or C samples
+# over a Unix socket (or host:port). Clients do not need torch/transformers installed.
+# Requests are pickled, so connections are authenticated: a Unix socket server generates a random key and writes it
+# to <socket>.key, both readable by its user only; a host:port server needs an explicit key (--authkey or
+# FORKLIFT_AUTHKEY), that clients pass the same way.
+
+DEFAULT_ADDRESS = '/tmp/forklift.sock'
+AUTHKEY_ENV = 'FORKLIFT_AUTHKEY'
+
+
+def parse_address(address):
+    if ':' in address and not address.startswith('/'):
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    return address
+
+
+def authkey_path(address):
+    # file of the key of a Unix socket server, None for host:port
+    address = parse_address(address)
+    return address + '.key' if isinstance(address, str) else None
+
+
+def load_authkey(address, authkey=None):
+    # explicit key, else FORKLIFT_AUTHKEY, else the key file of a Unix socket server
+    authkey = authkey or os.environ.get(AUTHKEY_ENV)
+    if authkey is None and authkey_path(address) is not None:
+        try:
+            with open(authkey_path(address)) as f:
+                authkey = f.read().strip()
+        except FileNotFoundError:
+            pass
+    if not authkey:
+        raise ValueError(f'no key to authenticate with {address}, pass authkey or set {AUTHKEY_ENV}')
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+def _write_private(path, data):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+
+
+class LiftServer:
+    def __init__(self, config, asm_cache=None, n_workers=None):
+        from .evaluator import get_evaluator
+        self.evaluator = get_evaluator(config)
+        self.asm_cache = asm_cache
+        self.n_workers = n_workers
+        self._model_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def predict_batch(self, rows_pairs):
+        with self._model_lock:
+            return self.evaluator.predict_batch(rows_pairs)
+
+    def lift(self, samples, pair, compilers_keys=None):
+        from .utils import InferenceDataset
+        rows = InferenceDataset(samples, compilers_keys=compilers_keys, n_workers=self.n_workers,
+                                cache=self.asm_cache, pairs=[pair])
+        return self.predict_batch([(row, pair) for row in rows])
+
+    def handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    return
+                try:
+                    op, kwargs = request
+                    if op == 'predict_batch':
+                        res = self.predict_batch(**kwargs)
+                    elif op == 'lift':
+                        res = self.lift(**kwargs)
+                    elif op == 'ping':
+                        res = self.evaluator.config.to_dict()
+                    elif op == 'shutdown':
+                        self._stop.set()
+                        res = None
+                    else:
+                        raise ValueError(f'op = {op}')
+                    conn.send(('ok', res))
+                except BaseException as e:
+                    conn.send(('error', repr(e)))
+
+    def serve_forever(self, address=DEFAULT_ADDRESS, authkey=None):
+        key_path = authkey_path(address)
+        authkey = authkey or os.environ.get(AUTHKEY_ENV)
+        if key_path is None and not authkey:
+            raise ValueError(f'refusing to serve on {address} without a key, pass authkey or set {AUTHKEY_ENV}')
+        address = parse_address(address)
+        if key_path is not None:
+            if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+                os.remove(address)  # stale socket of a previous server
+            authkey = authkey or secrets.token_hex(32)
+            _write_private(key_path, authkey if isinstance(authkey, str) else authkey.decode())
+        authkey = authkey.encode() if isinstance(authkey, str) else authkey
+        umask = os.umask(0o177)  # the socket is created 0600
+        try:
+            listener = Listener(address, authkey=authkey)
+        finally:
+            os.umask(umask)
+        try:
+            with listener:
+                while not self._stop.is_set():
+                    try:
+                        conn = listener.accept()
+                    except (AuthenticationError, EOFError, OSError):  # e.g. a client with another key
+                        continue
+                    threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            if key_path is not None and os.path.exists(key_path):
+                os.remove(key_path)
+
+
+class LiftClient:
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None):
+        self.address = parse_address(address)
+        self.authkey = load_authkey(address, authkey)
+        self.conn = Client(self.address, authkey=self.authkey)
+
+    def _call(self, op, **kwargs):
+        self.conn.send((op, kwargs))
+        status, res = self.conn.recv()
+        if status != 'ok':
+            raise RuntimeError(res)
+        return res
+
+    def predict_batch(self, rows_pairs):
+        return self._call('predict_batch', rows_pairs=rows_pairs)
+
+    def lift(self, samples, pair, compilers_keys=None):
+        return self._call('lift', samples=samples, pair=pair, compilers_keys=compilers_keys)
+
+    def ping(self):
+        return self._call('ping')
+
+    def shutdown(self):
+        # the server exits after accepting its next connection
+        self._call('shutdown')
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except OSError:
+            pass
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a Forklift model to many client scripts')
+    parser.add_argument('--model', required=True, help='HF model path')
+    parser.add_argument('--pairs', nargs='+', required=True, help='Lifting pairs, e.g. clang_opt3_ir_optz-ir_optz')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, help='Unix socket path or host:port')
+    parser.add_argument('--beam', type=int, default=5)
+    parser.add_argument('--nbest', type=int, default=1)
+    parser.add_argument('--asm-cache', default=None, help='Directory of a persistent cache of compiled assembly')
+    parser.add_argument('--n-workers', type=int, default=None, help='Parallel compiler invocations per sample')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'bfloat16'])
+    parser.add_argument('--quantize', default=None, choices=['dynamic_int8'])
+    parser.add_argument('--num-threads', type=int, default=None)
+    parser.add_argument('--authkey', default=None,
+                        help=f'Key clients authenticate with (default: ${AUTHKEY_ENV}, or a random key written to '
+                             f'<socket>.key for Unix sockets). Required for host:port')
+    args = parser.parse_args()
+    if authkey_path(args.address) is None and not (args.authkey or os.environ.get(AUTHKEY_ENV)):
+        parser.error(f'--authkey (or {AUTHKEY_ENV}) is required to serve on host:port')
+
+    from .evaluator import Config
+    from .cache import AsmCache
+    config = Config(hf_model_path=args.model, pairs=args.pairs, beam=args.beam, nbest=args.nbest, dtype=args.dtype,
+                    quantize=args.quantize, num_threads=args.num_threads)
+    server = LiftServer(config, asm_cache=AsmCache(args.asm_cache) if args.asm_cache else None,
+                        n_workers=args.n_workers)
+    print(f'Serving {args.model} on {args.address}')
+    server.serve_forever(args.address, authkey=args.authkey)
+
+
+if __name__ == '__main__':
+    main()
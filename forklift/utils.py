@@ -1,28 +1,46 @@
 import re
-from .asm import AsmAdder, FuncDataclass
 
-def normalize_structs(llvm_ir):
+_STRUCT_PATTERN = re.compile(r"%struct\.[a-zA-Z0-9_]+")
+
+
+def normalize_structs(llvm_ir, return_mapping=False):
+    # renames %struct.<name> to %struct.struct<n>, numbered by first occurrence, in a single pass over the text;
+    # with return_mapping, also returns the {original: normalized} names to undo it with denormalize_structs
     if not llvm_ir:
-        return llvm_ir
+        return (llvm_ir, {}) if return_mapping else llvm_ir
     struct_dict = {}
-    counter = 0
-    normalized_ir = ""
-    struct_pattern = re.compile(r"(%struct\.[a-zA-Z0-9_]+)")
-    for line in llvm_ir.split("\n"):
-        for match in struct_pattern.findall(line):
-            if match not in struct_dict:
-                struct_dict[match] = f"%struct.struct{counter}"
-                counter += 1
-        normalized_line = struct_pattern.sub(lambda m: struct_dict.get(m.group(1), m.group(1)), line)
-        normalized_ir += normalized_line + "\n"
-    return normalized_ir
+
+    def rename(m):
+        name = m.group(0)
+        normalized = struct_dict.get(name)
+        if normalized is None:
+            normalized = struct_dict[name] = f"%struct.struct{len(struct_dict)}"
+        return normalized
+
+    normalized_ir = _STRUCT_PATTERN.sub(rename, llvm_ir) + "\n"
+    return (normalized_ir, struct_dict) if return_mapping else normalized_ir
+
+
+def denormalize_structs(llvm_ir, mapping):
+    # maps the normalized struct names in e.g. a model prediction back to the original ones
+    inverse = {normalized: name for name, normalized in mapping.items()}
+    return _STRUCT_PATTERN.sub(lambda m: inverse.get(m.group(0), m.group(0)), llvm_ir)
 
 class InferenceDataset:
-    def __init__(self, data, compilers_keys=None):
+    def __init__(self, data, compilers_keys=None, n_workers=None, cache=None, pch_dir=None, asm_as_dict=False,
+                 pairs=None):
+        from .asm import AsmAdder
+        # with pairs and no compilers_keys, only the targets the pairs read are compiled
+        if compilers_keys is None and pairs:
+            from .par_data import DP
+            compilers_keys = DP.get_required_asms(pairs, add_o0_reference=False)
         self.data = data
-        self.asm_adder = AsmAdder(also_do_real=True, compilers_keys=compilers_keys)
+        self.asm_as_dict = asm_as_dict  # yield row['asm'] as {target: code} instead of the HF parallel lists
+        self.asm_adder = AsmAdder(also_do_real=True, compilers_keys=compilers_keys, n_workers=n_workers, cache=cache,
+                                  pch_dir=pch_dir)
 
     def __iter__(self):
+        from .asm import FuncDataclass
         for instance in self.data:
             func_def = instance['func_def']
             deps = instance['deps']
@@ -32,7 +50,10 @@ class InferenceDataset:
                               real_deps=deps)
             self.asm_adder.add_asm(e)
             e = e.dict()
-            self._fix(e)
+            if self.asm_as_dict:
+                e['asm'] = {target: code['func_asm'] if code else None for target, code in e['asm'].items()}
+            else:
+                self._fix(e)
             yield e
 
     def _fix(self, row):
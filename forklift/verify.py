@@ -0,0 +1,263 @@
+import argparse
+import glob
+import json
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+# Compile-and-run verification of lifted IR. Jobs are independent subprocesses, so a thread pool is enough to keep
+# every core busy; each step has its own timeout.
+
+PASS = 'pass'
+FAIL = 'fail'
+COMPILE_ERROR = 'compile_error'
+TIMEOUT = 'timeout'
+ERROR = 'error'
+
+
+@dataclass
+class VerifyJob:
+    name: str
+    output_exe: str
+    ll_file: Optional[str] = None  # if None, output_exe is assumed to be already built and is only run
+    test_c_file: Optional[str] = None
+    opt_level: str = '-O0'
+    compile_cmd: Optional[List[str]] = None  # overrides the default aarch64 cross-compilation command
+    run_cmd: Optional[List[str]] = None  # overrides [runner, output_exe]
+    run: bool = True  # if False, the job passes as soon as it compiles
+
+    def dict(self):
+        return asdict(self)
+
+
+@dataclass
+class VerifyResult:
+    name: str
+    status: str
+    message: str = ''
+    returncode: Optional[int] = None
+    compile_time: float = 0.0
+    run_time: float = 0.0
+    ll_file: Optional[str] = None
+    exe_file: Optional[str] = None
+
+    @property
+    def passed(self):
+        return self.status == PASS
+
+    def dict(self):
+        return asdict(self)
+
+
+def aarch64_compile_cmd(ll_file, test_c_file, output_exe, opt_level='-O0'):
+    home = os.path.expanduser('~')
+    return [
+        "clang",
+        "--target=aarch64-linux-gnu",
+        f"--sysroot={home}/aarch64-sysroot",
+        "-B/usr/lib/gcc-cross/aarch64-linux-gnu/11",
+        "-L/usr/lib/gcc-cross/aarch64-linux-gnu/11",
+        f"-L{home}/aarch64-sysroot/usr/aarch64-linux-gnu/lib",
+        "-static",
+        opt_level,
+        "-o", output_exe,
+        ll_file, test_c_file,
+        "-lm"
+    ]
+
+
+def aarch64_object_cmd(ll_file, output_obj, opt_level='-O0'):
+    # compile-only check of lifted IR, when there is no test harness
+    return ["clang", "--target=aarch64-linux-gnu", "-c", opt_level, "-o", output_obj, ll_file]
+
+
+def run_job(job: VerifyJob, compile_timeout=30, run_timeout=30, runner='qemu-aarch64', debug=False) -> VerifyResult:
+    res = VerifyResult(name=job.name, status=ERROR, ll_file=job.ll_file)
+    if job.ll_file is not None:
+        compile_cmd = job.compile_cmd or aarch64_compile_cmd(job.ll_file, job.test_c_file, job.output_exe,
+                                                             job.opt_level)
+        if debug:
+            print(f"Compile command: {' '.join(compile_cmd)}")
+        start = time.time()
+        try:
+            compiled = subprocess.run(compile_cmd, capture_output=True, text=True, timeout=compile_timeout)
+        except subprocess.TimeoutExpired:
+            res.status, res.message = TIMEOUT, f'Compilation timed out after {compile_timeout}s'
+            return res
+        except Exception as e:
+            res.message = f"Error during compilation/testing: {str(e)}"
+            return res
+        finally:
+            res.compile_time = time.time() - start
+        if compiled.returncode != 0:
+            res.status, res.returncode, res.message = COMPILE_ERROR, compiled.returncode, \
+                f"Compilation failed: {compiled.stderr}"
+            return res
+        if not job.run:
+            res.status, res.message, res.exe_file = PASS, "Compilation passed", job.output_exe
+            return res
+
+    run_cmd = job.run_cmd or [runner, job.output_exe]
+    if debug:
+        print(f"Running test: {' '.join(run_cmd)}")
+    start = time.time()
+    try:
+        tested = subprocess.run(run_cmd, capture_output=True, text=True, timeout=run_timeout)
+    except subprocess.TimeoutExpired:
+        res.status, res.message = TIMEOUT, f'Test timed out after {run_timeout}s'
+        return res
+    except Exception as e:
+        res.message = f"Error during compilation/testing: {str(e)}"
+        return res
+    finally:
+        res.run_time = time.time() - start
+    res.returncode = tested.returncode
+    if tested.returncode == 0:
+        res.status, res.message, res.exe_file = PASS, "Test passed", job.output_exe
+    else:
+        res.status, res.message = FAIL, f"Test failed: {tested.stderr}"
+    return res
+
+
+def verify_all(jobs: List[VerifyJob], n_workers=None, **kwargs) -> List[VerifyResult]:
+    # results are returned in the order of jobs
+    n_workers = n_workers or os.cpu_count()
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        return list(pool.map(lambda job: run_job(job, **kwargs), jobs))
+
+
+def summarize(results: List[VerifyResult]) -> Dict:
+    counts = {status: 0 for status in [PASS, FAIL, COMPILE_ERROR, TIMEOUT, ERROR]}
+    for r in results:
+        counts[r.status] += 1
+    total = len(results)
+    return dict(total=total, passed=counts[PASS], failed=total - counts[PASS], counts=counts,
+                success_rate=counts[PASS] / total if total else 0.0)
+
+
+def write_json_report(results: List[VerifyResult], path):
+    with open(path, 'w') as f:
+        json.dump(dict(summary=summarize(results), results=[r.dict() for r in results]), f, indent=2)
+
+
+def write_text_report(results: List[VerifyResult], path):
+    summary = summarize(results)
+    total, passed = summary['total'], summary['passed']
+    with open(path, 'w') as f:
+        f.write("Test Results Summary\n")
+        f.write(f"{'='*50}\n")
+        f.write(f"Total: {total}, Passed: {passed}, Failed: {total - passed}\n")
+        f.write(f"Success rate: {summary['success_rate']*100:.1f}%\n\n")
+
+        for r in results:
+            f.write(f"Problem {r.name}: {'PASSED' if r.passed else 'FAILED'}\n")
+            if not r.passed:
+                f.write(f"  Error: {r.message}\n")
+            f.write("\n")
+
+
+def make_verifier(name, work_dir, test_c_file=None, opt_level='-O0', fix=None, **run_kwargs):
+    """
+    Verifier of the IR lifted for one problem, for lift_and_verify: verifier(ir, attempt) writes fix(ir) to
+    work_dir/{name}_{attempt}.ll, compiles it with test_c_file and runs the test. Without test_c_file, the IR is only
+    compiled to an object file. run_kwargs are passed to run_job (timeouts, runner, debug).
+    """
+    os.makedirs(work_dir, exist_ok=True)
+
+    def verify(ir, attempt) -> VerifyResult:
+        base = os.path.join(work_dir, f'{name}_{attempt}')
+        ll_file = base + '.ll'
+        with open(ll_file, 'w') as f:
+            f.write(fix(ir) if fix else ir)
+        if test_c_file is None:
+            job = VerifyJob(name=name, output_exe=base + '.o', ll_file=ll_file, opt_level=opt_level,
+                            compile_cmd=aarch64_object_cmd(ll_file, base + '.o', opt_level), run=False)
+        else:
+            job = VerifyJob(name=name, output_exe=base + '_test', ll_file=ll_file, test_c_file=test_c_file,
+                            opt_level=opt_level)
+        return run_job(job, **run_kwargs)
+
+    return verify
+
+
+# pass@k search of lift_and_verify: greedy first, beam search only for the rows greedy didn't solve
+DEFAULT_STRATEGIES = (dict(num_beams=1, num_return_sequences=1), dict(num_beams=5, num_return_sequences=5))
+
+
+@dataclass
+class SearchResult:
+    status: str = ERROR  # of the passing hypothesis, else of the last one verified
+    strategy: Optional[int] = None  # index in strategies of the decoding that produced the passing hypothesis
+    rank: Optional[int] = None  # rank of the passing hypothesis among the ones of that decoding
+    hypothesis: Optional[str] = None
+    attempts: List[VerifyResult] = field(default_factory=list)  # one per distinct hypothesis verified, in order
+
+    @property
+    def passed(self):
+        return self.status == PASS
+
+    def dict(self):
+        return asdict(self)
+
+
+def lift_and_verify(evaluator, rows_pairs, verifiers, strategies=DEFAULT_STRATEGIES, n_workers=None) \
+        -> List[SearchResult]:
+    """
+    Lifts rows_pairs with an Evaluator and verifies the hypotheses, stopping at the first that passes.
+    The rows are encoded once, then decoded with each of strategies (model.generate() overrides, cheapest first)
+    for the rows without a passing hypothesis yet. The hypotheses of a row are verified in rank order by
+    verifiers[idx] (see make_verifier), skipping those already verified; rows are verified in parallel.
+    """
+    rows_pairs = list(rows_pairs)
+    encoded = evaluator.encode(rows_pairs)
+    res = [SearchResult() for _ in rows_pairs]
+    verified = [set() for _ in rows_pairs]
+    todo = list(range(len(rows_pairs)))
+    with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count()) as pool:
+        for strategy_idx, strategy in enumerate(strategies):
+            if not todo:
+                break
+
+            def search(idx, hyps):
+                for rank, hyp in enumerate(hyps or []):
+                    if not hyp or hyp in verified[idx]:
+                        continue
+                    verified[idx].add(hyp)
+                    attempt = verifiers[idx](hyp, len(res[idx].attempts))
+                    res[idx].attempts.append(attempt)
+                    res[idx].status = attempt.status
+                    if attempt.passed:
+                        res[idx].strategy, res[idx].rank, res[idx].hypothesis = strategy_idx, rank, hyp
+                        return
+
+            list(pool.map(search, todo, evaluator.decode(encoded.select(todo), **strategy)))
+            todo = [idx for idx in todo if not res[idx].passed]
+    return res
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run prebuilt test executables (e.g. results/problem*_test) in parallel')
+    parser.add_argument('exes', nargs='*', help='Executables to run (default: problem*_test in the current directory)')
+    parser.add_argument('--runner', default='qemu-aarch64')
+    parser.add_argument('--timeout', type=float, default=5)
+    parser.add_argument('--jobs', type=int, default=None, help='Number of parallel jobs (default: number of cores)')
+    parser.add_argument('--json', default=None, help='Write a JSON report to this path')
+    args = parser.parse_args(argv)
+
+    exes = args.exes or sorted(glob.glob('problem*_test'))
+    jobs = [VerifyJob(name=os.path.basename(exe), output_exe=exe) for exe in exes]
+    results = verify_all(jobs, n_workers=args.jobs, run_timeout=args.timeout, runner=args.runner)
+    for r in results:
+        print(f" - {r.name}: {r.status} {'' if r.passed else r.message.strip()}")
+    summary = summarize(results)
+    print(f"\nTotal tests: {summary['total']}, Passed: {summary['passed']}, Failed: {summary['failed']}")
+    if args.json:
+        write_json_report(results, args.json)
+    return 0 if summary['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,43 +1,42 @@
 import argparse
 import os
-import subprocess
 import re
-from forklift.evaluator import Evaluator, Config
+from forklift.evaluator import Config, get_evaluator
+from forklift.service import LiftClient
 from forklift.asm import AsmAdder, FuncDataclass
 from forklift.utils import normalize_structs, InferenceDataset
+from forklift.cache import AsmCache
+from forklift.verify import VerifyJob, COMPILE_ERROR, FAIL, TIMEOUT, verify_all, write_json_report, write_text_report
 
 # --- MODEL AND FORKLIFT CONFIGURATION (Mostly Unchanged) ---
 DIRECTION = 'clang_opt3_ir_optz-ir_optz'
 MODELS = {'clang_opt3_ir_optz-ir_optz': 'jordiae/clang_opt3_ir_optz-ir_optz-2024-01-15-0959-e1bf-bc2b'}
+# decoding of the retries of failed problems, from the encoder states cached on the first attempt
+RETRY_DECODING = dict(num_beams=1, num_return_sequences=1, do_sample=True, top_p=0.95, temperature=0.8)
 
-def run_model_on_sample(sample):
+def get_local_evaluator():
+    # the model weights are loaded once per process and shared by every sample
+    return get_evaluator(Config(hf_model_path=MODELS[DIRECTION], pairs=[DIRECTION]))
+
+def run_model_on_sample(sample, asm_cache=None, client=None, pch_dir=None, return_encoded=False):
     """
     Takes a SAMPLE dictionary and runs it through the forklift model.
-    Returns the generated LLVM IR string.
+    Returns the generated LLVM IR string (and, with return_encoded, the Evaluator.encode() result to decode retries
+    from; None with a client).
+    If a LiftClient is given, the sample is lifted by the running forklift.service instead.
     """
-    config = Config(hf_model_path=MODELS[DIRECTION], pairs=[DIRECTION])
-    evaluator = Evaluator(config)
-    predictions = []
-    fnames = []
-    batch = []
-    rows = []
-    pair = DIRECTION
-    samples = [sample]
+    if client is not None:
+        prediction = client.lift([sample], pair=DIRECTION, compilers_keys=['clang_ir_Oz', 'clang_x86_O3'])[0][0]
+        return (prediction, None) if return_encoded else prediction
+    evaluator = get_local_evaluator()
     # NOTE: The compiler keys here are part of how forklift generates its internal dataset.
     # They don't directly affect the final compilation command we build ourselves.
-    for row in InferenceDataset(samples, compilers_keys=['clang_ir_Oz', 'clang_x86_O3']):
-        batch.append((row, pair))
-        # The fname in the original script was hardcoded; let's use the correct one.
-        fnames.append(sample['fname'])
-        rows.append(row)
-        if len(batch) == 1:
-            predictions.extend(evaluator.predict_batch(batch))
-            batch = []
-    if len(batch) > 0:
-        predictions.extend(evaluator.predict_batch(batch))
-
-    # predictions[0] is a list of outputs, we want the first one.
-    return predictions[0][0]
+    rows = InferenceDataset([sample], compilers_keys=['clang_ir_Oz', 'clang_x86_O3'], cache=asm_cache,
+                            pch_dir=pch_dir)
+    encoded = evaluator.encode([(row, DIRECTION) for row in rows])
+    # the first (and only) row, we want its first output
+    prediction = evaluator.decode(encoded)[0][0]
+    return (prediction, encoded) if return_encoded else prediction
 
 def load_c_code(code_path):
     """
@@ -99,6 +98,10 @@ def main(args):
         
     passed_problems = []
     failed_problems = []
+    asm_cache = AsmCache(args.asm_cache) if args.asm_cache else None
+    client = LiftClient(args.server) if args.server else None
+    jobs = []
+    encoded = {}  # problem number -> encoder states, to retry without re-running the encoder
 
     print(f"Starting processing for {len(problems_to_run)} problem(s).")
     print(f"Results will be stored in: {results_base_dir}")
@@ -127,69 +130,64 @@ def main(args):
         sample = dict(func_def=func_def, deps=deps, fname='func0')
         
         # 3. Run model and save the (fixed) LLVM IR
-        print("    [1/4] Running model to generate LLVM IR...")
-        lifted_ir_raw = run_model_on_sample(sample)
+        print("    Running model to generate LLVM IR...")
+        if args.retries > 0:
+            lifted_ir_raw, encoded[num] = run_model_on_sample(sample, asm_cache=asm_cache, client=client,
+                                                              pch_dir=args.pch_dir, return_encoded=True)
+        else:
+            lifted_ir_raw = run_model_on_sample(sample, asm_cache=asm_cache, client=client, pch_dir=args.pch_dir)
         lifted_ir_fixed = fix_llvm_ir(lifted_ir_raw)
         
         with open(ll_file, 'w') as f:
             f.write(lifted_ir_fixed)
         print(f"    [+] LLVM IR saved to: {ll_file}")
         
-        # 4. Compile the generated IR with the test file
-        print("    [2/4] Compiling generated IR with test case...")
-        # Using the user-specified command structure
+        # 4. Queue the compile+test job; all jobs run in parallel once every problem has been lifted
         # NOTE: -O2 is a placeholder for optimization level. Change if needed.
-        opt_level_flag = "-O2"
-        compile_cmd = [
-            "clang", "--target=aarch64-linux-gnu", f"--sysroot={os.path.expanduser('~')}/aarch64-sysroot",
-            "-B/usr/lib/gcc-cross/aarch64-linux-gnu/11", "-L/usr/lib/gcc-cross/aarch64-linux-gnu/11",
-            f"-L{os.path.expanduser('~')}/aarch64-sysroot/usr/aarch64-linux-gnu/lib", "-static",
-            opt_level_flag, "-o", output_exe, ll_file, test_c_file, "-lm"
-        ]
-        
-        if args.debug:
-            print(f"    [DEBUG] Compile command: {' '.join(compile_cmd)}")
-            
-        compile_proc = subprocess.run(compile_cmd, capture_output=True, text=True, timeout=30)  # 30 second timeout
-        
-        if compile_proc.returncode != 0:
-            print("    [-] ERROR: Compilation failed!")
-            if args.debug:
-                print("    [DEBUG] Stderr:\n" + compile_proc.stderr)
-            failed_problems.append(num)
-            continue
-        
-        print(f"    [+] Compilation successful. Executable at: {output_exe}")
+        jobs.append(VerifyJob(name=str(num), output_exe=output_exe, ll_file=ll_file, test_c_file=test_c_file,
+                              opt_level="-O2"))
 
-        # 5. Run the executable using QEMU to test it
-        print("    [3/4] Running test executable with QEMU...")
-        # We need qemu-aarch64-static to run the cross-compiled binary
-        test_cmd = ["qemu-aarch64-static", output_exe]
-        
-        if args.debug:
-            print(f"    [DEBUG] Test command: {' '.join(test_cmd)}")
-            
-        try:
-            test_proc = subprocess.run(test_cmd, capture_output=True, text=True, timeout=10) # 10 second timeout
-            
-            # test.c should return 0 on success
-            if test_proc.returncode == 0:
-                print("    [4/4] SUCCESS: Test case passed!")
-                passed_problems.append(num)
-            else:
-                print("    [4/4] FAILURE: Test case failed.")
-                if args.debug:
-                    print(f"    [DEBUG] Program returned code {test_proc.returncode}")
-                    print(f"    [DEBUG] Program stdout:\n{test_proc.stdout}")
-                failed_problems.append(num)
-        except FileNotFoundError:
-            print("    [-] ERROR: `qemu-aarch64-static` not found. Cannot run test case.")
-            print("    [-] Please install it (e.g., `sudo apt-get install qemu-user-static`)")
-            failed_problems.append(num)
-        except subprocess.TimeoutExpired:
-            print("    [-] ERROR: Test execution timed out (possible infinite loop).")
-            failed_problems.append(num)
+    # 5. Compile the generated IR with the test files and run them under QEMU
+    print(f"\n>>> Compiling and testing {len(jobs)} problem(s) in parallel...")
+    verify_kwargs = dict(n_workers=args.jobs, compile_timeout=30, run_timeout=10, runner="qemu-aarch64-static",
+                         debug=args.debug)
+    results = verify_all(jobs, **verify_kwargs)
+
+    # 6. Retry the failed problems with sampled IR, decoded from the cached encoder states
+    for attempt in range(1, args.retries + 1):
+        retry = [i for i, result in enumerate(results) if not result.passed and encoded[int(result.name)] is not None]
+        if not retry:
+            break
+        print(f"\n>>> Retry {attempt}/{args.retries}: sampling new LLVM IR for {len(retry)} problem(s)...")
+        evaluator = get_local_evaluator()
+        for i in retry:
+            lifted_ir_raw = evaluator.decode(encoded[int(jobs[i].name)], **RETRY_DECODING)[0][0]
+            with open(jobs[i].ll_file, 'w') as f:
+                f.write(fix_llvm_ir(lifted_ir_raw))
+        for i, result in zip(retry, verify_all([jobs[i] for i in retry], **verify_kwargs)):
+            results[i] = result
 
+    for result in results:
+        num = int(result.name)
+        if result.passed:
+            print(f"    [+] Problem #{num}: SUCCESS: Test case passed!")
+            passed_problems.append(num)
+            continue
+        failed_problems.append(num)
+        if result.status == COMPILE_ERROR:
+            print(f"    [-] Problem #{num}: ERROR: Compilation failed!")
+        elif result.status == TIMEOUT:
+            print(f"    [-] Problem #{num}: ERROR: {result.message} (possible infinite loop).")
+        elif result.status == FAIL:
+            print(f"    [-] Problem #{num}: FAILURE: Test case failed.")
+        else:
+            print(f"    [-] Problem #{num}: ERROR: {result.message}")
+            print("    [-] Is `qemu-aarch64-static` installed? (e.g., `sudo apt-get install qemu-user-static`)")
+        if args.debug:
+            print(f"    [DEBUG] Program returned code {result.returncode}")
+            print(f"    [DEBUG] {result.message}")
+    write_text_report(results, os.path.join(results_base_dir, 'test_results.txt'))
+    write_json_report(results, os.path.join(results_base_dir, 'test_results.json'))
 
     # --- Final Summary ---
     print("\n" + "="*40)
@@ -227,6 +225,36 @@ if __name__ == '__main__':
         default='./results',
         help="Directory to store all outputs."
     )
+    parser.add_argument(
+        '--asm-cache',
+        type=str,
+        default=None,
+        help="Directory of a persistent cache of compiled assembly, reused across runs."
+    )
+    parser.add_argument(
+        '--pch-dir',
+        type=str,
+        default=None,
+        help="Directory of precompiled headers for the #include lines shared by every problem."
+    )
+    parser.add_argument(
+        '--server',
+        type=str,
+        default=None,
+        help="Address of a running `python -m forklift.service` to lift with, instead of loading the model here."
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=None,
+        help="Number of parallel compile+test jobs (default: number of cores)."
+    )
+    parser.add_argument(
+        '--retries',
+        type=int,
+        default=0,
+        help="Times to re-sample the IR of failed problems, reusing their encoder states (local model only)."
+    )
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -234,4 +262,6 @@ if __name__ == '__main__':
     )
     
     args = parser.parse_args()
+    if args.server and args.retries > 0:
+        parser.error("--retries needs the encoder states of the local model, it can't be used with --server")
     main(args)
\ No newline at end of file
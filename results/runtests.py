@@ -1,51 +1,51 @@
+import argparse
 import os
 import re
-import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from forklift.verify import PASS, TIMEOUT, VerifyJob, verify_all, write_json_report
+
 
 def find_test_files():
     """Find all test files in the current directory named problem#_test where # is a number."""
-    return [f for f in os.listdir('.') if re.fullmatch(r'problem\d+_test', f)]
+    return sorted(f for f in os.listdir('.') if re.fullmatch(r'problem\d+_test', f))
 
 
 def main():
-    success = 0
-    total = 0
-    successlist = []
-    
+    parser = argparse.ArgumentParser(description='Run the problem#_test executables of the current directory')
+    parser.add_argument('--jobs', type=int, default=None, help='Number of parallel tests (default: number of cores)')
+    parser.add_argument('--timeout', type=float, default=5)
+    parser.add_argument('--json', default='runtests.json', help='JSON report path')
+    args = parser.parse_args()
+
     test_files = find_test_files()
     if not test_files:
         print("No test files found in the current directory.")
-        return 
-    
+        return
+
+    jobs = [VerifyJob(name=test_file, output_exe=os.path.join('.', test_file)) for test_file in test_files]
+    results = verify_all(jobs, n_workers=args.jobs, run_timeout=args.timeout, runner='qemu-aarch64')
+
     print("Found test files:")
-    for test_file in test_files:
-        total += 1
-        print(f" - {test_file}")
-        try:
-            test_result = subprocess.run(
-                ["qemu-aarch64", test_file],
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
-            if test_result.returncode == 0:
-                print("  Test passed")
-                success += 1
-                successlist.append(test_file)
-            else:
-                print(f"  Test failed: {test_result.stderr.strip()}")
-        except subprocess.TimeoutExpired:
+    for r in results:
+        print(f" - {r.name}")
+        if r.status == PASS:
+            print("  Test passed")
+        elif r.status == TIMEOUT:
             print("  Test timed out")
-        except Exception as e:
-            print(f"  Unexpected error: {e}")
+        else:
+            print(f"  {r.message.strip()}")
 
+    successlist = [r.name for r in results if r.passed]
+    total, success = len(results), len(successlist)
     print(f"\nTotal tests: {total}, Passed: {success}, Failed: {total - success}")
     if successlist:
         print("\nSuccessful tests:")
         for s in successlist:
             print(f" - {s}")
-    
+    write_json_report(results, args.json)
+
 
 if __name__ == '__main__':
     main()
-    
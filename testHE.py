@@ -1,17 +1,21 @@
-from forklift.evaluator import Evaluator, Config
+from forklift.evaluator import Config, get_evaluator
+from forklift.service import LiftClient
 import os
 import glob
 import argparse
-import subprocess
 import shutil
 from pathlib import Path
 from forklift.asm import AsmAdder, FuncDataclass
 from forklift.utils import normalize_structs, InferenceDataset
+from forklift.cache import AsmCache
+from forklift.verify import VerifyJob, VerifyResult, ERROR, run_job, verify_all, write_json_report, write_text_report, \
+    lift_and_verify, make_verifier
 
 DIRECTION = 'clang_opt3_ir_optz-ir_optz'
 
 MODELS = {'clang_opt3_ir_optz-ir_optz': 'jordiae/clang_opt3_ir_optz-ir_optz-2024-01-15-0959-e1bf-bc2b'
           }
+SEARCH_BATCH_SIZE = 8  # problems encoded and decoded together by --pass-at-k
 
 def read_code_file(problem_path):
     """Read the code.c file and extract the function definition"""
@@ -44,19 +48,23 @@ def create_sample(problem_path):
         fname='func0',
     )
 
-def run_prediction(sample, batch_size=1):
-    """Run the model prediction on a sample"""
+def run_prediction(sample, batch_size=1, asm_cache=None, client=None, pch_dir=None):
+    """Run the model prediction on a sample, locally or on a running forklift.service"""
+    if client is not None:
+        return client.lift([sample], pair=DIRECTION, compilers_keys=['clang_ir_Oz', 'clang_x86_O3'])[0]
     config = Config(hf_model_path=MODELS[DIRECTION],
                     pairs=[DIRECTION],
                     )
 
-    evaluator = Evaluator(config)
+    # the model weights are loaded once per process and shared by every problem
+    evaluator = get_evaluator(config)
     predictions = []
     batch = []
     pair = DIRECTION
     samples = [sample]
     
-    for row in InferenceDataset(samples, compilers_keys=['clang_ir_Oz', 'clang_x86_O3']):
+    for row in InferenceDataset(samples, compilers_keys=['clang_ir_Oz', 'clang_x86_O3'], cache=asm_cache,
+                                pch_dir=pch_dir):
         batch.append((row, pair))
         if len(batch) == batch_size:
             predictions.extend(evaluator.predict_batch(batch))
@@ -69,42 +77,52 @@ def run_prediction(sample, batch_size=1):
 
 def compile_and_test(ll_file, test_c_file, output_exe, opt_level="-O0", debug=False):
     """Compile the LLVM IR with test.c and run the test"""
-    compile_cmd = [
-        "clang", 
-        "--target=aarch64-linux-gnu", 
-        f"--sysroot={os.path.expanduser('~')}/aarch64-sysroot",
-        "-B/usr/lib/gcc-cross/aarch64-linux-gnu/11",
-        "-L/usr/lib/gcc-cross/aarch64-linux-gnu/11",
-        f"-L{os.path.expanduser('~')}/aarch64-sysroot/usr/aarch64-linux-gnu/lib",
-        "-static",
-        opt_level,
-        "-o", output_exe,
-        ll_file, test_c_file,
-        "-lm"
-    ]
-    
-    if debug:
-        print(f"Compile command: {' '.join(compile_cmd)}")
-    
-    try:
-        # Compile
-        result = subprocess.run(compile_cmd, capture_output=True, text=True, timeout=30)
-        if result.returncode != 0:
-            return False, f"Compilation failed: {result.stderr}"
-        
-        # Run the test
-        if debug:
-            print(f"Running test: {output_exe}")
-        
-        test_result = subprocess.run(["qemu-aarch64", output_exe], capture_output=True, text=True, timeout=30)
-        
-        if test_result.returncode == 0:
-            return True, "Test passed"
-        else:
-            return False, f"Test failed: {test_result.stderr}"
-            
-    except Exception as e:
-        return False, f"Error during compilation/testing: {str(e)}"
+    job = VerifyJob(name=os.path.basename(ll_file), output_exe=output_exe, ll_file=ll_file, test_c_file=test_c_file,
+                    opt_level=opt_level)
+    result = run_job(job, debug=debug)
+    return result.passed, result.message
+
+def search_problems(problem_dirs, results_dir, args, asm_cache=None):
+    """Lift-and-verify (pass@k): greedy first, then k beam hypotheses for the problems greedy didn't solve"""
+    evaluator = get_evaluator(Config(hf_model_path=MODELS[DIRECTION], pairs=[DIRECTION]))
+    strategies = (dict(num_beams=1, num_return_sequences=1),
+                  dict(num_beams=args.pass_at_k, num_return_sequences=args.pass_at_k))
+    results = {}
+    todo = []
+    for problem_num, problem_path in problem_dirs:
+        test_c_file = os.path.join(problem_path, 'test.c')
+        if not os.path.exists(test_c_file):
+            print(f"Warning: test.c not found for problem {problem_num}")
+            results[problem_num] = VerifyResult(name=str(problem_num), status=ERROR, message='test.c not found')
+            continue
+        try:
+            sample = create_sample(problem_path)
+        except Exception as e:
+            print(f"✗ Problem {problem_num}: ERROR - {str(e)}")
+            results[problem_num] = VerifyResult(name=str(problem_num), status=ERROR, message=str(e))
+            continue
+        verifier = make_verifier(f"problem{problem_num}", str(results_dir), test_c_file=test_c_file,
+                                 opt_level=args.opt_level, debug=args.debug)
+        todo.append((problem_num, sample, verifier))
+
+    for start in range(0, len(todo), SEARCH_BATCH_SIZE):
+        batch = todo[start:start + SEARCH_BATCH_SIZE]
+        print(f"\nLifting and verifying problems {', '.join(str(num) for num, _, _ in batch)}...")
+        rows = InferenceDataset([sample for _, sample, _ in batch], compilers_keys=['clang_ir_Oz', 'clang_x86_O3'],
+                                cache=asm_cache, pch_dir=args.pch_dir)
+        searched = lift_and_verify(evaluator, [(row, DIRECTION) for row in rows], [v for _, _, v in batch],
+                                   strategies=strategies, n_workers=args.jobs)
+        for (problem_num, _, _), search in zip(batch, searched):
+            result = search.attempts[-1] if search.attempts else \
+                VerifyResult(name=str(problem_num), status=ERROR, message='No prediction generated')
+            result.name = str(problem_num)
+            results[problem_num] = result
+            if search.passed:
+                print(f"✓ Problem {problem_num}: PASSED (strategy {search.strategy}, rank {search.rank}, "
+                      f"{len(search.attempts)} hypotheses verified)")
+            else:
+                print(f"✗ Problem {problem_num}: FAILED - {result.message}")
+    return results
 
 def get_problem_directories(base_path="~/asm-to-asm/humaneval"):
     """Get all problem directories"""
@@ -124,8 +142,16 @@ def main():
     parser.add_argument('--debug', action='store_true', help='Enable debug mode with verbose output')
     parser.add_argument('--opt-level', default='-O3', help='Optimization level for compilation (default: -O3)')
     parser.add_argument('--results-dir', default='results', help='Directory to store results (default: results)')
+    parser.add_argument('--asm-cache', default=None, help='Directory of a persistent cache of compiled assembly')
+    parser.add_argument('--pch-dir', default=None, help='Directory of precompiled headers for the shared #include lines')
+    parser.add_argument('--server', default=None, help='Address of a running forklift.service to lift with')
+    parser.add_argument('--jobs', type=int, default=None, help='Parallel compile+test jobs (default: number of cores)')
+    parser.add_argument('--pass-at-k', type=int, default=None,
+                        help='Lift-and-verify: try greedy, then the k beam hypotheses, until one passes (local model)')
     
     args = parser.parse_args()
+    if args.server and args.pass_at_k:
+        parser.error("--pass-at-k needs the beam hypotheses of the local model, it can't be used with --server")
     
     # Create results directory
     results_dir = Path(args.results_dir)
@@ -143,82 +169,83 @@ def main():
         problem_dirs = get_problem_directories()
         print(f"Running on all problems (found {len(problem_dirs)} problems)")
     
+    asm_cache = AsmCache(args.asm_cache) if args.asm_cache else None
+    client = LiftClient(args.server) if args.server else None
     results = {}
-    passed_count = 0
+    jobs = []
     total_count = len(problem_dirs)
     
-    for problem_num, problem_path in problem_dirs:
-        print(f"\n--- Processing Problem {problem_num} ({passed_count + len([r for r in results.values() if not r['passed']])}/{total_count}) ---")
+    if args.pass_at_k:
+        results.update(search_problems(problem_dirs, results_dir, args, asm_cache=asm_cache))
+    else:
+        # Phase 1: run the model on every problem (sequential, the model is shared)
+        for idx, (problem_num, problem_path) in enumerate(problem_dirs):
+            print(f"\n--- Processing Problem {problem_num} ({idx}/{total_count}) ---")
         
-        try:
-            # Create sample from problem
-            if args.debug:
-                print(f"Reading problem from: {problem_path}")
-            
-            sample = create_sample(problem_path)
-            
-            if args.debug:
-                print(f"\nC code being processed:")
-                print("=" * 50)
-                print(sample['func_def'])
-                print("=" * 50)
+            try:
+                # Create sample from problem
+                if args.debug:
+                    print(f"Reading problem from: {problem_path}")
             
-            # Run prediction
-            print(f"Running model prediction for problem {problem_num}...")
-            predicted = run_prediction(sample)
+                sample = create_sample(problem_path)
             
-            if not predicted:
-                print(f"Error: No prediction generated for problem {problem_num}")
-                results[problem_num] = {'passed': False, 'error': 'No prediction generated'}
-                continue
+                if args.debug:
+                    print(f"\nC code being processed:")
+                    print("=" * 50)
+                    print(sample['func_def'])
+                    print("=" * 50)
             
-            if args.debug:
-                print(f"\nGenerated LLVM IR:")
-                print("=" * 50)
-                print(predicted[0])
-                print("=" * 50)
+                # Run prediction
+                print(f"Running model prediction for problem {problem_num}...")
+                predicted = run_prediction(sample, asm_cache=asm_cache, client=client, pch_dir=args.pch_dir)
             
-            # Save the generated LLVM IR
-            ll_filename = f"problem{problem_num}_generated.ll"
-            ll_file = results_dir / ll_filename
+                if not predicted:
+                    print(f"Error: No prediction generated for problem {problem_num}")
+                    results[problem_num] = VerifyResult(name=str(problem_num), status=ERROR, message='No prediction generated')
+                    continue
             
-            with open(ll_file, 'w') as f:
-                f.write(predicted[0])  # Assuming first prediction is what we want
+                if args.debug:
+                    print(f"\nGenerated LLVM IR:")
+                    print("=" * 50)
+                    print(predicted[0])
+                    print("=" * 50)
             
-            if args.debug:
-                print(f"Generated LLVM IR saved to: {ll_file}")
+                # Save the generated LLVM IR
+                ll_filename = f"problem{problem_num}_generated.ll"
+                ll_file = results_dir / ll_filename
             
-            # Test compilation and execution
-            test_c_file = os.path.join(problem_path, 'test.c')
-            if not os.path.exists(test_c_file):
-                print(f"Warning: test.c not found for problem {problem_num}")
-                results[problem_num] = {'passed': False, 'error': 'test.c not found'}
-                continue
+                with open(ll_file, 'w') as f:
+                    f.write(predicted[0])  # Assuming first prediction is what we want
             
-            output_exe = results_dir / f"problem{problem_num}_test"
+                if args.debug:
+                    print(f"Generated LLVM IR saved to: {ll_file}")
             
-            print(f"Compiling and testing problem {problem_num}...")
-            test_passed, test_message = compile_and_test(
-                str(ll_file), test_c_file, str(output_exe), 
-                args.opt_level, args.debug
-            )
+                test_c_file = os.path.join(problem_path, 'test.c')
+                if not os.path.exists(test_c_file):
+                    print(f"Warning: test.c not found for problem {problem_num}")
+                    results[problem_num] = VerifyResult(name=str(problem_num), status=ERROR, message='test.c not found',
+                                                        ll_file=str(ll_file))
+                    continue
             
-            results[problem_num] = {
-                'passed': test_passed,
-                'message': test_message,
-                'll_file': str(ll_file),
-                'exe_file': str(output_exe) if test_passed else None
-            }
-            
-            if test_passed:
-                passed_count += 1
+                output_exe = results_dir / f"problem{problem_num}_test"
+                jobs.append((problem_num, VerifyJob(name=str(problem_num), output_exe=str(output_exe), ll_file=str(ll_file),
+                                                    test_c_file=test_c_file, opt_level=args.opt_level)))
+                
+            except Exception as e:
+                print(f"✗ Problem {problem_num}: ERROR - {str(e)}")
+                results[problem_num] = VerifyResult(name=str(problem_num), status=ERROR, message=str(e))
+    
+        # Phase 2: compile and test all the generated IR in parallel, bounded by cores instead of the sum of timeouts
+        print(f"\nCompiling and testing {len(jobs)} problems ({args.jobs or os.cpu_count()} parallel jobs)...")
+        verified = verify_all([job for _, job in jobs], n_workers=args.jobs, debug=args.debug)
+        for (problem_num, _), result in zip(jobs, verified):
+            results[problem_num] = result
+            if result.passed:
                 print(f"✓ Problem {problem_num}: PASSED")
             else:
-                print(f"✗ Problem {problem_num}: FAILED - {test_message}")
-                
-        except Exception as e:
-            print(f"✗ Problem {problem_num}: ERROR - {str(e)}")
-            results[problem_num] = {'passed': False, 'error': str(e)}
+                print(f"✗ Problem {problem_num}: FAILED - {result.message}")
+    results = dict(sorted(results.items()))
+    passed_count = sum(result.passed for result in results.values())
     
     # Print final summary
     print(f"\n{'='*60}")
@@ -231,32 +258,21 @@ def main():
     
     print(f"\nPassed problems:")
     for problem_num, result in results.items():
-        if result['passed']:
+        if result.passed:
             print(f"  Problem {problem_num}")
     
     print(f"\nFailed problems:")
     for problem_num, result in results.items():
-        if not result['passed']:
-            error_msg = result.get('error', result.get('message', 'Unknown error'))
-            print(f"  Problem {problem_num}: {error_msg}")
+        if not result.passed:
+            print(f"  Problem {problem_num}: {result.message}")
     
     # Save detailed results to file
     results_file = results_dir / 'test_results.txt'
-    with open(results_file, 'w') as f:
-        f.write(f"Test Results Summary\n")
-        f.write(f"{'='*50}\n")
-        f.write(f"Total: {total_count}, Passed: {passed_count}, Failed: {total_count - passed_count}\n")
-        f.write(f"Success rate: {passed_count/total_count*100:.1f}%\n\n")
-        
-        for problem_num, result in results.items():
-            status = "PASSED" if result['passed'] else "FAILED"
-            f.write(f"Problem {problem_num}: {status}\n")
-            if not result['passed']:
-                error_msg = result.get('error', result.get('message', 'Unknown error'))
-                f.write(f"  Error: {error_msg}\n")
-            f.write(f"\n")
+    write_text_report(list(results.values()), results_file)
+    json_file = results_dir / 'test_results.json'
+    write_json_report(list(results.values()), json_file)
     
-    print(f"\nDetailed results saved to: {results_file}")
+    print(f"\nDetailed results saved to: {results_file} and {json_file}")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file